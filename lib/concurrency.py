@@ -0,0 +1,98 @@
+import math
+import time
+from collections import deque
+
+
+class AdaptiveLimit(object):
+    '''
+    Concurrency limit that follows the latency of the work it admits.
+
+    Latencies are averaged over windows of ``limit`` samples.  The fastest
+    window seen so far is the baseline: while windows stay within
+    ``tolerance`` times the baseline the limit grows by about ``sqrt(limit)``
+    per window, and as they get slower it shrinks proportionally.  The
+    baseline drifts up a little on every window so a single lucky window
+    does not hold the limit down forever.  :meth:`overloaded` halves the
+    limit straight away, for signals that do not come from latency (e.g. a
+    busy database).
+
+    :param initial: Starting limit.
+    :param minimum: Lowest limit.
+    :param maximum: Highest limit.
+    :param tolerance: Ratio of window latency to baseline that is still
+                      considered healthy.
+    :param smoothing: Weight of each new estimate in the limit, in (0, 1].
+    :param rate_interval: Seconds covered by :attr:`rate`.
+    :param clock: Function returning the current time in seconds.
+    '''
+
+    BASELINE_DRIFT = 1.05
+
+    def __init__(self, initial=10, minimum=1, maximum=150, tolerance=2.0,
+                 smoothing=0.2, rate_interval=30, clock=time.time):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.rate_interval = rate_interval
+        self._clock = clock
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._window = []
+        self._baseline = None
+        self._completions = deque()
+        self.completed = 0
+
+    @property
+    def limit(self):
+        '''
+        Current number of tasks that may run at the same time.
+        '''
+        return int(self._limit)
+
+    @property
+    def rate(self):
+        '''
+        Completed samples per second over the last ``rate_interval`` seconds.
+        '''
+        now = self._clock()
+        self._expire(now)
+        if len(self._completions) < 2:
+            return 0.0
+        elapsed = max(self._completions[-1] - self._completions[0], 1e-6)
+        return (len(self._completions) - 1) / elapsed
+
+    def sample(self, latency):
+        '''
+        Records the latency, in seconds, of a completed task.
+        '''
+        now = self._clock()
+        self.completed += 1
+        self._completions.append(now)
+        self._expire(now)
+
+        self._window.append(latency)
+        if len(self._window) >= self.limit:
+            self._update(sum(self._window) / len(self._window))
+            self._window = []
+
+    def overloaded(self):
+        '''
+        Halves the limit, e.g. when the database reports too many busy backends.
+        '''
+        self._limit = max(float(self.minimum), self._limit / 2)
+        self._window = []
+
+    def _update(self, latency):
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        gradient = 1.0
+        if latency > 0:
+            gradient = max(0.5, min(1.0, self.tolerance * self._baseline / latency))
+        estimate = self._limit * gradient + math.sqrt(self._limit)
+        limit = (1 - self.smoothing) * self._limit + self.smoothing * estimate
+        self._limit = min(float(self.maximum), max(float(self.minimum), limit))
+        self._baseline *= self.BASELINE_DRIFT
+
+    def _expire(self, now):
+        while self._completions and self._completions[0] < now - self.rate_interval:
+            self._completions.popleft()
@@ -1,3 +1,13 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+
 def copy_from_csv(session, table_name, columns, csv_stream):
     '''
     Creates a table, loading the data from a .csv file.
@@ -19,3 +29,179 @@ def copy_from_csv(session, table_name, columns, csv_stream):
                 cols=', '.join(columns.keys()),
                 table=table_name),
             csv_stream)
+
+
+class IteratorStream(io.RawIOBase):
+    '''
+    Read-only stream over an iterator of text lines, so rows generated on the
+    fly can be handed to ``COPY ... FROM STDIN`` without being materialized.
+    '''
+    def __init__(self, lines, encoding='utf-8'):
+        '''
+        :param lines: An iterable of ``str`` lines, including their line
+                      terminators.
+        :param encoding: Encoding used to turn the lines into bytes.
+        '''
+        self._lines = iter(lines)
+        self._encoding = encoding
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        filled = 0
+        while filled < len(buf):
+            if not self._pending:
+                try:
+                    self._pending = memoryview(next(self._lines).encode(self._encoding))
+                except StopIteration:
+                    break
+            size = min(len(buf) - filled, len(self._pending))
+            buf[filled:filled + size] = self._pending[:size]
+            self._pending = self._pending[size:]
+            filled += size
+        return filled
+
+
+def copy_text_line(values):
+    '''
+    Formats ``values`` as a line in ``COPY`` text format, escaping what
+    needs it and writing ``None`` as ``NULL``.
+    '''
+    return '\t'.join(['\\N' if value is None else
+                      str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                                .replace('\n', '\\n').replace('\r', '\\r')
+                      for value in values]) + '\n'
+
+
+def copy_from_iterator(session, table_name, columns, lines):
+    '''
+    Loads an iterator of tab-delimited text lines into an existing table,
+    using a single ``COPY`` in the session's transaction.
+
+    :param session: A SQL Alchemy session
+    :param table_name: Output table name
+    :param columns: Iterable of column names, in the order of the fields.
+    :param lines: An iterable of lines in ``COPY`` text format.
+    '''
+    with session.connection().connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY {table} ({cols}) FROM stdin'.format(
+                cols=', '.join(columns),
+                table=table_name),
+            IteratorStream(lines))
+
+
+class CopyProgress(object):
+    '''
+    Thread-safe tally of the rows and bytes read by concurrent ``COPY``
+    statements, logged at most every ``interval`` seconds.
+    '''
+    def __init__(self, table_name, interval=10, clock=time.time):
+        self.table_name = table_name
+        self.interval = interval
+        self.rows = 0
+        self.bytes = 0
+        self.files = 0
+        self._clock = clock
+        self._start = self._last_log = clock()
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, nrows):
+        with self._lock:
+            self.bytes += nbytes
+            self.rows += nrows
+            now = self._clock()
+            if now - self._last_log >= self.interval:
+                self._last_log = now
+                self.log()
+
+    def file_done(self, rows, counted_rows):
+        '''
+        Replaces the estimated row count of a finished file with the count
+        reported by ``COPY``.
+        '''
+        with self._lock:
+            self.files += 1
+            self.rows += rows - counted_rows
+
+    def log(self):
+        elapsed = max(self._clock() - self._start, 1e-6)
+        LOGGER.info('%s: %s rows, %.1f MB from %s files in %.1fs (%.0f rows/s, %.2f MB/s)',
+                    self.table_name, self.rows, self.bytes / 1e6, self.files, elapsed,
+                    self.rows / elapsed, self.bytes / 1e6 / elapsed)
+
+
+class CountingStream(io.RawIOBase):
+    '''
+    Binary stream that reports what is read through it to a
+    :class:`CopyProgress`, counting lines as an estimate of the rows.
+    '''
+    def __init__(self, stream, progress):
+        self._stream = stream
+        self._progress = progress
+        self.lines = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self._stream.read(len(buf))
+        size = len(data)
+        buf[:size] = data
+        lines = data.count(b'\n')
+        self.lines += lines
+        self._progress.add(size, lines)
+        return size
+
+
+def copy_files(engine, table_name, sources, options='', workers=4):
+    '''
+    Loads several files into an existing table with ``COPY ... FROM STDIN``,
+    up to ``workers`` at the same time over the pooled connections of
+    ``engine``.  Each file is loaded in its own transaction.
+
+    If a file fails the files not started yet are skipped, and the error is
+    raised once the ones already running are done, after logging which file
+    it was.
+
+    :param engine: A SQL Alchemy engine
+    :param table_name: Output table name
+    :param sources: Iterable of ``(name, open_stream)``, where
+                    ``open_stream`` is a function returning a context manager
+                    for a binary stream with the contents of the file.
+    :param options: Options of the ``COPY`` statement.
+    :param workers: Number of files loaded at the same time.
+    :returns: The :class:`CopyProgress` with the totals.
+    '''
+    progress = CopyProgress(table_name)
+    statement = 'COPY {table} FROM STDIN {options}'.format(table=table_name, options=options)
+
+    def load(name, open_stream):
+        conn = engine.raw_connection()
+        try:
+            with open_stream() as stream, conn.cursor() as cursor:
+                counting = CountingStream(stream, progress)
+                cursor.copy_expert(statement, counting)
+                rows = cursor.rowcount if cursor.rowcount >= 0 else counting.lines
+            conn.commit()
+            progress.file_done(rows, counting.lines)
+        except Exception:
+            conn.rollback()
+            LOGGER.error('Failed to load %s into %s', name, table_name)
+            raise
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load, name, open_stream) for name, open_stream in sources]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    progress.log()
+    return progress
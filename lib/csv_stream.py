@@ -1,32 +1,67 @@
 import io
 import csv
+from itertools import islice
+from multiprocessing import Pool
 
+from lib.copy import IteratorStream
 
-class CSVNormalizerStream(io.IOBase):
+
+def _blocks(rows, size):
+    while True:
+        block = list(islice(rows, size))
+        if not block:
+            return
+        yield block
+
+
+def _normalize_block(func, rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerows([func(row) for row in rows])
+    return out.getvalue()
+
+
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+
+def _normalize_block_in_worker(rows):
+    return _normalize_block(_worker_func, rows)
+
+
+class CSVNormalizerStream(IteratorStream):
     '''
     Filter for applying a function to each line of a CSV file, compatible with iostreams
+
+    Rows are read and written back as CSV in blocks, so the output is quoted
+    as needed and can be handed to ``copy_expert`` without copying it around.
     '''
-    def __init__(self, infile, func):
+    def __init__(self, infile, func, processes=None, block_size=1000, encoding='utf-8'):
         '''
         :param infile: A stream that reads a CSV file. e.g: a file
         :param func: A function to apply to each CSV row. It takes an array of fields and returns an array of fields.
+        :param processes: Optional.  If set, ``func`` is applied in a pool of
+                          that many processes, so it must be picklable (e.g.
+                          a module-level function, not a lambda).  The order
+                          of the rows is kept.
+        :param block_size: Number of rows normalized at a time.
+        :param encoding: Encoding of the output.
         '''
-        self._csvreader = csv.reader(infile)
-        self._buffer = ''
-        self._func = func
-
-    def read(self, nbytes):
-        try:
-            while len(self._buffer) < nbytes:
-                self.getline()
-            out, self._buffer = self._buffer[:nbytes], self._buffer[nbytes:]
-            return out
-        except StopIteration:
-            out = self._buffer
-            self._buffer = ''
-            return out
-
-    def getline(self):
-        line = next(self._csvreader)
-        clean_line = self._func(line)
-        self._buffer += (','.join(clean_line) + ' \n')
+        self._pool = None
+        blocks = _blocks(csv.reader(infile), block_size)
+        if processes:
+            self._pool = Pool(processes, initializer=_init_worker, initargs=(func, ))
+            normalized = self._pool.imap(_normalize_block_in_worker, blocks)
+        else:
+            normalized = (_normalize_block(func, rows) for rows in blocks)
+        super(CSVNormalizerStream, self).__init__(normalized, encoding=encoding)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        super(CSVNormalizerStream, self).close()
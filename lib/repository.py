@@ -0,0 +1,218 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import http.client
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class ContentStore(object):
+    '''
+    Content-addressed store of downloaded files.
+
+    Every file is kept once under ``{root}/.store/blobs``, named after its
+    MD5, and the paths it is requested at are hardlinks to that blob, so the
+    same file downloaded for several resources or versions takes space once.
+
+    Downloads are hashed while they are written, and go through a partial
+    file named after the URL, which is resumed with an HTTP ``Range`` request
+    if a previous attempt was interrupted.  Partial files are only resumed
+    when the server gives a validator (a strong ``ETag`` or ``Last-Modified``)
+    that has not changed since they were started, and it is sent as
+    ``If-Range`` so a file replaced in between is downloaded again.  Files of at least
+    ``parallel_min_size`` bytes from servers accepting ranges are fetched in
+    ``parts`` concurrent ranges.
+
+    :param root: Directory of the repository.
+    :param chunk_size: Size of the reads and writes, in bytes.
+    :param parts: Number of concurrent ranges for large files.
+    :param parallel_min_size: Size from which files are fetched in ranges.
+    :param urlopen: Function opening a :class:`urllib.request.Request`.
+    '''
+
+    def __init__(self, root, chunk_size=1024 * 1024, parts=4,
+                 parallel_min_size=64 * 1024 * 1024, urlopen=urllib.request.urlopen):
+        self.root = os.path.join(root, '.store')
+        self.chunk_size = chunk_size
+        self.parts = parts
+        self.parallel_min_size = parallel_min_size
+        self._urlopen = urlopen
+
+    def fetch(self, url, path):
+        '''
+        Downloads ``url`` into the store and links it at ``path``.  Returns
+        the MD5 of the file.
+        '''
+        partial = self._partial_path(url)
+        size, accepts_ranges, validator = self._probe(url)
+        self._check_partial(partial, size, validator)
+        if self.parts > 1 and accepts_ranges and size and size >= self.parallel_min_size:
+            LOGGER.info('Downloading %s (%s bytes) in %s parts', url, size, self.parts)
+            digest = self._download_parts(url, partial, size, validator)
+        else:
+            LOGGER.info('Downloading %s', url)
+            digest = self._download(url, partial, hashed=True, validator=validator)
+        self._store(partial, digest, path)
+        os.remove(self._meta_path(partial))
+        return digest
+
+    def add(self, path):
+        '''
+        Moves the file at ``path`` into the store, leaving a link to it in its
+        place.  Returns the MD5 of the file.
+        '''
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+        self._store(path, digest, path)
+        return digest
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def _partial_path(self, url):
+        return os.path.join(self.root, 'partial', hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _meta_path(self, partial):
+        return partial + '.meta'
+
+    def _probe(self, url):
+        '''
+        Returns the size of ``url``, whether its server accepts ranges and the
+        validator to resume it with, ``(None, False, None)`` if they cannot be
+        known.
+        '''
+        try:
+            with self._urlopen(urllib.request.Request(url, method='HEAD')) as resp:
+                length = resp.headers.get('Content-Length')
+                etag = resp.headers.get('ETag')
+                # Weak ETags cannot be used in If-Range
+                validator = etag if etag and not etag.startswith('W/') else resp.headers.get('Last-Modified')
+                return (int(length) if length else None,
+                        resp.headers.get('Accept-Ranges', '').lower() == 'bytes',
+                        validator)
+        except (OSError, http.client.HTTPException, ValueError):
+            return None, False, None
+
+    def _check_partial(self, partial, size, validator):
+        '''
+        Removes what a previous attempt left of ``partial`` unless it was
+        downloaded with the same ``size`` and ``validator``, and records them
+        for the next attempt.
+        '''
+        meta_path = self._meta_path(partial)
+        current = {'size': size, 'validator': validator}
+        try:
+            with open(meta_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = None
+        if validator is None or previous != current:
+            for path in [partial] + glob.glob(glob.escape(partial) + '.*'):
+                if os.path.exists(path):
+                    LOGGER.info('Discarding the partial download %s', path)
+                    os.remove(path)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(meta_path, 'w') as f:
+            json.dump(current, f)
+
+    def _download(self, url, partial, first=0, last=None, hashed=False, validator=None):
+        '''
+        Downloads the bytes ``first`` to ``last`` (to the end if ``None``) of
+        ``url`` into ``partial``, resuming from what it already holds if the
+        file still matches ``validator``.  Returns the MD5 of ``partial`` if
+        ``hashed``.
+        '''
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        expected = None if last is None else last - first + 1
+        done = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if expected is not None and done > expected:
+            done = 0
+
+        md5 = hashlib.md5()
+        if done and hashed:
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    md5.update(chunk)
+        if expected is not None and done == expected:
+            return md5.hexdigest() if hashed else None
+
+        headers = {}
+        if done or first or last is not None:
+            headers['Range'] = 'bytes={}-{}'.format(first + done, '' if last is None else last)
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            resp = self._urlopen(urllib.request.Request(url, headers=headers))
+        except urllib.error.HTTPError as err:
+            # A previous attempt got the whole file but did not store it
+            if err.code == 416 and done and last is None:
+                return md5.hexdigest() if hashed else None
+            raise
+
+        with resp:
+            if headers and resp.getcode() != 206:
+                if first or last is not None:
+                    raise IOError('{} ignored the range {}'.format(url, headers['Range']))
+                # The whole file is coming again
+                LOGGER.info('Cannot resume %s, downloading it from the start', url)
+                done = 0
+                md5 = hashlib.md5()
+            elif done:
+                LOGGER.info('Resuming %s from byte %s', url, first + done)
+            with open(partial, 'ab' if done else 'wb') as f:
+                for chunk in iter(lambda: resp.read(self.chunk_size), b''):
+                    f.write(chunk)
+                    if hashed:
+                        md5.update(chunk)
+        return md5.hexdigest() if hashed else None
+
+    def _download_parts(self, url, partial, size, validator=None):
+        '''
+        Downloads ``url`` into ``partial`` as ``parts`` concurrent ranges,
+        hashing them as they are joined.  Returns the MD5 of the file.
+        '''
+        step = -(-size // self.parts)
+        bounds = [(first, min(first + step, size) - 1) for first in range(0, size, step)]
+        part_paths = ['{}.{}'.format(partial, num) for num in range(len(bounds))]
+        with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            list(executor.map(lambda args: self._download(url, *args, validator=validator),
+                              [(part_path, first, last)
+                               for part_path, (first, last) in zip(part_paths, bounds)]))
+
+        md5 = hashlib.md5()
+        with open(partial, 'wb') as out:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                        out.write(chunk)
+                        md5.update(chunk)
+        for part_path in part_paths:
+            os.remove(part_path)
+        return md5.hexdigest()
+
+    def _store(self, src, digest, path):
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            LOGGER.info('%s is already stored as %s', path, blob)
+            os.remove(src)
+        else:
+            os.rename(src, blob)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(blob, path)
+        except OSError:
+            shutil.copyfile(blob, path)
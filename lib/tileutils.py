@@ -17,3 +17,92 @@ def tile2bounds(z, x, y):
     lon1, lat1 = tile2lnglat(z, x+1, y-1)
 
     return [lon0, lat0, lon1, lat1]
+
+
+def _first_true(lower, upper, predicate):
+    '''
+    Binary search for the smallest integer in ``[lower, upper]`` for which a
+    monotone (False...True) ``predicate`` holds. Returns ``upper + 1`` if it
+    never holds.
+    '''
+    while lower <= upper:
+        middle = (lower + upper) // 2
+        if predicate(middle):
+            upper = middle - 1
+        else:
+            lower = middle + 1
+    return lower
+
+
+def bbox2tile_ranges(z, bbox):
+    '''
+    Returns the ``(xmin, xmax, ymin, ymax)`` tile index ranges (inclusive)
+    of the tiles at zoom ``z`` whose :func:`tile2bounds` intersect ``bbox``
+    as per :func:`lib.geo.bboxes_intersect`, or ``None`` if there are none.
+
+    ``bbox`` is a dict with ``xmin``, ``ymin``, ``xmax`` and ``ymax`` keys.
+    Only O(log 2^z) bounds are computed, instead of one per tile.
+    '''
+    last = 1 << z
+
+    # Tile bounds are [west, south, east, north]; x grows eastwards and y
+    # grows southwards, so every side is monotone along its axis
+    def column_bounds(x):
+        return tile2bounds(z, x, 0)
+
+    def row_bounds(y):
+        return tile2bounds(z, 0, y)
+
+    xmin = _first_true(0, last, lambda x: column_bounds(x)[2] >= bbox['xmin'])
+    xmax = _first_true(0, last, lambda x: column_bounds(x)[0] > bbox['xmax']) - 1
+    ymin = _first_true(0, last, lambda y: row_bounds(y)[1] <= bbox['ymax'])
+    ymax = _first_true(0, last, lambda y: row_bounds(y)[3] < bbox['ymin']) - 1
+
+    if xmin > xmax or ymin > ymax:
+        return None
+    return xmin, xmax, ymin, ymax
+
+
+def _merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _column_spans(z, bboxes):
+    '''
+    Splits the union of the tile ranges of ``bboxes`` into runs of columns
+    ``(xstart, xend, y_intervals)`` covered by the same, merged, y intervals.
+    '''
+    ranges = set([r for r in [bbox2tile_ranges(z, bbox) for bbox in bboxes] if r is not None])
+    breaks = sorted(set([r[0] for r in ranges] + [r[1] + 1 for r in ranges]))
+    for xstart, xnext in zip(breaks, breaks[1:]):
+        y_intervals = _merge_intervals([(r[2], r[3]) for r in ranges
+                                        if r[0] <= xstart and r[1] >= xnext - 1])
+        if y_intervals:
+            yield xstart, xnext - 1, y_intervals
+
+
+def tiles_in_bboxes(z, bboxes):
+    '''
+    Lazily yields every ``[x, y, z]`` tile intersecting any of ``bboxes``,
+    once, ordered by x and then by y.
+    '''
+    for xstart, xend, y_intervals in _column_spans(z, bboxes):
+        for x in range(xstart, xend + 1):
+            for ystart, yend in y_intervals:
+                for y in range(ystart, yend + 1):
+                    yield [x, y, z]
+
+
+def count_tiles_in_bboxes(z, bboxes):
+    '''
+    Number of tiles :func:`tiles_in_bboxes` would yield, without
+    enumerating them.
+    '''
+    return sum([(xend - xstart + 1) * sum([yend - ystart + 1 for ystart, yend in y_intervals])
+                for xstart, xend, y_intervals in _column_spans(z, bboxes)])
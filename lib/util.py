@@ -1,4 +1,6 @@
+import codecs
 import hashlib
+import struct
 
 
 # https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
@@ -8,3 +10,24 @@ def digest_file(file):
         for chunk in iter(lambda: f.read(4096), b''):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+def dbf_is_utf8(file):
+    '''
+    Whether the records of a DBF file (e.g. the attributes of a shapefile)
+    are valid UTF-8.  The file is streamed, it is not loaded in memory.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(file, "rb") as f:
+        header = f.read(32)
+        if len(header) < 32:
+            return True
+        # Bytes 8-9 hold the length of the header, records start after it
+        f.seek(struct.unpack('<H', header[8:10])[0])
+        try:
+            for chunk in iter(lambda: f.read(65536), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
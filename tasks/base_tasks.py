@@ -1,3 +1,4 @@
+import io
 import os
 import re
 import json
@@ -10,32 +11,45 @@ import zipfile
 import gzip
 import csv
 import uuid
+import shutil
 
 import urllib.request
 from urllib.parse import quote_plus
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date
+from functools import partial
 
 from luigi import (Task, Parameter, LocalTarget, BoolParameter, IntParameter,
                    ListParameter, DateParameter, WrapperTask, Event)
 from luigi.contrib.s3 import S3Target
 
+from sqlalchemy import create_engine
 from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 
-from lib.util import digest_file
+from lib.copy import copy_files
+from lib.repository import ContentStore
+from lib.util import dbf_is_utf8
 from lib.logger import get_logger
 
 from tasks.meta import (OBSColumn, OBSTable, metadata, current_session,
-                        session_commit, session_rollback, GEOM_REF)
-from tasks.targets import (ColumnTarget, TagTarget, CartoDBTarget, PostgresTarget, TableTarget, RepoTarget)
+                        session_commit, session_rollback, completeness_cache, GEOM_REF)
+from tasks.targets import (ColumnTarget, TagTarget, CartoDBTarget, PostgresTarget, TableTarget, RepoTarget,
+                           update_or_create_columns, prefetch_existence)
 from tasks.util import (classpath, query_cartodb, sql_to_cartodb_table, underscore_slugify, shell,
                         create_temp_schema, unqualified_task_id, generate_tile_summary, uncompress_file,
-                        copyfile)
+                        copyfile, open_stream, TILE_SUMMARY_WORKERS)
 from tasks.simplification import SIMPLIFIED_SUFFIX
 from tasks.simplify import Simplify
 
 LOGGER = get_logger(__name__)
 
+# Bytes held in memory at a time while decompressing
+UNCOMPRESS_BUFFER_SIZE = 1024 * 1024
+
 
 class ColumnsTask(Task):
     '''
@@ -75,8 +89,7 @@ class ColumnsTask(Task):
         session_commit(self)
 
     def run(self):
-        for _, coltarget in self.output().items():
-            coltarget.update_or_create()
+        update_or_create_columns(list(self.output().values()))
 
     def version(self):
         '''
@@ -158,17 +171,10 @@ class ColumnsTask(Task):
         if deps and not all([d.complete() for d in deps]):
             return False
         else:
-            # bulk check that all columns exist at proper version
-            cnt = current_session().execute(
-                '''
-                SELECT COUNT(*)
-                FROM observatory.obs_column
-                WHERE id IN ('{ids}') AND version = '{version}'
-                '''.format(
-                    ids="', '".join(list(self.colids.values())),
-                    version=self.version()
-                )).fetchone()[0]
-            return cnt == len(list(self.colids.values()))
+            # check that all columns exist at proper version
+            version = float(self.version())
+            return all([completeness_cache.column_version(colid) == version
+                        for colid in self.colids.values()])
 
     def tags(self, input_, col_key, col):
         '''
@@ -415,8 +421,14 @@ class RepoFileUncompressTask(Task):
     {output}.  Subclasses only need to define the following methods:
     :meth:`~.tasks.RepoFileUncompressTask.uncompress`
     :meth:`~.tasks.RepoFileUncompressTask.get_url`
+
+    Subclasses whose dependents read the archive directly, e.g. with
+    :func:`~.util.open_stream`, can set ``extract`` to ``False`` to only copy
+    it to ``{output}.{compressed_extension}``.
     '''
 
+    extract = True
+
     def version(self):
         return 1
 
@@ -438,7 +450,8 @@ class RepoFileUncompressTask(Task):
         os.makedirs(self.output().path)
         try:
             self.copy_from_repo()
-            self.uncompress()
+            if self.extract:
+                self.uncompress()
         except:
             os.rmdir(self.output().path)
             raise
@@ -478,12 +491,12 @@ class RepoFileGUnzipTask(RepoFileUncompressTask):
     file_extension = Parameter(default='csv')
 
     def uncompress(self):
-        gunzip = gzip.GzipFile('{output}.{extension}'.format(output=self.output().path,
-                                                             extension=self.compressed_extension),
-                               'rb')
-        with open(os.path.join(self.output().path, '{filename}.{extension}'.format(
-                filename=self.task_id, extension=self.file_extension)), 'wb') as outfile:
-            outfile.write(gunzip.read())
+        with gzip.open('{output}.{extension}'.format(output=self.output().path,
+                                                     extension=self.compressed_extension),
+                       'rb') as gunzip, \
+                open(os.path.join(self.output().path, '{filename}.{extension}'.format(
+                    filename=self.task_id, extension=self.file_extension)), 'wb') as outfile:
+            shutil.copyfileobj(gunzip, outfile, UNCOMPRESS_BUFFER_SIZE)
 
 
 class TempTableTask(Task):
@@ -525,6 +538,30 @@ class TempTableTask(Task):
         return PostgresTarget(classpath(self), unqualified_task_id(self.task_id))
 
 
+def prefetch_completeness(tasks):
+    '''
+    Resolves in bulk the Postgres targets checked by the ``complete()`` of
+    the :class:`TableTask` and :class:`TempTableTask` in ``tasks``, see
+    :func:`~.targets.prefetch_existence`.
+    '''
+    targets = []
+    for task in tasks:
+        if isinstance(task, TableTask):
+            targets.append(task._complete_target())
+        elif isinstance(task, TempTableTask):
+            targets.append(task.output())
+    prefetch_existence(targets)
+
+
+@Task.event_handler(Event.START)
+@Task.event_handler(Event.SUCCESS)
+def invalidate_completeness_cache(task):
+    '''
+    Whatever a task does while it runs can change what is complete.
+    '''
+    completeness_cache.invalidate()
+
+
 @TempTableTask.event_handler(Event.START)
 def clear_temp_table(task):
     create_temp_schema(task)
@@ -585,9 +622,18 @@ class GeoFile2TempTableTask(TempTableTask):
     '''
     A task that loads :meth:`~.tasks.GeoFile2TempTableTask.input_files()`
     into a temporary Postgres table. That method must be overriden.
+
+    Up to ``workers`` files are imported at the same time with ``ogr2ogr``,
+    each into its own staging table, which are then merged into the output.
+
+    :param encoding: Encoding used for the attributes of the files that are
+                     not valid UTF-8.  Defaults to ``latin1``.
+    :param workers: Number of files imported at the same time.  Defaults to
+                    ``4``.
     '''
 
     encoding = Parameter(default='latin1', significant=False)
+    workers = IntParameter(default=4, significant=False)
     other_options = ''
 
     def input_files(self):
@@ -598,36 +644,102 @@ class GeoFile2TempTableTask(TempTableTask):
         '''
         raise NotImplementedError("Must specify `input_files` method")
 
+    def detect_encoding(self, geofile):
+        '''
+        Returns the encoding to read ``geofile`` with: UTF-8, unless it is a
+        shapefile whose DBF is not valid UTF-8, then
+        :attr:`~.GeoFile2TempTableTask.encoding`.
+        '''
+        root, ext = os.path.splitext(geofile)
+        if ext.lower() == '.shp':
+            for dbf in (root + '.dbf', root + '.DBF'):
+                if os.path.exists(dbf):
+                    return 'utf-8' if dbf_is_utf8(dbf) else self.encoding
+        return 'utf-8'
+
     def run(self):
         if isinstance(self.input_files(), str):
             files = [self.input_files()]
         else:
-            files = self.input_files()
+            files = list(self.input_files())
         schema = self.output().schema
         tablename = self.output().tablename
+        # The first file is imported straight into the output, the rest into
+        # staging tables named after it
+        tablenames = [tablename] + ['{table}_part{num}'.format(table=tablename[:50], num=num)
+                                    for num in range(1, len(files))]
+        session = current_session()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(partial(self.import_file, schema), files, tablenames))
+            self.merge_tables(schema, tablename, tablenames[1:])
+        except:
+            session.rollback()
+            for table in tablenames:
+                session.execute('DROP TABLE IF EXISTS "{schema}".{table}'.format(
+                    schema=schema, table=table))
+            session.commit()
+            raise
+        for table in tablenames[1:]:
+            session.execute('DROP TABLE "{schema}".{table}'.format(schema=schema, table=table))
+
+    def import_file(self, schema, geofile, tablename):
+        '''
+        Imports ``geofile`` into a new ``"schema".tablename`` with ``ogr2ogr``.
+        '''
+        encoding = self.detect_encoding(geofile)
         operation = '-overwrite -lco OVERWRITE=yes -lco SCHEMA={schema} -lco PRECISION=no'.format(
             schema=schema)
-        for geofile in files:
-            # First we  try to import using utf8 as encoding if not able we
-            # fallback to the encoding passed as parameter
-            cmd = self.build_ogr_command(encoding='utf-8',
+        LOGGER.info('Importing %s (%s) into "%s".%s', geofile, encoding, schema, tablename)
+        output = shell(self.build_ogr_command(encoding=encoding,
+                                              schema=schema,
+                                              tablename=tablename,
+                                              input=geofile,
+                                              operation=operation,
+                                              other_options=self.other_options))
+        # Only shapefiles are checked beforehand
+        if encoding != self.encoding and self.utf8_error(output):
+            shell(self.build_ogr_command(encoding=self.encoding,
                                          schema=schema,
                                          tablename=tablename,
                                          input=geofile,
                                          operation=operation,
-                                         other_options=self.other_options)
-            output = shell(cmd)
-            if self.utf8_error(output):
-                cmd = self.build_ogr_command(encoding=self.encoding,
-                                             schema=schema,
-                                             tablename=tablename,
-                                             input=geofile,
-                                             operation=operation,
-                                             other_options=self.other_options)
-                shell(cmd)
-            # We don't add lco (layer creation options) because in the append mode
-            # are ignored
-            operation = '-append '.format(schema=schema)
+                                         other_options=self.other_options))
+
+    def merge_tables(self, schema, tablename, parts):
+        '''
+        Appends the rows of the ``parts`` tables to ``tablename`` with a single
+        ``INSERT ... SELECT``, in order.  Columns are matched by name and cast
+        to the type they have in ``tablename``; ``ogc_fid`` is assigned anew.
+        '''
+        if not parts:
+            return
+        session = current_session()
+        columns = [(name, coltype) for name, coltype in self._table_columns(session, schema, tablename)
+                   if name != 'ogc_fid']
+        selects = []
+        for part in parts:
+            part_columns = set([name for name, _ in self._table_columns(session, schema, part)])
+            selects.append('(SELECT {exprs} FROM "{schema}".{part}{order})'.format(
+                exprs=', '.join(['CAST("{name}" AS {type})'.format(name=name, type=coltype)
+                                 if name in part_columns else 'CAST(NULL AS {type})'.format(type=coltype)
+                                 for name, coltype in columns]),
+                schema=schema,
+                part=part,
+                order=' ORDER BY ogc_fid' if 'ogc_fid' in part_columns else ''))
+        session.execute('INSERT INTO "{schema}".{table} ({cols}) {selects}'.format(
+            schema=schema,
+            table=tablename,
+            cols=', '.join(['"{}"'.format(name) for name, _ in columns]),
+            selects=' UNION ALL '.join(selects)))
+
+    def _table_columns(self, session, schema, tablename):
+        return session.execute(
+            'SELECT attname, format_type(atttypid, atttypmod) '
+            'FROM pg_attribute '
+            'WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped '
+            'ORDER BY attnum',
+            {'table': '"{schema}".{table}'.format(schema=schema, table=tablename)}).fetchall()
 
     def utf8_error(self, cmd_output):
         regex = re.compile('invalid byte sequence for encoding \"UTF8\"', re.IGNORECASE)
@@ -647,6 +759,22 @@ class GeoFile2TempTableTask(TempTableTask):
                                                  other_options=args['other_options'])
 
 
+@contextmanager
+def _shell_stream(cmd):
+    '''
+    Runs ``cmd`` in a shell, yielding its stdout as a binary stream.  Raises
+    :class:`subprocess.CalledProcessError` if the command fails.
+    '''
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
 class CSV2TempTableTask(TempTableTask):
     '''
     A task that loads :meth:`~.tasks.CSV2TempTableTask.input_csv` into a
@@ -654,7 +782,7 @@ class CSV2TempTableTask(TempTableTask):
 
     Optionally, :meth:`~tasks.CSV2TempTableTask.coldef` can be overriden.
 
-    Under the hood, uses postgres's ``COPY``.
+    Under the hood, uses postgres's ``COPY``, see :func:`lib.copy.copy_files`.
 
     :param delimiter: Delimiter separating fields in the CSV.  Defaults to
                       ``,``.  Must be one character.
@@ -662,11 +790,14 @@ class CSV2TempTableTask(TempTableTask):
                        Defaults to ``True``.
     :param force: Boolean as to whether the task should be run even if the
                   temporary output already exists.
+    :param copy_workers: Number of CSVs loaded at the same time, each over
+                         its own connection.  Defaults to ``4``.
     '''
 
     delimiter = Parameter(default=',', significant=False)
     has_header = BoolParameter(default=True, significant=False)
     encoding = Parameter(default='utf8', significant=False)
+    copy_workers = IntParameter(default=4, significant=False)
 
     def input_csv(self):
         '''
@@ -694,13 +825,28 @@ class CSV2TempTableTask(TempTableTask):
             raise NotImplementedError("Cannot automatically determine colnames "
                                       "if several input CSVs.")
 
-        with open('{csv}'.format(csv=csvfile), 'r', encoding=self.encoding) as f:
+        with io.TextIOWrapper(open_stream(csvfile), encoding=self.encoding) as f:
             header_row = next(csv.reader(f, delimiter=self.delimiter))
         return [(h, 'Text') for h in header_row]
 
     def read_method(self, fname):
+        '''
+        Override with a shell command writing the contents of ``fname`` to
+        stdout to preprocess the CSVs, e.g. to decompress them.  By default
+        the files are read directly.
+        '''
         return 'cat "{input}"'.format(input=fname)
 
+    def open_csv(self, fname):
+        '''
+        Returns a context manager for a binary stream with the contents of
+        ``fname``, as output by :meth:`read_method` if it is overriden.
+        Compressed files are read with :func:`~.util.open_stream`.
+        '''
+        if type(self).read_method is CSV2TempTableTask.read_method:
+            return open_stream(fname)
+        return _shell_stream(self.read_method(fname))
+
     def run(self):
         if isinstance(self.input_csv(), str):
             csvs = [self.input_csv()]
@@ -713,19 +859,16 @@ class CSV2TempTableTask(TempTableTask):
             coldef=', '.join(['"{}" {}'.format(c[0], c[1]) for c in self.coldef()])
         ))
         session.commit()
-        options = ['''
-           DELIMITER '"'{delimiter}'"' ENCODING '"'{encoding}'"'
-        '''.format(delimiter=self.delimiter,
-                   encoding=self.encoding)]
+        options = ["DELIMITER '{delimiter}' ENCODING '{encoding}'".format(
+            delimiter=self.delimiter.replace("'", "''"),
+            encoding=self.encoding)]
         if self.has_header:
             options.append('CSV HEADER')
         try:
-            for csvfile in csvs:
-                shell(r'''{read_method} | psql -c '\copy {table} FROM STDIN {options}' '''.format(
-                    read_method=self.read_method(csvfile),
-                    table=self.output().table,
-                    options=' '.join(options)
-                ))
+            copy_files(session.get_bind(), self.output().table,
+                       [(csvfile, partial(self.open_csv, csvfile)) for csvfile in csvs],
+                       options=' '.join(options), workers=self.copy_workers)
+            self._recode(session)
             self.after_copy()
         except:
             session.rollback()
@@ -734,6 +877,41 @@ class CSV2TempTableTask(TempTableTask):
             session.commit()
             raise
 
+    def recode(self):
+        '''
+        Override to replace values of some columns once they are loaded.
+        Expected is a dict of column names to dicts of the values to replace
+        to their replacements, e.g. ``{'X10': {'1': 'Hispanic and Young'}}``.
+        Values are compared as text, and values not in a mapping are kept.
+        '''
+        return {}
+
+    def _recode(self, session):
+        '''
+        Applies :meth:`recode` with a single ``UPDATE``, so each row is
+        rewritten at most once whatever the number of columns and values.
+        '''
+        params = {}
+        sets, conditions = [], []
+        for colnum, (column, mapping) in enumerate(self.recode().items()):
+            if not mapping:
+                continue
+            whens, olds = [], []
+            for valnum, (old, new) in enumerate(mapping.items()):
+                old_param, new_param = 'old_{}_{}'.format(colnum, valnum), 'new_{}_{}'.format(colnum, valnum)
+                params[old_param], params[new_param] = str(old), new
+                whens.append('WHEN :{} THEN :{}'.format(old_param, new_param))
+                olds.append(':{}'.format(old_param))
+            sets.append('"{column}" = CASE "{column}" {whens} ELSE "{column}" END'.format(
+                column=column, whens=' '.join(whens)))
+            conditions.append('"{column}" IN ({olds})'.format(column=column, olds=', '.join(olds)))
+        if not sets:
+            return
+        session.execute('UPDATE {output} SET {sets} WHERE {conditions}'.format(
+            output=self.output().table,
+            sets=', '.join(sets),
+            conditions=' OR '.join(conditions)), params)
+
     def after_copy(self):
         pass
 
@@ -1121,13 +1299,16 @@ class TableTask(Task):
                          self._columns, self)
         return tt
 
-    def complete(self):
+    def _complete_target(self):
         return TableTarget(self.schema(),
                            self.name(),
                            OBSTable(description=self.description(),
                                     version=self.version(),
                                     table_timespan=self.table_timespan()),
-                           [], self).exists()
+                           [], self)
+
+    def complete(self):
+        return self._complete_target().exists()
 
 
 class RenameTables(Task):
@@ -1432,6 +1613,9 @@ class GenerateRasterTiles(Task):
     column_id = Parameter()
 
     force = BoolParameter(default=False, significant=False)
+    # The table is committed by then, so its summary can be computed in
+    # parallel connections
+    workers = IntParameter(default=TILE_SUMMARY_WORKERS, significant=False)
 
     def run(self):
         self._ran = True
@@ -1453,7 +1637,7 @@ class GenerateRasterTiles(Task):
             LOGGER.info('table_id: %s, column_id: %s, tablename: %s, colname: %s',
                         self.table_id, self.column_id, tablename, colname)
             generate_tile_summary(session, self.table_id, self.column_id,
-                                  'observatory.' + tablename, colname)
+                                  'observatory.' + tablename, colname, workers=self.workers)
             session.commit()
         except:
             session.rollback()
@@ -1511,6 +1695,11 @@ class MetaWrapper(WrapperTask):
             assert isinstance(t, TableTask)
             yield t
 
+    def complete(self):
+        tables = list(self.requires())
+        prefetch_completeness(tables)
+        return all([t.complete() for t in tables])
+
 
 class RunWrapper(WrapperTask):
     '''
@@ -1678,15 +1867,22 @@ class RepoFile(Task):
 
     def run(self):
         self.output().makedirs()
-        self._retrieve_remote_file()
-        digest = digest_file(self.output().path)
+        digest = self._retrieve_remote_file()
         self._to_db(self.resource_id, self.version, digest, self.url, self.output().path)
 
     def _retrieve_remote_file(self):
+        '''
+        Downloads the file into the content store of the repository, see
+        :class:`lib.repository.ContentStore`, and returns its checksum.
+        '''
+        store = ContentStore(self._repo_dir)
+        if self.downloader is base_downloader:
+            return store.fetch(self.url, self.output().path)
         LOGGER.info('Downloading remote file')
         if os.path.isfile(self.output().path):
             os.remove(self.output().path)
         self.downloader(self.url, self.output().path)
+        return store.add(self.output().path)
 
     def _to_db(self, resource_id, version, checksum, url, path):
         LOGGER.info('Storing entry in repository')
@@ -1763,14 +1959,31 @@ class InterpolationTask(BaseInterpolationTask):
     This task interpolates the data for one geography level from the data/geometries from
     another geography level by computing the intersections and area relations between the
     geometries.
+
+    With more than one ``workers``, the target geometries are split in
+    spatially close chunks, all the geometries of a target geoid in the same
+    one, that are interpolated by concurrent connections against the source
+    geometries cut with ``ST_Subdivide``, which gives the same results up to
+    rounding.  Those connections only see committed data.
+
+    :param workers: Number of chunks interpolated at the same time.
+                    Defaults to ``1``, which runs a single statement.
     '''
 
+    workers = IntParameter(default=1, significant=False)
+
+    CHUNKS_PER_WORKER = 4
+    SUBDIVIDE_MAX_VERTICES = 256
+
     def populate(self):
         input_ = self.input()
         interpolation_params = self.get_interpolation_parameters()
 
         colnames = [x for x in list(self.columns().keys()) if x.lower() != interpolation_params['target_geom_geoid']]
 
+        if self.workers > 1:
+            return self._populate_partitioned(colnames, interpolation_params)
+
         stmt = '''
                 INSERT INTO {output} ({target_data_geoid}, {out_colnames})
                 SELECT {target_geom_geoid}, {sum_colnames}
@@ -1812,6 +2025,115 @@ class InterpolationTask(BaseInterpolationTask):
 
         current_session().execute(stmt)
 
+    def _populate_partitioned(self, colnames, interpolation_params):
+        input_ = self.input()
+        engine = create_engine(current_session().get_bind().url, poolclass=NullPool)
+        chunks = self.workers * self.CHUNKS_PER_WORKER
+        params = dict(
+            interpolation_params,
+            chunks_table='{}_chunks'.format(self.output().table),
+            pieces_table='{}_pieces'.format(self.output().table),
+            result_table='{}_result'.format(self.output().table),
+            source_data_table=input_['source_data'].table,
+            source_geom_table=input_['source_geom'].table,
+            target_geom_table=input_['target_geom'].table,
+        )
+
+        # Staging tables are committed, so the workers can read them
+        session = Session(bind=engine)
+        try:
+            self._drop_staging_tables(session, params)
+            session.execute('''
+                CREATE UNLOGGED TABLE {chunks_table} AS
+                SELECT row_number() OVER () target_id, target_geom_table.{target_geom_geoid} geoid,
+                       target_geom_table.{target_geom_geomfield} geom, geoids.chunk
+                  FROM {target_geom_table} target_geom_table
+                  JOIN (SELECT geoid, ntile({chunks}) OVER (ORDER BY geohash) chunk
+                          FROM (SELECT {target_geom_geoid} geoid,
+                                       MIN(CASE WHEN NOT ST_IsEmpty({target_geom_geomfield})
+                                                THEN ST_GeoHash(ST_Centroid(ST_Envelope({target_geom_geomfield})), 10)
+                                           END) geohash
+                                  FROM {target_geom_table}
+                                 GROUP BY {target_geom_geoid}) targets
+                       ) geoids ON geoids.geoid = target_geom_table.{target_geom_geoid};
+                CREATE INDEX ON {chunks_table} (chunk);
+                CREATE UNLOGGED TABLE {pieces_table} AS
+                SELECT source_id, geoid, source_area, ST_Subdivide(geom, {max_vertices}) piece
+                  FROM (SELECT row_number() OVER () source_id, {source_geom_geoid} geoid,
+                               ST_Area({source_geom_geomfield}) source_area, {source_geom_geomfield} geom
+                          FROM {source_geom_table}) source_geom_table;
+                CREATE INDEX ON {pieces_table} USING GIST (piece);
+                ANALYZE {chunks_table};
+                ANALYZE {pieces_table};
+                CREATE UNLOGGED TABLE {result_table} AS {chunk_query} WITH NO DATA;
+                '''.format(chunks=chunks, max_vertices=self.SUBDIVIDE_MAX_VERTICES,
+                           chunk_query=self._chunk_query(colnames, params, 0), **params))
+            session.commit()
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(partial(self._interpolate_chunk, engine, colnames, params),
+                                  range(1, chunks + 1)))
+        except:
+            session.rollback()
+            self._drop_staging_tables(session, params)
+            session.commit()
+            raise
+        finally:
+            session.close()
+
+        current_session().execute('''
+            INSERT INTO {output} ({target_data_geoid}, {out_colnames})
+            SELECT * FROM {result_table};
+            DROP TABLE {chunks_table};
+            DROP TABLE {pieces_table};
+            DROP TABLE {result_table};
+            '''.format(output=self.output().table, out_colnames=', '.join(colnames), **params))
+
+    def _interpolate_chunk(self, engine, colnames, params, chunk):
+        session = Session(bind=engine)
+        try:
+            session.execute('INSERT INTO {result_table} {chunk_query}'.format(
+                chunk_query=self._chunk_query(colnames, params, chunk), **params))
+            session.commit()
+        finally:
+            session.close()
+
+    def _chunk_query(self, colnames, params, chunk):
+        '''
+        Interpolation of the targets in ``chunk``.  The area of the
+        intersection of each source and target geometry is added up from the
+        pieces of the source, giving the same area ratio as the single
+        statement.
+        '''
+        return '''
+            SELECT pairs.target_geoid, {sum_colnames}
+              FROM (
+                SELECT chunks.geoid target_geoid, pieces.source_id, pieces.geoid,
+                       SUM(CASE WHEN ST_Within(pieces.piece, chunks.geom)
+                                     THEN ST_Area(pieces.piece)
+                                ELSE ST_Area(ST_Intersection(pieces.piece, chunks.geom))
+                           END) / Nullif(MAX(pieces.source_area), 0) area_ratio
+                  FROM {chunks_table} chunks,
+                       {pieces_table} pieces
+                 WHERE chunks.chunk = {chunk}
+                   AND ST_Intersects(pieces.piece, chunks.geom)
+                 GROUP BY chunks.target_id, chunks.geoid, pieces.source_id, pieces.geoid
+                ) pairs, {source_data_table} source_data_table
+             WHERE source_data_table.{source_data_geoid} = pairs.geoid
+             GROUP BY pairs.target_geoid
+            '''.format(
+                chunk=int(chunk),
+                sum_colnames=', '.join(['round(sum(source_data_table.{x} / Nullif(area_ratio, 0))) {x}'.format(x=x)
+                                        for x in colnames]),
+                **params)
+
+    def _drop_staging_tables(self, session, params):
+        session.execute('''
+            DROP TABLE IF EXISTS {chunks_table};
+            DROP TABLE IF EXISTS {pieces_table};
+            DROP TABLE IF EXISTS {result_table};
+            '''.format(**params))
+
 
 class CoupledInterpolationTask(BaseInterpolationTask):
     '''
@@ -16,6 +16,11 @@ from datetime import date
 
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 
 LOGGER = get_logger(__name__)
 
@@ -511,6 +516,7 @@ class OBSMeta(Task):
                     numer_t.timespan = leftjoined_denoms.denom_timespan
                     AND geomref_c.id = leftjoined_denoms.geomref_id
                 ))
+                {numer_filter}
             GROUP BY numer_c.id, denom_id, geom_c.id, numer_t.timespan;
       ''',
 
@@ -666,7 +672,7 @@ SELECT numer_id ,
          ARRAY_REMOVE(ARRAY_AGG(DISTINCT numer_timespan)::TEXT[], NULL) timespans,
          NULL::Geometry(Geometry, 4326) the_geom, -- ST_Union(DISTINCT ST_SetSRID(the_geom, 4326)) the_geom
          NULL::Integer numer_version
-FROM observatory.obs_meta_next
+FROM {obs_meta_next}
 GROUP BY numer_id;
         ''',
         ''' ALTER TABLE {obs_meta} ADD PRIMARY KEY (numer_id); ''',
@@ -680,14 +686,14 @@ numer_extra = obs_meta.numer_extra,
 numer_type = obs_meta.numer_type,
 numer_aggregate = obs_meta.numer_aggregate,
 numer_version = obs_meta.numer_version
-FROM observatory.obs_meta_next obs_meta
+FROM {obs_meta_next} obs_meta
 WHERE obs_meta.numer_id = {obs_meta}.numer_id;
         ''',
-        '''CREATE INDEX ON observatory.obs_meta_next (numer_id, geom_tid); ''',
+        '''CREATE INDEX ON {obs_meta_next} (numer_id, geom_tid); ''',
         '''
 WITH geom_tids AS (
   SELECT  ARRAY_AGG(distinct geom_tid) geom_tids, numer_id
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY numer_id
 ), unique_geom_ids AS (
   SELECT ARRAY_AGG(distinct numer_id) numer_ids, geom_tids
@@ -705,7 +711,7 @@ WHERE {obs_meta}.numer_id = ANY(union_geoms.numer_ids);
         '''
         ],
         'denom': ['''
-CREATE UNIQUE INDEX ON observatory.obs_meta_next (denom_id, numer_id, geom_id, numer_timespan, denom_timespan);
+CREATE UNIQUE INDEX ON {obs_meta_next} (denom_id, numer_id, geom_id, numer_timespan, denom_timespan);
         ''',
         '''
 CREATE TABLE {obs_meta} AS
@@ -723,7 +729,7 @@ SELECT denom_id::TEXT,
          ARRAY_REMOVE(ARRAY_AGG(DISTINCT denom_timespan)::TEXT[], NULL) timespans,
          NULL::Geometry(Geometry, 4326) the_geom, -- ST_Union(DISTINCT ST_SetSRID(the_geom, 4326)) the_geom
          NULL::Integer denom_version
-FROM observatory.obs_meta_next
+FROM {obs_meta_next}
 WHERE denom_id IS NOT NULL
 GROUP BY denom_id;
         ''',
@@ -741,14 +747,14 @@ denom_extra = obs_meta.denom_extra,
 denom_type = obs_meta.denom_type,
 denom_aggregate = obs_meta.denom_aggregate,
 denom_version = obs_meta.denom_version
-FROM observatory.obs_meta_next obs_meta
+FROM {obs_meta_next} obs_meta
 WHERE obs_meta.denom_id = {obs_meta}.denom_id;
         ''',
-        '''CREATE INDEX ON observatory.obs_meta_next (denom_id, geom_tid); ''',
+        '''CREATE INDEX ON {obs_meta_next} (denom_id, geom_tid); ''',
         '''
 WITH geom_tids AS (
   SELECT  ARRAY_AGG(geom_tid) geom_tids, numer_id
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY numer_id
 ) , unique_geom_ids AS (
   SELECT ARRAY_AGG(numer_id) numer_ids, geom_tids
@@ -766,7 +772,7 @@ WHERE {obs_meta}.denom_id = ANY(union_geoms.numer_ids);
         '''
         ],
         'geom': [
-        ''' CREATE UNIQUE INDEX ON observatory.obs_meta_next
+        ''' CREATE UNIQUE INDEX ON {obs_meta_next}
         (geom_id, numer_id, numer_timespan, geom_timespan, denom_id);
         ''',
         '''
@@ -784,7 +790,7 @@ SELECT geom_id::TEXT,
          ARRAY_REMOVE(ARRAY_AGG(DISTINCT denom_id)::TEXT[], NULL) denoms,
          ARRAY_REMOVE(ARRAY_AGG(DISTINCT geom_timespan)::TEXT[], NULL) timespans,
          NULL::Integer geom_version
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY geom_id;
         ''',
         ''' ALTER TABLE {obs_meta} ADD PRIMARY KEY (geom_id); ''',
@@ -798,13 +804,13 @@ geom_extra = obs_meta.geom_extra,
 geom_type = obs_meta.geom_type,
 geom_aggregate = obs_meta.geom_aggregate,
 geom_version = obs_meta.geom_version
-FROM observatory.obs_meta_next obs_meta
+FROM {obs_meta_next} obs_meta
 WHERE obs_meta.geom_id = {obs_meta}.geom_id;
         ''',
         '''
 WITH geom_tids AS (
   SELECT  ARRAY_AGG(geom_tid) geom_tids, geom_id
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY geom_id
 ) , unique_geom_ids AS (
   SELECT ARRAY_AGG(geom_id) geom_ids, geom_tids
@@ -828,7 +834,7 @@ SELECT geom_id::TEXT,
        numer_id::TEXT,
        ARRAY_AGG(DISTINCT numer_timespan)::TEXT[] timespans,
        ARRAY_AGG(DISTINCT geom_timespan)::TEXT[] geom_timespans
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY geom_id, numer_id;
         ''',
         ''' ALTER TABLE {obs_meta} ADD PRIMARY KEY (geom_id, numer_id); ''',
@@ -850,7 +856,7 @@ SELECT numer_timespan::TEXT timespan_id,
        NULL::TEXT[] geoms,
        NULL::Geometry(Geometry, 4326) the_geom, -- ST_Union(DISTINCT ST_SetSRID(the_geom, 4326)) the_geom
        NULL::Integer timespan_version
-FROM observatory.obs_meta_next
+FROM {obs_meta_next}
 WHERE numer_timespan IS NOT NULL
 GROUP BY numer_timespan, numer_timespan_alias, numer_timespan_name,
          numer_timespan_description, numer_timespan_range, numer_timespan_weight;
@@ -877,7 +883,7 @@ SELECT denom_timespan::TEXT timespan_id,
        NULL::TEXT[] geoms,
        NULL::Geometry(Geometry, 4326) the_geom, -- ST_Union(DISTINCT ST_SetSRID(the_geom, 4326)) the_geom
        NULL::Integer timespan_version
-FROM observatory.obs_meta_next
+FROM {obs_meta_next}
 WHERE denom_timespan IS NOT NULL
 GROUP BY denom_timespan, denom_timespan_alias, denom_timespan_name,
          denom_timespan_description, denom_timespan_range, denom_timespan_weight
@@ -902,7 +908,7 @@ SELECT geom_timespan::TEXT timespan_id,
        NULL::TEXT[] geoms,
        NULL::Geometry(Geometry, 4326) the_geom, -- ST_Union(DISTINCT ST_SetSRID(the_geom, 4326)) the_geom
        NULL::Integer timespan_version
-FROM observatory.obs_meta_next
+FROM {obs_meta_next}
 WHERE geom_timespan IS NOT NULL
 GROUP BY geom_timespan, geom_timespan_alias, geom_timespan_name,
          geom_timespan_description, geom_timespan_range, geom_timespan_weight
@@ -911,31 +917,31 @@ ON CONFLICT (timespan_id) DO NOTHING;
         '''
 UPDATE {obs_meta} AS t SET numers =
 (SELECT ARRAY_REMOVE(ARRAY_AGG(DISTINCT numer_id)::TEXT[], NULL) numers
-FROM observatory.obs_meta_next as m
+FROM {obs_meta_next} as m
 WHERE m.numer_timespan = t.timespan_id);
         ''',
         '''
 UPDATE {obs_meta} AS t SET denoms =
 (SELECT ARRAY_REMOVE(ARRAY_AGG(DISTINCT denom_id)::TEXT[], NULL) denoms
-FROM observatory.obs_meta_next as m
+FROM {obs_meta_next} as m
 WHERE m.denom_timespan = t.timespan_id);
         ''',
         '''
 UPDATE {obs_meta} AS t SET geoms =
 (SELECT ARRAY_REMOVE(ARRAY_AGG(DISTINCT geom_id)::TEXT[], NULL) geoms
-FROM observatory.obs_meta_next as m
+FROM {obs_meta_next} as m
 WHERE m.geom_timespan = t.timespan_id);
         ''',
         '''
 UPDATE {obs_meta} SET
 timespan_tags = obs_meta.timespan_tags
-FROM observatory.obs_meta_next obs_meta
+FROM {obs_meta_next} obs_meta
 WHERE obs_meta.numer_timespan = {obs_meta}.timespan_id;
         ''',
         '''
 WITH geom_tids AS (
   SELECT  ARRAY_AGG(geom_tid) geom_tids, numer_timespan
-  FROM observatory.obs_meta_next
+  FROM {obs_meta_next}
   GROUP BY numer_timespan
 ) , unique_geom_ids AS (
   SELECT ARRAY_AGG(numer_timespan) numer_timespans, geom_tids
@@ -984,74 +990,279 @@ class DropRemoteOrphanTables(Task):
 
 
 class OBSMetaToLocal(OBSMeta):
+    '''
+    Builds the local ``obs_meta`` table and its dimension tables.
+
+    With ``incremental`` only the rows of the numerators affected by the
+    tags, columns and tables that changed since the last build (as reported
+    by :class:`UpdatedMetaTarget <tasks.meta.UpdatedMetaTarget>`) are
+    rebuilt, the rest are copied over.  It falls back to a full rebuild
+    when there is no previous build.
+    '''
 
     force = BoolParameter(default=True)
+    incremental = BoolParameter(default=True, significant=False)
+    dimension_workers = IntParameter(default=len(OBSMeta.DIMENSIONS), significant=False)
+
+    # Key columns of every dimension table, and the obs_meta columns they come from
+    DIMENSION_KEYS = {
+        'numer': (('numer_id', ), [('numer_id', )]),
+        # the denominator geometries are unioned by numer_id
+        'denom': (('denom_id', ), [('denom_id', ), ('numer_id', )]),
+        'geom': (('geom_id', ), [('geom_id', )]),
+        'geom_numer_timespan': (('geom_id', 'numer_id'), [('geom_id', 'numer_id')]),
+        'timespan': (('timespan_id', ), [('numer_timespan', ), ('denom_timespan', ), ('geom_timespan', )]),
+    }
+
+    AFFECTED_NUMERS = '''
+        DROP TABLE IF EXISTS observatory.obs_meta_next_affected;
+        CREATE TABLE observatory.obs_meta_next_affected AS
+        WITH changed_columns AS (
+            SELECT UNNEST(CAST(:column_ids AS TEXT[])) id
+            UNION
+            SELECT column_id FROM observatory.obs_column_tag
+            WHERE tag_id = ANY(CAST(:tag_ids AS TEXT[]))
+            UNION
+            SELECT column_id FROM observatory.obs_column_table
+            WHERE table_id = ANY(CAST(:table_ids AS TEXT[]))
+        )
+        -- numerators that changed
+        SELECT id numer_id FROM changed_columns
+        UNION
+        -- numerators whose denominator changed
+        SELECT c2c.source_id
+        FROM observatory.obs_column_to_column c2c, changed_columns
+        WHERE c2c.target_id = changed_columns.id
+          AND c2c.reltype IN ('denominator', 'universe')
+        UNION
+        -- numerators whose geometry changed
+        SELECT numer_ct.column_id
+        FROM observatory.obs_column_to_column c2c,
+             observatory.obs_column_table geomref_ct,
+             observatory.obs_column_table numer_ct,
+             changed_columns
+        WHERE c2c.target_id = changed_columns.id
+          AND c2c.reltype = 'geom_ref'
+          AND geomref_ct.column_id = c2c.source_id
+          AND numer_ct.table_id = geomref_ct.table_id
+        UNION
+        -- numerators of the current obs_meta rows that reference the changes
+        SELECT numer_id FROM observatory.obs_meta
+        WHERE numer_id IN (SELECT id FROM changed_columns)
+           OR denom_id IN (SELECT id FROM changed_columns)
+           OR geom_id IN (SELECT id FROM changed_columns)
+           OR numer_tid = ANY(CAST(:table_ids AS TEXT[]))
+           OR denom_tid = ANY(CAST(:table_ids AS TEXT[]))
+           OR geom_tid = ANY(CAST(:table_ids AS TEXT[]))
+           OR EXISTS (
+               SELECT 1 FROM JSONB_OBJECT_KEYS(COALESCE(numer_tags, '{}'::JSONB) ||
+                                               COALESCE(denom_tags, '{}'::JSONB) ||
+                                               COALESCE(geom_tags, '{}'::JSONB)) tag
+               WHERE SPLIT_PART(tag, '/', 2) = ANY(CAST(:tag_ids AS TEXT[])))
+    '''
 
     def requires(self):
         yield ConfirmTablesDescribedExist()
 
     def run(self):
         session = current_session()
+        incremental = self.incremental and self._find_affected_numers(session)
+        try:
+            self._build_obs_meta(session, incremental)
+
+            shell("psql -c 'VACUUM ANALYZE observatory.obs_meta_next'")
+
+            try:
+                self._build_dimensions(session, incremental)
+            except:
+                session.rollback()
+                session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next')
+                for dimension in self.DIMENSIONS:
+                    session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next_{dimension}'.format(
+                        dimension=dimension))
+                session.commit()
+                raise
+
+            # Swap every table in at once
+            try:
+                session.execute('DROP TABLE IF EXISTS observatory.obs_meta')
+                session.execute('ALTER TABLE observatory.obs_meta_next RENAME TO obs_meta')
+                for dimension, query in self.DIMENSIONS.items():
+                    session.execute('DROP TABLE IF EXISTS observatory.obs_meta_{dimension}'.format(
+                        dimension=dimension
+                    ))
+                    session.execute('''
+                        ALTER TABLE IF EXISTS observatory.obs_meta_next_{dimension}
+                        RENAME TO obs_meta_{dimension}'''.format(
+                            dimension=dimension
+                        ))
+                session.commit()
+            except:
+                session.rollback()
+                session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next')
+                session.commit()
+                raise
+        finally:
+            if incremental:
+                session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next_affected')
+                session.commit()
+
+    def _find_affected_numers(self, session):
+        '''
+        Stores in ``observatory.obs_meta_next_affected`` the ids of the
+        numerators whose ``obs_meta`` rows have to be rebuilt.  Returns
+        ``False`` when there is no previous build to update.
+        '''
+        for target in self.output()[:-1]:
+            if not target.exists():
+                LOGGER.info('%s does not exist, rebuilding obs_meta from scratch', target.table)
+                return False
+
+        before = time.time()
+        tag_ids, column_ids, table_ids = UpdatedMetaTarget().changes()
+        session.execute(self.AFFECTED_NUMERS, {
+            'tag_ids': sorted(tag_ids),
+            'column_ids': sorted(column_ids),
+            'table_ids': sorted(table_ids),
+        })
+        session.commit()
+        num_numers = session.execute(
+            'SELECT COUNT(*) FROM observatory.obs_meta_next_affected').fetchone()[0]
+        after = time.time()
+        LOGGER.info('%s tags, %s columns and %s tables changed, rebuilding %s numerators '
+                    '(time taken: %s)', len(tag_ids), len(column_ids), len(table_ids),
+                    num_numers, round(after - before, 2))
+        return True
+
+    def _build_obs_meta(self, session, incremental):
+        numer_filter = ''
+        if incremental:
+            numer_filter = 'AND numer_c.id IN (SELECT numer_id FROM observatory.obs_meta_next_affected)'
         try:
             session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next')
             session.execute(self.FIRST_AGGREGATE)
             for i, q in enumerate(self.QUERIES):
                 before = time.time()
-                query = q.format(obs_meta='observatory.obs_meta_next')
+                query = q.format(obs_meta='observatory.obs_meta_next', numer_filter=numer_filter)
                 session.execute(query)
                 after = time.time()
                 LOGGER.info('time taken for obs_meta:%s: %s', i, round(after - before, 2))
                 if i == 1:
                     session.commit()
-            session.commit()
-        except:
-            session.rollback()
-            raise
-
-        shell("psql -c 'VACUUM ANALYZE observatory.obs_meta_next'")
-
-        try:
-            for dimension, queries in self.DIMENSIONS.items():
+            if incremental:
                 before = time.time()
-                session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next_{dimension}'.format(
-                    dimension=dimension))
-                for i, q in enumerate(queries):
-                    before = time.time()
-                    query = q.format(obs_meta='observatory.obs_meta_next_{}'.format(dimension))
-                    session.execute(query)
-                    session.flush()
-                    after = time.time()
-                    LOGGER.info('time taken for %s:%s: %s', dimension, i, round(after - before, 2))
-                # geom_numer_timespan doesn't have geometries so no need to add geometry index for it
-                if dimension != 'geom_numer_timespan':
-                    session.execute('CREATE INDEX ON observatory.obs_meta_next_{dimension} USING gist '
-                                    '(the_geom)'.format(dimension=dimension))
+                session.execute('''
+                    INSERT INTO observatory.obs_meta_next
+                    SELECT * FROM observatory.obs_meta
+                    WHERE numer_id NOT IN (SELECT numer_id FROM observatory.obs_meta_next_affected)
+                ''')
                 after = time.time()
+                LOGGER.info('time taken for obs_meta:copy: %s', round(after - before, 2))
             session.commit()
         except:
             session.rollback()
-            session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next')
-            session.commit()
             raise
 
+    def _build_dimensions(self, session, incremental):
+        '''
+        Builds every dimension table, with its indexes, in a connection of
+        its own.  They only read ``obs_meta_next`` so they run at the same time.
+        '''
+        engine = create_engine(session.get_bind().url, poolclass=NullPool)
         try:
-            session.execute('DROP TABLE IF EXISTS observatory.obs_meta')
-            session.execute('ALTER TABLE observatory.obs_meta_next RENAME TO obs_meta')
-            for dimension, query in self.DIMENSIONS.items():
-                session.execute('DROP TABLE IF EXISTS observatory.obs_meta_{dimension}'.format(
-                    dimension=dimension
-                ))
-                session.execute('''
-                    ALTER TABLE IF EXISTS observatory.obs_meta_next_{dimension}
-                    RENAME TO obs_meta_{dimension}'''.format(
-                        dimension=dimension
-                    ))
+            with ThreadPoolExecutor(max_workers=self.dimension_workers) as executor:
+                futures = [executor.submit(self._build_dimension, engine, dimension, queries, incremental)
+                           for dimension, queries in self.DIMENSIONS.items()]
+                for future in futures:
+                    future.result()
+        finally:
+            engine.dispose()
+
+    def _build_dimension(self, engine, dimension, queries, incremental):
+        session = Session(bind=engine)
+        try:
+            before = time.time()
+            session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next_{dimension}'.format(
+                dimension=dimension))
+            if incremental:
+                self._update_dimension(session, dimension, queries)
+            else:
+                self._run_dimension_queries(session, dimension, queries,
+                                            'observatory.obs_meta_next_{}'.format(dimension),
+                                            'observatory.obs_meta_next')
+            # geom_numer_timespan doesn't have geometries so no need to add geometry index for it
+            if dimension != 'geom_numer_timespan':
+                session.execute('CREATE INDEX ON observatory.obs_meta_next_{dimension} USING gist '
+                                '(the_geom)'.format(dimension=dimension))
             session.commit()
+            after = time.time()
+            LOGGER.info('time taken for %s: %s', dimension, round(after - before, 2))
         except:
             session.rollback()
-            session.execute('DROP TABLE IF EXISTS observatory.obs_meta_next')
-            session.commit()
             raise
+        finally:
+            session.close()
+
+    def _run_dimension_queries(self, session, dimension, queries, obs_meta, obs_meta_next):
+        for i, q in enumerate(queries):
+            before = time.time()
+            query = q.format(obs_meta=obs_meta, obs_meta_next=obs_meta_next)
+            session.execute(query)
+            session.flush()
+            after = time.time()
+            LOGGER.info('time taken for %s:%s: %s', dimension, i, round(after - before, 2))
+
+    def _update_dimension(self, session, dimension, queries):
+        '''
+        Builds ``obs_meta_next_<dimension>`` from the current
+        ``obs_meta_<dimension>``, replacing the rows whose keys appear in the
+        ``obs_meta`` rows of the affected numerators, before or after the
+        rebuild.  Those rows are recomputed from every ``obs_meta_next`` row
+        that references their keys, unioned geometries included.
+        '''
+        table = 'observatory.obs_meta_next_{}'.format(dimension)
+        keys_table = '{}_keys'.format(table)
+        source_table = '{}_source'.format(table)
+        delta_table = '{}_delta'.format(table)
+        key_columns, source_columns = self.DIMENSION_KEYS[dimension]
+        key = '({})'.format(', '.join(key_columns))
+
+        affected_keys = []
+        for columns in source_columns:
+            for obs_meta in ('observatory.obs_meta', 'observatory.obs_meta_next'):
+                affected_keys.append('''
+                    SELECT {columns} FROM {obs_meta}
+                    WHERE numer_id IN (SELECT numer_id FROM observatory.obs_meta_next_affected)
+                      AND {not_null}'''.format(
+                          columns=', '.join(['{} {}'.format(c, k) for c, k in zip(columns, key_columns)]),
+                          obs_meta=obs_meta,
+                          not_null=' AND '.join(['{} IS NOT NULL'.format(c) for c in columns])))
+        source_filter = ' OR '.join(['({columns}) IN (SELECT {key} FROM {keys_table})'.format(
+            columns=', '.join(columns), key=', '.join(key_columns), keys_table=keys_table)
+            for columns in source_columns])
+
+        for t in (keys_table, source_table, delta_table):
+            session.execute('DROP TABLE IF EXISTS {}'.format(t))
+        session.execute('CREATE TABLE {keys_table} AS {keys}'.format(
+            keys_table=keys_table, keys=' UNION '.join(affected_keys)))
+        session.execute('''
+            CREATE TABLE {source_table} AS
+            SELECT * FROM observatory.obs_meta_next WHERE {source_filter}
+        '''.format(source_table=source_table, source_filter=source_filter))
+        self._run_dimension_queries(session, dimension, queries, delta_table, source_table)
+
+        session.execute('''
+            CREATE TABLE {table} AS
+            SELECT * FROM observatory.obs_meta_{dimension}
+            WHERE {key} NOT IN (SELECT {key_columns} FROM {keys_table});
+            INSERT INTO {table}
+            SELECT * FROM {delta_table}
+            WHERE {key} IN (SELECT {key_columns} FROM {keys_table});
+            ALTER TABLE {table} ADD PRIMARY KEY {key};
+        '''.format(table=table, dimension=dimension, key=key, key_columns=', '.join(key_columns),
+                   keys_table=keys_table, delta_table=delta_table))
+        for t in (keys_table, source_table, delta_table):
+            session.execute('DROP TABLE {}'.format(t))
 
     def output(self):
         tables = ['obs_meta', 'obs_meta_numer', 'obs_meta_denom',
@@ -3,7 +3,7 @@ from tasks.base_tasks import (ColumnsTask, TableTask, TagsTask, CSV2TempTableTas
 from tasks.eu.geo import NUTSColumns, NUTSGeometries
 from tasks.meta import OBSColumn, OBSTag, current_session, GEOM_REF
 from tasks.tags import SectionTags, SubsectionTags, UnitTags
-from tasks.util import underscore_slugify, classpath, shell, copyfile
+from tasks.util import underscore_slugify, classpath, shell, copyfile, grouper
 
 from luigi import IntParameter, Parameter, WrapperTask, Task, LocalTarget
 from collections import OrderedDict
@@ -458,6 +458,10 @@ class TableEU(TableTask):
     unit = Parameter()
     year = Parameter()
 
+    # Upper bound of output columns filled by each grouped pass over the temp
+    # table, keeps the statement well below Postgres' target list limit
+    PIVOT_COLUMNS_PER_PASS = 500
+
     def version(self):
         return 10
 
@@ -509,38 +513,76 @@ class TableEU(TableTask):
             output=self.output().table,
             level=self.nuts_level))
         session.flush()
-        column_targets = self._columns
-        for colname, coltarget in list(column_targets.items()):
-            if colname != 'nuts{}_id'.format(self.nuts_level):
-                col = coltarget.get(session)
-                extra = col.extra
-                multiple = ''
-                keys = list(extra.keys())
-                vals = [extra[k_] for k_ in keys]
-                # metabase unit does not correspond to headers due to lack of
-                # \time"
-                if unit:
-                    if 'unit' in keys:
-                        keys[keys.index('unit')] = unit
-                stmt = '''
-                    INSERT INTO {output} (nuts{level}_id, {colname})
-                    SELECT "{geo}",
-                      {multiply}NullIf(SPLIT_PART("{year}", ' ', 1), ':')::Numeric
-                    FROM {input}
-                    WHERE ("{input_dims}") = ('{output_dims}')
-                    ON CONFLICT (nuts{level}_id)
-                       DO UPDATE SET {colname} = EXCLUDED.{colname}'''.format(
-                           geo=geo,
-                           level=self.nuts_level,
-                           colname=colname,
-                           multiply=multiple,
-                           year=self.year,
-                           input_dims='", "'.join(keys),
-                           output_dims="', '".join(vals),
-                           output=self.output().table,
-                           input=input_['data'].table
-                       )
-                session.execute(stmt)
+
+        for keys, dimensions in self._dimension_columns(session, unit).items():
+            for batch in grouper(dimensions, self.PIVOT_COLUMNS_PER_PASS):
+                batch = [dim for dim in batch if dim is not None]
+                LOGGER.info('Pivoting %s columns from %s in one pass', len(batch), input_['data'].table)
+                session.execute(self._pivot_statement(geo, keys, batch))
+
+    def _dimension_columns(self, session, unit):
+        '''
+        Compile the dimension tuple stored in each column's ``extra`` into
+        the values that select it from the temp table.
+
+        Returns an :py:class:`~collections.OrderedDict` keyed by the tuple of
+        input dimension names, whose values are lists of
+        ``(colname, dimension_values)``.  Eurostat columns of a table usually
+        share the same dimensions, so this tends to be a single group.
+        '''
+        geoid = 'nuts{}_id'.format(self.nuts_level)
+        column_ids = [coltarget._id for colname, coltarget in self._columns.items() if colname != geoid]
+        extras = dict(session.query(OBSColumn.id, OBSColumn.extra).filter(OBSColumn.id.in_(column_ids)))
+
+        dimension_columns = OrderedDict()
+        for colname, coltarget in self._columns.items():
+            if colname == geoid:
+                continue
+            extra = extras[coltarget._id]
+            keys = list(extra.keys())
+            vals = [extra[k_] for k_ in keys]
+            # metabase unit does not correspond to headers due to lack of
+            # \time"
+            if unit:
+                if 'unit' in keys:
+                    keys[keys.index('unit')] = unit
+            dimension_columns.setdefault(tuple(keys), []).append((colname, vals))
+        return dimension_columns
+
+    def _pivot_statement(self, geo, keys, dimensions):
+        '''
+        Build a single grouped pass over the temp table that fills every column
+        in ``dimensions`` at once.
+        '''
+        value = "NullIf(SPLIT_PART(\"{year}\", ' ', 1), ':')::Numeric".format(year=self.year)
+        input_dims = '"{}"'.format('", "'.join(keys))
+
+        def output_dims(vals):
+            return "('{}')".format("', '".join([v.replace("'", "''") for v in vals]))
+
+        return '''
+            INSERT INTO {output} (nuts{level}_id, {colnames})
+            SELECT "{geo}", {aggregates}
+            FROM {input}
+            WHERE ({input_dims}) IN ({all_output_dims})
+            GROUP BY "{geo}"
+            ON CONFLICT (nuts{level}_id)
+               DO UPDATE SET {updates}'''.format(
+                   geo=geo,
+                   level=self.nuts_level,
+                   colnames=', '.join([colname for colname, _ in dimensions]),
+                   aggregates=', '.join(['MAX({value}) FILTER (WHERE ({input_dims}) = {output_dims}) {colname}'.format(
+                       value=value,
+                       input_dims=input_dims,
+                       output_dims=output_dims(vals),
+                       colname=colname) for colname, vals in dimensions]),
+                   input_dims=input_dims,
+                   all_output_dims=', '.join([output_dims(vals) for _, vals in dimensions]),
+                   updates=', '.join(['{colname} = EXCLUDED.{colname}'.format(colname=colname)
+                                      for colname, _ in dimensions]),
+                   output=self.output().table,
+                   input=self.input()['data'].table
+               )
 
 
 class AllEUTableYears(Task):
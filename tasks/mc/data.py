@@ -1,4 +1,3 @@
-import os
 import urllib.request
 import itertools
 from luigi import Parameter, WrapperTask
@@ -111,6 +110,9 @@ def geoname_format(country, name):
 class DownloadGUnzipMC(RepoFileGUnzipTask):
     country = Parameter()
 
+    # ImportMCData streams the CSV from the archive
+    extract = False
+
     URL = 'http://172.17.0.1:8000/mc/my_{country}mc_fake_data.csv.gz'
 
     def get_url(self):
@@ -120,8 +122,6 @@ class DownloadGUnzipMC(RepoFileGUnzipTask):
 class ImportMCData(CSV2TempTableTask):
     country = Parameter()
 
-    FILE_EXTENSION = 'csv'
-
     def requires(self):
         return DownloadGUnzipMC(country=self.country)
 
@@ -133,9 +133,8 @@ class ImportMCData(CSV2TempTableTask):
         return [(t[0].lower(), t[1]) for t in uppercased]
 
     def input_csv(self):
-        for file in os.listdir(self.input().path):
-            if file.endswith('.{}'.format(self.FILE_EXTENSION)):
-                return os.path.join(self.input().path, file)
+        return '{path}.{extension}'.format(path=self.input().path,
+                                           extension=DownloadGUnzipMC.compressed_extension)
 
 
 class MCDataBaseTable(TempTableTask):
@@ -309,6 +308,10 @@ class MCData(TempTableTask):
                            for x in itertools.product([x[1] for x in MEASUREMENT_COLUMNS],
                            CATEGORIES.keys())])
 
+        # The geographies of a country are loaded concurrently, and concurrent
+        # CREATE SCHEMA IF NOT EXISTS can still collide
+        session.execute('SELECT pg_advisory_xact_lock(hashtext(:schema))',
+                        {'schema': self.output().schema})
         query = '''
                 CREATE SCHEMA IF NOT EXISTS "{schema}"
                 '''.format(schema=self.output().schema)
@@ -330,13 +333,17 @@ class MCData(TempTableTask):
         session.execute(query)
         session.commit()
 
-    def _insert_tr(self, session):
-        LOGGER.info('Inserting "total retail" data into {}'.format(self.output().table))
+    def _insert_pivoted(self, session):
+        LOGGER.info('Inserting pivoted data into {}'.format(self.output().table))
 
-        output_fields = ','.join(['{}_tr'.format(geoname_format(self.country, x[1].lower()))
-                                  for x in MEASUREMENT_COLUMNS])
-        input_fields = ','.join(['mc.{field} as {field}_tr'.format(field=geoname_format(self.country, x[1].lower()))
-                                 for x in MEASUREMENT_COLUMNS])
+        pivoted = list(itertools.product([geoname_format(self.country, x[1].lower()) for x in MEASUREMENT_COLUMNS],
+                                         CATEGORIES.items()))
+        output_fields = ','.join(['{}_{}'.format(field, catid.lower()) for field, (catid, _) in pivoted])
+        # (region_id, month, category) is the primary key of the input, so
+        # every aggregate picks the single value of its category
+        input_fields = ','.join(["MAX(mc.{field}) FILTER (WHERE mc.category = '{category}')".format(
+                                     field=field, category=catname)
+                                 for field, (_, catname) in pivoted])
 
         query = '''
                 INSERT INTO "{output_schema}".{output_table} (
@@ -350,7 +357,8 @@ class MCData(TempTableTask):
                     {input_fields}
                     FROM
                         "{input_schema}".{input_table} mc
-                    WHERE mc.category = 'total retail';
+                    GROUP BY mc.{region_id}, mc.{month}
+                    HAVING bool_or(mc.category = '{total_retail}');
                 '''.format(
                         output_schema=self.output().schema,
                         output_table=self.output().tablename,
@@ -360,6 +368,7 @@ class MCData(TempTableTask):
                         input_fields=input_fields,
                         input_schema=self.input().schema,
                         input_table=self.input().tablename,
+                        total_retail=CATEGORIES['TR'],
                     )
         session.execute(query)
         session.commit()
@@ -379,43 +388,12 @@ class MCData(TempTableTask):
         session.execute(query)
         session.commit()
 
-    def _update_category(self, session, category):
-        LOGGER.info('Updating {} with "{}" category'.format(self.output().table, category[1]))
-
-        fields = ','.join(['{field}_{category} = cat.{field}'.format(
-                                field=geoname_format(self.country, x[1].lower()), category=category[0].lower())
-                           for x in MEASUREMENT_COLUMNS])
-
-        query = '''
-                UPDATE "{output_schema}".{output_table} as mcc SET
-                    {fields}
-                FROM
-                    "{input_schema}".{input_table} cat
-                WHERE mcc.{region_id} = cat.{region_id}
-                  AND mcc.{month} = cat.{month}
-                  AND cat.category = '{category}';
-                '''.format(
-                    output_schema=self.output().schema,
-                    output_table=self.output().tablename,
-                    region_id=REGION_ID_COLUMN[1],
-                    month=MONTH_COLUMN[1],
-                    input_schema=self.input().schema,
-                    input_table=self.input().tablename,
-                    fields=fields,
-                    category=category[1]
-                )
-        session.execute(query)
-        session.commit()
-
     def run(self):
         session = current_session()
         try:
             self._create_table(session)
-            self._insert_tr(session)  # Insert the 'total retail' data
+            self._insert_pivoted(session)
             self._create_constraints(session)
-            for catid, catname in CATEGORIES.items():  # Insert the rest of the categories
-                if catid != 'TR':
-                    self._update_category(session, (catid, catname))
         except Exception as e:
             LOGGER.error('Error creating/populating {table}: {error}'.format(
                 table=self.output().table,
@@ -435,7 +413,7 @@ class AllMCData(WrapperTask):
 
     def requires(self):
         for geography in [x.replace(' ', '_') for x in GEOGRAPHIES[self.country]]:
-            yield MCData(geography=geography)
+            yield MCData(country=self.country, geography=geography)
 
 
 class AllMCCountries(WrapperTask):
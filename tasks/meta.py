@@ -6,6 +6,7 @@ functions for persisting metadata about tables loaded via ETL
 
 import os
 import re
+import multiprocessing
 
 from luigi import Target
 
@@ -32,7 +33,7 @@ def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
 
 
 async def async_pool(user=None, password=None, host=None, port=None,
-                     db=None, max_connections=150, timeout=60):
+                     db=None, max_connections=150, timeout=60, init=None):
     user = user or os.environ.get('PGUSER', 'postgres')
     password = password or os.environ.get('PGPASSWORD', '')
     host = host or os.environ.get('PGHOST', 'localhost')
@@ -42,7 +43,8 @@ async def async_pool(user=None, password=None, host=None, port=None,
                                         database=db, host=host,
                                         port=port,
                                         command_timeout=timeout,
-                                        max_size=max_connections)
+                                        max_size=max_connections,
+                                        init=init)
     return db_pool
 
 
@@ -894,6 +896,11 @@ class OBSTimespan(UniqueMixin, Base):
     def unique_filter(cls, query, id):
         return query.filter(OBSTimespan.id == id)
 
+def _invalidate_after_write(conn, cursor, statement, parameters, context, executemany):
+    if not statement.lstrip().upper().startswith(('SELECT', 'SHOW')):
+        completeness_cache.invalidate()
+
+
 class CurrentSession(object):
 
     def __init__(self, async_conn=False):
@@ -904,6 +911,11 @@ class CurrentSession(object):
     def begin(self):
         if not self._session:
             self._session = sessionmaker(bind=get_engine())()
+            # Whatever the transaction changed may be visible now.  Flushes
+            # and raw SQL both go through the engine
+            event.listen(self._session.get_bind(), 'after_cursor_execute', _invalidate_after_write)
+            event.listen(self._session, 'after_commit', completeness_cache.invalidate)
+            event.listen(self._session, 'after_rollback', completeness_cache.invalidate)
         self._pid = os.getpid()
 
     def get(self):
@@ -954,6 +966,129 @@ class CurrentSession(object):
 _current_session = CurrentSession()
 
 
+class CompletenessCache(object):
+    '''
+    Snapshot of the metadata versions and of the relations in the database,
+    so the ``complete()`` checks luigi repeats while it builds the task graph
+    are answered from memory.
+
+    Each kind of data is loaded with a single query the first time it is
+    needed.  The snapshot is dropped when the current session writes anything,
+    so reads inside a transaction see its own changes, when it commits or
+    rolls back, and when a task starts or succeeds.
+
+    Dropping the snapshot in any process drops it in every process forked
+    from the one that imported this module, through a shared generation
+    counter.  With several luigi workers, tasks run in forked processes, and
+    their commits have to reach the scheduling process, which checks the
+    completeness of the dependencies they yield and of the tasks it
+    reschedules.
+    '''
+
+    def __init__(self):
+        self._generation = multiprocessing.Value('L', 0)
+        self._seen = None
+        self._clear()
+
+    def _clear(self):
+        self._metadata = {}
+        self._relations = None
+        self._rows = {}
+
+    def invalidate(self, *args):
+        with self._generation.get_lock():
+            self._generation.value += 1
+        self._clear()
+
+    def _check_pid(self):
+        generation = (os.getpid(), self._generation.value)
+        if self._seen != generation:
+            self._clear()
+            self._seen = generation
+
+    def _load(self, model, *attrs):
+        self._check_pid()
+        if model not in self._metadata:
+            query = current_session().query(model.id, model.version, *attrs)
+            self._metadata[model] = dict([(row[0], (float(row[1] or 0.0), ) + tuple(row[2:]))
+                                          for row in query])
+        return self._metadata[model]
+
+    def column_version(self, column_id):
+        '''
+        Version of the :class:`OBSColumn`, ``None`` if it does not exist.
+        '''
+        column = self._load(OBSColumn).get(column_id)
+        return column[0] if column else None
+
+    def tag_version(self, tag_id):
+        '''
+        Version of the :class:`OBSTag`, ``None`` if it does not exist.
+        '''
+        tag = self._load(OBSTag).get(tag_id)
+        return tag[0] if tag else None
+
+    def table(self, table_id):
+        '''
+        ``(version, tablename)`` of the :class:`OBSTable`, ``None`` if it does
+        not exist.
+        '''
+        return self._load(OBSTable, OBSTable.tablename).get(table_id)
+
+    def relation_exists(self, schema, tablename):
+        '''
+        Whether there is a table or view named ``tablename`` in ``schema``
+        (case insensitive).
+        '''
+        self._check_pid()
+        if self._relations is None:
+            resp = current_session().execute('''
+                SELECT LOWER(n.nspname), LOWER(c.relname)
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.relkind IN ('r', 'v', 'm', 'f', 'p')''')
+            self._relations = set([tuple(row) for row in resp])
+        return (schema.lower(), tablename.lower()) in self._relations
+
+    def has_rows(self, schema, tablename, where='1 = 1'):
+        '''
+        Whether ``"schema".tablename`` has a row matching ``where``.
+        '''
+        self._check_pid()
+        key = (schema.lower(), tablename.lower(), where)
+        if key not in self._rows:
+            resp = current_session().execute(
+                'SELECT row_number() over () FROM "{schema}".{tablename} WHERE {where} LIMIT 1'.format(
+                    schema=schema, tablename=tablename, where=where))
+            self._rows[key] = resp.fetchone() is not None
+        return self._rows[key]
+
+    def prefetch_rows(self, keys, batch_size=500):
+        '''
+        Resolves :meth:`has_rows` for many ``(schema, tablename, where)`` at
+        once, probing every existing table in a single query per batch.
+        '''
+        self._check_pid()
+        pending = []
+        for schema, tablename, where in keys:
+            key = (schema.lower(), tablename.lower(), where)
+            if key in self._rows or key in pending:
+                continue
+            if not self.relation_exists(schema, tablename):
+                self._rows[key] = False
+                continue
+            pending.append(key)
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            resp = current_session().execute('SELECT {}'.format(', '.join([
+                'EXISTS (SELECT 1 FROM "{schema}".{tablename} WHERE {where})'.format(
+                    schema=schema, tablename=tablename, where=where)
+                for schema, tablename, where in batch])))
+            self._rows.update(zip(batch, resp.fetchone()))
+
+
+completeness_cache = CompletenessCache()
+
+
 def current_session():
     '''
     Returns the session relevant to the currently operating :class:`Task`, if
@@ -1026,12 +1161,15 @@ if not os.environ.get('READTHEDOCS') == 'True':
     Base.metadata.create_all()
 
 class UpdatedMetaTarget(Target):
-    def exists(self):
-        session = current_session()
+    '''
+    Exists when the local ``obs_meta`` tables are up to date with the
+    metadata: no tag, column or table has appeared, changed or disappeared
+    since they were built.
+    '''
 
-        # identify tags that have appeared, changed or disappeared
-        # version shifts won't crop up in and of themselves, but name changes will
-        changed_tags = '''
+    # identify tags that have appeared, changed or disappeared
+    # version shifts won't crop up in and of themselves, but name changes will
+    CHANGED_TAGS = '''
         with tags as (
             SELECT jsonb_each_text(numer_tags)
             FROM observatory.obs_meta_numer
@@ -1063,13 +1201,10 @@ class UpdatedMetaTarget(Target):
             meta.type = distinct_tags.type AND
             meta.name = distinct_tags.name
         WHERE meta.id IS NULL OR distinct_tags.id IS NULL
-        '''
-        resp = session.execute(changed_tags)
-        if resp.fetchone():
-            return False
+    '''
 
-        # identify columns that have appeared, changed, or disappeared
-        changed_columns = '''
+    # identify columns that have appeared, changed, or disappeared
+    CHANGED_COLUMNS = '''
         WITH columns AS (
             SELECT DISTINCT c.id, c.version
             FROM observatory.obs_column c
@@ -1091,13 +1226,10 @@ class UpdatedMetaTarget(Target):
         FROM columns FULL JOIN meta
         ON id = numer_id AND version = numer_version
         WHERE numer_id IS NULL OR id IS NULL;
-        '''
-        resp = session.execute(changed_columns)
-        if resp.fetchone():
-            return False
+    '''
 
-        # identify tables that have appeared, changed, or disappeared
-        changed_tables = '''
+    # identify tables that have appeared, changed, or disappeared
+    CHANGED_TABLES = '''
         with numer_tables as (
             select distinct tab.id, tab.version
             from observatory.obs_table tab,
@@ -1157,8 +1289,31 @@ class UpdatedMetaTarget(Target):
             id = geom_tid and version = geom_t_version
         where rank = 1 and (geom_tid is null or id is null)
         ;
-        '''
-        resp = session.execute(changed_tables)
-        if resp.fetchone():
-            return False
+    '''
+
+    def exists(self):
+        session = current_session()
+        for query in (self.CHANGED_TAGS, self.CHANGED_COLUMNS, self.CHANGED_TABLES):
+            resp = session.execute(query)
+            if resp.fetchone():
+                return False
         return True
+
+    def changes(self):
+        '''
+        Returns the ids of the tags, columns and tables that have appeared,
+        changed or disappeared, as a tuple of three sets.  Each changed row
+        carries the id in the metadata and in ``obs_meta``, either may be
+        ``None``.
+        '''
+        session = current_session()
+        tag_ids = set()
+        for row in session.execute(self.CHANGED_TAGS):
+            tag_ids.update([row[0], row[3]])
+        column_ids = set()
+        for row in session.execute(self.CHANGED_COLUMNS):
+            column_ids.update([row[0], row[2]])
+        table_ids = set()
+        for row in session.execute(self.CHANGED_TABLES):
+            table_ids.update([row[0], row[2]])
+        return tag_ids - {None}, column_ids - {None}, table_ids - {None}
@@ -1,13 +1,17 @@
 import os
 import requests
 
+from collections import OrderedDict
+
 from luigi import Target, LocalTarget
 from hashlib import sha1
 
 from tasks.util import (query_cartodb, underscore_slugify, OBSERVATORY_PREFIX, OBSERVATORY_SCHEMA)
 from tasks.meta import (OBSColumn, OBSTable, metadata, Geometry, Point,
-                        Linestring, OBSColumnTable, OBSTag, current_session)
-from sqlalchemy import Table, types, Column
+                        Linestring, OBSColumnTable, OBSTag, OBSColumnTag, OBSColumnToColumn,
+                        current_session, completeness_cache)
+from sqlalchemy import Table, types, Column, inspect
+from sqlalchemy.dialects.postgresql import insert
 
 
 class PostgresTarget(Target):
@@ -34,23 +38,17 @@ class PostgresTarget(Target):
     def schema(self):
         return self._schema
 
+    def _rows_key(self):
+        return (self._schema, self._tablename, self._where)
+
     def _existenceness(self):
         '''
         Returns 0 if the table does not exist, 1 if it exists but has no
         rows (is empty), and 2 if it exists and has one or more rows.
         '''
-        session = current_session()
-        resp = session.execute('SELECT COUNT(*) FROM information_schema.tables '
-                               "WHERE table_schema ILIKE '{schema}'  "
-                               "  AND table_name ILIKE '{tablename}' ".format(
-                                   schema=self._schema,
-                                   tablename=self._tablename))
-        if int(resp.fetchone()[0]) == 0:
+        if not completeness_cache.relation_exists(self._schema, self._tablename):
             return 0
-        resp = session.execute(
-            'SELECT row_number() over () FROM "{schema}".{tablename} WHERE {where} LIMIT 1'.format(
-                schema=self._schema, tablename=self._tablename, where=self._where))
-        if resp.fetchone() is None:
+        if not completeness_cache.has_rows(self._schema, self._tablename, self._where):
             return 1
         else:
             return 2
@@ -147,13 +145,9 @@ class ColumnTarget(Target):
         self._column = current_session().merge(self._column)
 
     def exists(self):
-        existing = self.get(current_session())
+        existing_version = completeness_cache.column_version(self._id)
+        existing = existing_version is not None
         new_version = float(self._column.version or 0.0)
-        if existing:
-            existing_version = float(existing.version or 0.0)
-            current_session().expunge(existing)
-        else:
-            existing_version = 0.0
         if existing and existing_version == new_version:
             return True
         elif existing and existing_version > new_version:
@@ -167,6 +161,103 @@ class ColumnTarget(Target):
         return False
 
 
+def prefetch_existence(targets):
+    '''
+    Resolves whether the :class:`PostgresTarget` and :class:`TableTarget` in
+    ``targets`` exist with one catalog query and one batch of row probes, so
+    that checking them afterwards does not hit the database.  Other targets
+    are ignored.
+    '''
+    keys = [target._rows_key() for target in targets
+            if isinstance(target, (PostgresTarget, TableTarget))]
+    completeness_cache.prefetch_rows([key for key in keys if key is not None])
+
+
+def targets_exist(targets):
+    '''
+    Returns ``[target.exists() for target in targets]``, resolving the
+    Postgres targets in bulk first with :func:`prefetch_existence`.
+    '''
+    targets = list(targets)
+    prefetch_existence(targets)
+    return [target.exists() for target in targets]
+
+
+def update_or_create_columns(coltargets, batch_size=1000):
+    '''
+    Same as calling :meth:`ColumnTarget.update_or_create` on every target,
+    but writes the columns, their tags and their targets with a few
+    multi-row ``INSERT ... ON CONFLICT`` instead of merging them one by one.
+
+    As with ``merge``, only the attributes set on each column overwrite the
+    stored ones, and the tag and target links of a column are replaced when
+    they have been set.
+    '''
+    session = current_session()
+    session.flush()
+
+    # The last definition of a column wins, as it would merging them in order
+    columns = list(OrderedDict([(ct._column.id, ct._column) for ct in coltargets]).values())
+    column_ids = [col.id for col in columns]
+
+    # Columns setting the same attributes share a statement
+    attributes = [c.key for c in OBSColumn.__table__.columns]
+    groups = {}
+    for col in columns:
+        loaded = inspect(col).dict
+        keys = tuple([key for key in attributes if key in loaded])
+        groups.setdefault(keys, []).append(dict([(key, loaded[key]) for key in keys]))
+    for keys, rows in groups.items():
+        for i in range(0, len(rows), batch_size):
+            stmt = insert(OBSColumn.__table__).values(rows[i:i + batch_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['id'],
+                set_=dict([(key, getattr(stmt.excluded, key)) for key in keys if key != 'id']))
+            session.execute(stmt)
+
+    tags, tagged, coltags = {}, [], []
+    related, col2cols = [], []
+    for col in columns:
+        loaded = inspect(col).dict
+        if 'column_column_tags' in loaded:
+            tagged.append(col.id)
+            for coltag in col.column_column_tags:
+                coltags.append({'column_id': col.id, 'tag_id': coltag.tag_id or coltag.tag.id})
+                # Tags that were not found in the database come with their definition
+                tag = inspect(coltag.tag).dict
+                if 'name' in tag and 'type' in tag:
+                    tags[tag['id']] = dict([(c.key, tag[c.key]) for c in OBSTag.__table__.columns
+                                            if c.key in tag])
+        if 'tgts' in loaded:
+            related.append(col.id)
+            for c2c in col.tgts.values():
+                col2cols.append({'source_id': col.id, 'target_id': c2c.target.id,
+                                 'reltype': c2c.reltype})
+
+    for tag in tags.values():
+        session.execute(insert(OBSTag.__table__).values(tag).on_conflict_do_nothing())
+    if tagged:
+        session.execute(OBSColumnTag.__table__.delete().where(
+            OBSColumnTag.__table__.c.column_id.in_(tagged)))
+    for i in range(0, len(coltags), batch_size):
+        session.execute(insert(OBSColumnTag.__table__).values(
+            coltags[i:i + batch_size]).on_conflict_do_nothing())
+    if related:
+        session.execute(OBSColumnToColumn.__table__.delete().where(
+            OBSColumnToColumn.__table__.c.source_id.in_(related)))
+    for i in range(0, len(col2cols), batch_size):
+        session.execute(insert(OBSColumnToColumn.__table__).values(
+            col2cols[i:i + batch_size]).on_conflict_do_nothing())
+
+    # Objects already in the session would not see the new rows otherwise
+    column_ids = set(column_ids)
+    for obj in list(session):
+        if isinstance(obj, OBSColumn) and obj.id in column_ids or \
+                isinstance(obj, OBSColumnTag) and obj.column_id in column_ids or \
+                isinstance(obj, OBSColumnToColumn) and obj.source_id in column_ids:
+            session.expire(obj)
+
+
 class TagTarget(Target):
     '''
     '''
@@ -188,14 +279,9 @@ class TagTarget(Target):
             self._tag = current_session().merge(self._tag)
 
     def exists(self):
-        session = current_session()
-        existing = self.get(session)
+        existing_version = completeness_cache.tag_version(self._id)
+        existing = existing_version is not None
         new_version = float(self._tag.version or 0.0)
-        if existing:
-            existing_version = float(existing.version or 0.0)
-            current_session().expunge(existing)
-        else:
-            existing_version = 0.0
         if existing and existing_version == new_version:
             return True
         elif existing and existing_version > new_version:
@@ -244,30 +330,16 @@ class TableTarget(Target):
         We always want to run this at least once, because we can always
         regenerate tabular data from scratch.
         '''
-        session = current_session()
-        existing = self.get(session)
+        existing = completeness_cache.table(self._id)
         new_version = float(self.obs_table.version or 0.0)
         if existing:
-            existing_version = float(existing.version or 0.0)
-            if existing in session:
-                session.expunge(existing)
+            existing_version, existing_tablename = existing
         else:
             existing_version = 0.0
         if existing and existing_version == new_version:
-            resp = session.execute(
-                'SELECT COUNT(*) FROM information_schema.tables '
-                "WHERE table_schema = '{schema}'  "
-                "  AND table_name = '{tablename}' ".format(
-                    schema='observatory',
-                    tablename=existing.tablename))
-            if int(resp.fetchone()[0]) == 0:
+            if not completeness_cache.relation_exists('observatory', existing_tablename):
                 return False
-            resp = session.execute(
-                'SELECT row_number() over () '
-                'FROM "{schema}".{tablename} LIMIT 1 '.format(
-                    schema='observatory',
-                    tablename=existing.tablename))
-            return resp.fetchone() is not None
+            return completeness_cache.has_rows('observatory', existing_tablename)
         elif existing and existing_version > new_version:
             raise Exception('Metadata version mismatch: cannot run task {task} '
                             '(id "{id}") '
@@ -278,6 +350,11 @@ class TableTarget(Target):
                                                db=existing_version))
         return False
 
+    def _rows_key(self):
+        existing = completeness_cache.table(self._id)
+        if existing and existing[0] == float(self.obs_table.version or 0.0):
+            return ('observatory', existing[1], '1 = 1')
+
     def get(self, session):
         '''
         Return a copy of the underlying OBSTable in the specified session.
@@ -1,21 +1,100 @@
 from tasks.us.census.tiger import ShorelineClip
 from tasks.targets import PostgresTarget
-from luigi import IntParameter, Parameter, WrapperTask, Task
+from luigi import IntParameter, FloatParameter, Parameter, WrapperTask, Task
 from tasks.meta import current_session, async_pool
 from lib.logger import get_logger
-from lib.tileutils import tile2bounds
-from lib.geo import bboxes_intersect
+from lib.tileutils import tile2bounds, tiles_in_bboxes, count_tiles_in_bboxes
+from lib.copy import copy_from_iterator
+from lib.concurrency import AdaptiveLimit
 import json
 import os
 import time
 import asyncio
 import concurrent.futures
 import backoff
-import csv
+from itertools import islice
 
 LOGGER = get_logger(__name__)
 
 
+async def register_geometry_codec(conn):
+    '''
+    Exchange PostGIS geometries as raw EWKB, so the records fetched for a tile
+    can be written back with binary ``COPY`` untouched.
+    '''
+    await conn.set_type_codec('geometry', schema='public',
+                              encoder=bytes, decoder=bytes, format='binary')
+
+
+class TileProgress(object):
+    '''
+    Ledger of the tiles already generated for a tiler table (shards have
+    their own table) and zoom level, so an interrupted run only generates the
+    missing tiles when restarted.
+
+    Tiles are recorded in the same transaction that copies their rows, so a
+    recorded tile always has its data stored.
+    '''
+    TABLE = 'tile_progress'
+
+    def __init__(self, schema, tablename, zoom_level):
+        self.schema = schema
+        self.tablename = tablename
+        self.zoom_level = zoom_level
+
+    @property
+    def table(self):
+        return '"{schema}".{table}'.format(schema=self.schema, table=self.TABLE)
+
+    def create(self, session):
+        session.execute('''CREATE TABLE IF NOT EXISTS {table}(
+                              table_name TEXT NOT NULL,
+                              z INTEGER NOT NULL,
+                              x INTEGER NOT NULL,
+                              y INTEGER NOT NULL,
+                              PRIMARY KEY (table_name, z, x, y)
+                           )'''.format(table=self.table))
+
+    def reset(self, session):
+        '''
+        Forget the tiles recorded for this table at every zoom level, for when
+        the table is (re)created and no longer holds them.
+        '''
+        session.execute("DELETE FROM {table} WHERE table_name = '{tablename}'".format(
+            table=self.table, tablename=self.tablename))
+
+    def count(self, session):
+        '''
+        Number of tiles recorded for this table and zoom level.
+        '''
+        resp = session.execute("SELECT to_regclass('{table}')".format(table=self.table))
+        if resp.fetchone()[0] is None:
+            return 0
+        return session.execute('''
+            SELECT COUNT(*) FROM {table}
+            WHERE table_name = '{tablename}' AND z = {zoom_level}
+            '''.format(table=self.table, tablename=self.tablename,
+                       zoom_level=self.zoom_level)).fetchone()[0]
+
+    async def pending(self, conn, tiles):
+        '''
+        The subset of ``tiles`` that has not been recorded yet.
+        '''
+        done = await conn.fetch('''
+            SELECT x, y FROM {table}
+            WHERE table_name = $1 AND z = $2
+              AND (x, y) IN (SELECT * FROM unnest($3::INTEGER[], $4::INTEGER[]))
+            '''.format(table=self.table), self.tablename, self.zoom_level,
+                       [tile[0] for tile in tiles], [tile[1] for tile in tiles])
+        done = set([(record['x'], record['y']) for record in done])
+        return [tile for tile in tiles if (tile[0], tile[1]) not in done]
+
+    async def record(self, conn, tiles):
+        await conn.copy_records_to_table(self.TABLE, schema_name=self.schema,
+                                         columns=['table_name', 'z', 'x', 'y'],
+                                         records=[(self.tablename, tile[2], tile[0], tile[1]) for tile in tiles])
+
+
 class TilesTempTable(Task):
     zoom_level = IntParameter()
     geography = Parameter()
@@ -34,53 +113,77 @@ class TilesTempTable(Task):
             self._store_tiles(session, tiles, config)
 
     def _calculate_tiles(self, config):
-        tiles = []
-        for x in range(0, (pow(2, self.zoom_level) + 1)):
-            for y in range(0, (pow(2, self.zoom_level) + 1)):
-                if self._tile_in_bboxes(self.zoom_level, x, y, config['bboxes']):
-                    tiles.append([x, y, self.zoom_level])
-        return tiles
-
-    def _tile_in_bboxes(self, zoom, x, y, bboxes):
-        rect1 = tile2bounds(zoom, x, y)
-        for bbox in bboxes:
-            rect2 = [bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax']]
-            if bboxes_intersect(rect1, rect2):
-                return True
-
-        return False
+        tile_start = time.time()
+        num_tiles = count_tiles_in_bboxes(self.zoom_level, config['bboxes'])
+        tile_end = time.time()
+        LOGGER.info("Tiles to be stored: {}. Enumerated in {} seconds".format(num_tiles, (tile_end - tile_start)))
+        return tiles_in_bboxes(self.zoom_level, config['bboxes'])
 
     def _store_tiles(self, session, tiles, config):
-        for tile in tiles:
-            bounds = 'SELECT cdb_observatory.OBS_GetTileBoundsx'
-            query = '''
-                    WITH data as (
-                        SELECT {x} x, {y} y, {z} z, cdb_observatory.OBS_GetTileBounds({z},{x},{y}) bounds
-                    )
-                    INSERT INTO \"{schema}\".\"{table}\" (x,y,z,bounds,envelope,ext)
-                    SELECT x, y, z, bounds bounds, ST_MakeEnvelope(bounds[1], bounds[2], bounds[3], bounds[4], 4326) envelope,
-                    ST_MakeBox2D(ST_Point(bounds[1], bounds[2]), ST_Point(bounds[3], bounds[4])) ext
-                    FROM data
-                    '''.format(schema=config['schema'], table=self._get_table_name(config),
-                               x=tile[0], y=tile[1], z=tile[2])
-            session.execute(query)
+        table = '"{schema}"."{table}"'.format(schema=config['schema'], table=self._get_table_name(config))
+        columns = ['x', 'y', 'z', 'bounds', 'envelope', 'ext']
+        copy_start = time.time()
+        already_stored = session.execute('SELECT EXISTS (SELECT 1 FROM {table})'.format(table=table)).fetchone()[0]
+        if already_stored:
+            # Only add the tiles missing from a previous run of this zoom level
+            staging = '"{table}_staging"'.format(table=self._get_table_name(config))
+            session.execute('CREATE TEMPORARY TABLE {staging} (LIKE {table}) ON COMMIT DROP'.format(
+                staging=staging, table=table))
+            copy_from_iterator(session, staging, columns, self._tile_rows(tiles))
+            resp = session.execute('''
+                INSERT INTO {table} ({columns})
+                SELECT {columns} FROM {staging} s
+                WHERE NOT EXISTS (SELECT 1 FROM {table} t
+                                  WHERE t.x = s.x AND t.y = s.y AND t.z = s.z)
+                '''.format(table=table, staging=staging, columns=', '.join(columns)))
+            LOGGER.info("Added {} missing tiles to {}".format(resp.rowcount, table))
+        else:
+            copy_from_iterator(session, table, columns, self._tile_rows(tiles))
+        self._create_primary_key(session, config)
         session.commit()
+        copy_end = time.time()
+        LOGGER.info("Copy tiles for table {} took {} seconds".format(table, copy_end - copy_start))
+
+    def _tile_rows(self, tiles):
+        '''
+        Tiles as lines in ``COPY`` text format, with the same bounds,
+        envelope and box as ``cdb_observatory.OBS_GetTileBounds``,
+        ``ST_MakeEnvelope`` and ``ST_MakeBox2D`` would yield.
+        '''
+        for x, y, z in tiles:
+            xmin, ymin, xmax, ymax = tile2bounds(z, x, y)
+            ring = '(({xmin} {ymin},{xmin} {ymax},{xmax} {ymax},{xmax} {ymin},{xmin} {ymin}))'.format(
+                xmin=repr(xmin), ymin=repr(ymin), xmax=repr(xmax), ymax=repr(ymax))
+            yield '{x}\t{y}\t{z}\t{{{bounds}}}\tSRID=4326;POLYGON{ring}\tPOLYGON{ring}\n'.format(
+                x=x, y=y, z=z, bounds=','.join([repr(b) for b in (xmin, ymin, xmax, ymax)]), ring=ring)
 
     def _create_table(self, session, config):
         session.execute('CREATE SCHEMA IF NOT EXISTS \"{}\"'.format(config['schema']))
+        # The primary key is created after loading the tiles
         sql_table = '''CREATE TABLE IF NOT EXISTS \"{schema}\".\"{table}\"(
                        x INTEGER NOT NULL,
                        y INTEGER NOT NULL,
                        z INTEGER NOT NULL,
                        bounds Numeric[],
                        envelope Geometry,
-                       ext Geometry,
-                       CONSTRAINT {table}_pk PRIMARY KEY (x,y,z)
+                       ext Geometry
                     )'''.format(schema=config['schema'],
                                 table=self._get_table_name(config))
         session.execute(sql_table)
         session.commit()
 
+    def _create_primary_key(self, session, config):
+        table = self._get_table_name(config)
+        resp = session.execute('''
+            SELECT 1 FROM pg_constraint
+            WHERE conname = '{table}_pk'
+              AND conrelid = '"{schema}"."{table}"'::regclass
+            '''.format(schema=config['schema'], table=table))
+        if resp.fetchone() is None:
+            session.execute('''ALTER TABLE \"{schema}\".\"{table}\"
+                               ADD CONSTRAINT {table}_pk PRIMARY KEY (x,y,z)'''.format(
+                                   schema=config['schema'], table=table))
+
     def output(self):
         targets = []
         for config in self.config_data:
@@ -101,6 +204,12 @@ class TilerXYZTableTask(Task):
 
     zoom_level = IntParameter()
     geography = Parameter()
+    copy_chunk_size = IntParameter(default=5000, significant=False)
+    queue_size = IntParameter(default=200, significant=False)
+    initial_concurrency = IntParameter(default=10, significant=False)
+    max_concurrency = IntParameter(default=150, significant=False)
+    max_backend_load = FloatParameter(default=0.9, significant=False)
+    monitor_interval = IntParameter(default=10, significant=False)
 
     def __init__(self, *args, **kwargs):
         super(TilerXYZTableTask, self).__init__(*args, **kwargs)
@@ -131,8 +240,7 @@ class TilerXYZTableTask(Task):
                     start_time = time.time()
                     LOGGER.info("Processing table {}".format(table_data['table']))
                     self._create_schema_and_table(table_data, config)
-                    self._generate_csv_tiles(self.zoom_level, table_data, config, table_bboxes)
-                    self._insert_tiles(table_data)
+                    self._generate_table_tiles(self.zoom_level, table_data, config, table_bboxes)
                     end_time = time.time()
                     LOGGER.info("Finished processing table {}. It took {} seconds".format(
                         table_data['table'],
@@ -169,7 +277,14 @@ class TilerXYZTableTask(Task):
                                 table_name=table_data['table'],
                                 cols=", ".join(cols_schema))
 
+        resp = session.execute("SELECT to_regclass('{table}')".format(table=self._get_table_name(table_data)))
+        table_exists = resp.fetchone()[0] is not None
         session.execute(sql_table)
+        progress = self._get_progress(table_data)
+        progress.create(session)
+        if not table_exists:
+            # The ledger outlives a dropped table, a new one starts from scratch
+            progress.reset(session)
         session.commit()
 
     def _get_config_data(self):
@@ -177,31 +292,22 @@ class TilerXYZTableTask(Task):
         with (open('{}/conf/{}'.format(dir_path, self.get_config_file()))) as f:
             return json.load(f)
 
-    def _tile_in_bboxes(self, zoom, x, y, bboxes):
-        rect1 = tile2bounds(zoom, x, y)
-        for bbox in bboxes:
-            rect2 = [bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax']]
-            if bboxes_intersect(rect1, rect2):
-                return True
-
-        return False
-
-    def _generate_csv_tiles(self, zoom, table_data, config, bboxes_config):
-        tiles = []
+    def _generate_table_tiles(self, zoom, table_data, config, bboxes_config):
         tile_start = time.time()
-        for x in range(0, (pow(2, zoom) + 1)):
-            for y in range(0, (pow(2, zoom) + 1)):
-                if self._tile_in_bboxes(zoom, x, y, bboxes_config):
-                    tiles.append([x, y, zoom])
+        num_tiles = count_tiles_in_bboxes(zoom, bboxes_config)
         tile_end = time.time()
 
-        LOGGER.info("Tiles to be processed: {}. Calculated in {} seconds".format(len(tiles), (tile_end - tile_start)))
+        LOGGER.info("Tiles to be processed: {}. Enumerated in {} seconds".format(num_tiles, (tile_end - tile_start)))
+        done_tiles = self._get_progress(table_data).count(current_session())
+        if done_tiles:
+            LOGGER.info("Resuming {}: {} of {} tiles already generated".format(table_data['table'],
+                                                                               done_tiles, num_tiles))
 
         sql_start = time.time()
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            exceptions = loop.run_until_complete(self._generate_tiles(tiles, config, table_data))
+            exceptions = loop.run_until_complete(self._generate_tiles(zoom, bboxes_config, config, table_data))
             exceptions =  [e for e in exceptions if e is not None]
 
             if exceptions:
@@ -213,43 +319,106 @@ class TilerXYZTableTask(Task):
         LOGGER.info("Generated tiles it took {} seconds".format(sql_end - sql_start))
 
     def batch(self, iterable, n=1):
-        iterable_lenght = len(iterable)
-        for ndx in range(0, iterable_lenght, n):
-            yield iterable[ndx:min(ndx + n, iterable_lenght)]
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, n))
+            if not chunk:
+                return
+            yield chunk
 
     @backoff.on_exception(backoff.expo,
                           (asyncio.TimeoutError,
                            concurrent.futures._base.TimeoutError),
                           max_time=600)
 
-    async def _generate_tiles(self, tiles, config, table_data):
-        with open(self._get_csv_filename(table_data), 'w+') as csvfile:
-            db_pool = await async_pool()
-            columns = self.get_columns(config, table_data['value'])
-            csvwriter = csv.writer(csvfile)
-            headers = ['x', 'y', 'z', 'mvt_geometry', 'geoid', 'area_ratio', 'area']
-            headers += [column.get('column_alias', column['column_name']).lower() for column in columns]
-            csvwriter.writerow(headers)
-            geography_level = self.get_geography_level(self.geography)
-            batch_no = 1
+    async def _generate_tiles(self, zoom, bboxes_config, config, table_data):
+        # The tiles are enumerated on every attempt, a retry after a timeout
+        # starts over and the ledger skips the tiles already stored
+        tiles = tiles_in_bboxes(zoom, bboxes_config)
+        # Room for the tile queries plus the writer, the ledger lookups and the monitor
+        db_pool = await async_pool(max_connections=self.max_concurrency + 3, init=register_geometry_codec)
+        columns = self.get_columns(config, table_data['value'])
+        headers = ['x', 'y', 'z', 'mvt_geometry', 'geoid', 'area_ratio', 'area']
+        headers += [column.get('column_alias', column['column_name']).lower() for column in columns]
+        geography_level = self.get_geography_level(self.geography)
+
+        # Tile queries hand their records to a single COPY writer through a
+        # bounded queue, so a slow writer holds the queries back instead of
+        # piling up rows in memory
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        progress = self._get_progress(table_data)
+        limiter = AdaptiveLimit(initial=self.initial_concurrency, maximum=self.max_concurrency)
+        writer = asyncio.ensure_future(self._write_tiles(db_pool, queue, table_data, headers, progress))
+        monitor = asyncio.ensure_future(self._monitor(db_pool, limiter))
+        exceptions = []
+        running = set()
+        start_time = time.time()
+        try:
+            # A new tile query starts as soon as one finishes, as long as
+            # there are fewer running than the limiter allows
             for tiles_batch in self.batch(tiles, 100):
-                LOGGER.info("Processing batch {} with {} elements".format(batch_no, len(tiles_batch)))
-                batch_start = time.time()
-                executed_tiles = [self._generate_tile(db_pool, csvwriter, tile, geography_level, config, table_data['value'])
-                                  for tile in tiles_batch]
-                exceptions = await asyncio.gather(*executed_tiles, return_exceptions=True)
-                batch_end = time.time()
-                LOGGER.info("Batch {} processed in {} seconds".format(batch_no, (batch_end - batch_start)))
-                batch_no += 1
-
-            return exceptions
+                async with db_pool.acquire() as conn:
+                    tiles_batch = await progress.pending(conn, tiles_batch)
+                for tile in tiles_batch:
+                    while len(running) >= limiter.limit:
+                        done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                        exceptions += [task.exception() for task in done]
+                    running.add(asyncio.ensure_future(
+                        self._generate_tile(db_pool, queue, limiter, tile, geography_level, config,
+                                            table_data['value'])))
+            if running:
+                done, running = await asyncio.wait(running)
+                exceptions += [task.exception() for task in done]
+        finally:
+            for task in running:
+                task.cancel()
+            monitor.cancel()
+            # Cancelled tasks release their connections before the pool closes
+            await asyncio.gather(monitor, *running, return_exceptions=True)
+            try:
+                # The writer may have died with the queue full, so stop
+                # waiting for room as soon as it is done
+                end = asyncio.ensure_future(queue.put(None))
+                await asyncio.wait([end, writer], return_when=asyncio.FIRST_COMPLETED)
+                end.cancel()
+                await writer
+            finally:
+                await db_pool.close()
+        LOGGER.info("Generated {} tiles at {:.2f} tiles/sec".format(
+            limiter.completed, limiter.completed / max(time.time() - start_time, 1e-6)))
+
+        return exceptions
+
+    async def _monitor(self, db_pool, limiter):
+        '''
+        Every ``monitor_interval`` seconds reports the tile concurrency and
+        throughput, and backs the limiter off when the share of busy
+        Postgres backends goes over ``max_backend_load``.
+        '''
+        while True:
+            await asyncio.sleep(self.monitor_interval)
+            try:
+                async with db_pool.acquire() as conn:
+                    load = await conn.fetchval('''
+                        SELECT COUNT(*) FILTER (WHERE state = 'active')::FLOAT /
+                               current_setting('max_connections')::FLOAT
+                        FROM pg_stat_activity''')
+            except Exception as e:
+                LOGGER.warning('Unable to read the backend load: {}'.format(e))
+                load = None
+            if load is None or load > self.max_backend_load:
+                limiter.overloaded()
+            status = "Concurrency: {}, tiles/sec: {:.2f}, backend load: {}".format(
+                limiter.limit, limiter.rate, 'timeout' if load is None else '{:.2f}'.format(load))
+            LOGGER.info(status)
+            self.set_status_message(status)
 
     @backoff.on_exception(backoff.expo,
                           (asyncio.TimeoutError,
                            concurrent.futures._base.TimeoutError),
                           max_time=600)
 
-    async def _generate_tile(self, db_pool, csvwriter, tile, geography, config, shard_value=None):
+    async def _generate_tile(self, db_pool, queue, limiter, tile, geography, config, shard_value=None):
         tile_query = self.get_tile_query(config, tile, geography, shard_value)
 
         conn = None
@@ -260,11 +429,10 @@ class TilerXYZTableTask(Task):
             records = await conn.fetch(tile_query)
 
             tile_end = time.time()
+            limiter.sample(tile_end - tile_start)
             LOGGER.debug('Generated tile [{}/{}/{}] in {} seconds'.format(tile[0], tile[1], tile[2],
                                                                           (tile_end - tile_start)))
-            for record in records:
-                csvwriter.writerow(tuple(record))
-            else:
+            if not records:
                 LOGGER.debug('Tile [{}/{}/{}] without data'.format(tile[0], tile[1], tile[2], (tile_end - tile_start)))
         except BaseException as e:
             LOGGER.error('Tile [{}/{}/{}] returned exception {}'.format(tile[0], tile[1], tile[2], e))
@@ -272,20 +440,56 @@ class TilerXYZTableTask(Task):
         finally:
             await db_pool.release(conn)
 
-    def _insert_tiles(self, table_data):
-        table_name = self._get_table_name(table_data)
+        # Empty tiles are queued too, so they get recorded as done
+        await queue.put((tile, records))
+
+    async def _write_tiles(self, db_pool, queue, table_data, headers, progress):
+        '''
+        Drains the ``(tile, records)`` pairs from ``queue`` until a ``None``
+        arrives, copying the records into the tiler table in chunks of
+        ``copy_chunk_size`` rows with binary ``COPY``.
+        '''
+        rows = []
+        tiles = []
+        error = None
+        async with db_pool.acquire() as conn:
+            while True:
+                item = await queue.get()
+                if item is not None:
+                    tiles.append(item[0])
+                    rows.extend(item[1])
+                if tiles and (item is None or len(rows) >= self.copy_chunk_size or
+                              len(tiles) >= self.copy_chunk_size):
+                    # Keep draining after a failure so producers are never
+                    # blocked on a full queue, the error is raised at the end
+                    if error is None:
+                        try:
+                            await self._copy_tiles(conn, table_data, headers, rows, tiles, progress)
+                        except Exception as e:
+                            LOGGER.error('Copy of {} rows into {} failed: {}'.format(
+                                len(rows), table_data['table'], e))
+                            error = e
+                    rows = []
+                    tiles = []
+                if item is None:
+                    break
+
+        if error is not None:
+            raise error
+
+    async def _copy_tiles(self, conn, table_data, headers, rows, tiles, progress):
         copy_start = time.time()
-        session = current_session()
-        with open(self._get_csv_filename(table_data), 'rb') as f:
-            cursor = session.connection().connection.cursor()
-            sql_copy = """
-                        COPY {table} FROM STDIN WITH CSV HEADER DELIMITER AS ','
-                       """.format(table=table_name)
-            cursor.copy_expert(sql=sql_copy, file=f)
-            session.commit()
-            cursor.close()
+        async with conn.transaction():
+            if rows:
+                await conn.copy_records_to_table(table_data['table'],
+                                                 schema_name=table_data['schema'],
+                                                 columns=headers,
+                                                 records=rows)
+            await progress.record(conn, tiles)
         copy_end = time.time()
-        LOGGER.info("Copy tiles for table {} took {} seconds".format(table_data['table'],copy_end - copy_start))
+        LOGGER.debug("Copied {} rows of {} tiles into {} in {} seconds".format(len(rows), len(tiles),
+                                                                              table_data['table'],
+                                                                              copy_end - copy_start))
 
     def output(self):
         targets = []
@@ -297,15 +501,43 @@ class TilerXYZTableTask(Task):
                                               where='z = {}'.format(self.zoom_level)))
         return targets
 
+    def progress(self):
+        '''
+        Returns a dict of tiler table name to ``(generated tiles, total tiles)``
+        for this zoom level, as recorded in the :class:`TileProgress` ledger.
+        '''
+        session = current_session()
+        progress = {}
+        for config in self.config_data:
+            if config.get('bypass', False):
+                continue
+            num_tiles = count_tiles_in_bboxes(self.zoom_level, config['bboxes'])
+            for table_data in self._get_table_names(config):
+                progress[table_data['table']] = (self._get_progress(table_data).count(session), num_tiles)
+        return progress
+
+    def complete(self):
+        '''
+        Complete when every output has rows for this zoom level and, for the
+        tables with a ledger, all of its tiles have been recorded.  Tables
+        generated before the ledger existed have no entries and are only
+        checked for rows.
+        '''
+        if not all([target.exists() for target in self.output()]):
+            return False
+        for tablename, (done_tiles, num_tiles) in self.progress().items():
+            if done_tiles and done_tiles < num_tiles:
+                LOGGER.info("Table {} is partially generated: {} of {} tiles".format(tablename, done_tiles,
+                                                                                     num_tiles))
+                return False
+        return True
+
+    def _get_progress(self, table_data):
+        return TileProgress(table_data['schema'], table_data['table'], self.zoom_level)
+
     def _get_table_name(self, table_data):
         return "\"{schema}\".\"{table}\"".format(schema=table_data['schema'], table=table_data['table'])
 
-    def _get_csv_filename(self, table_data):
-        if not os.path.exists('tmp/tiler'):
-            os.makedirs('tmp/tiler')
-        return "tmp/tiler/tiler_{table_name}_{geography}.csv".format(table_name=table_data['table'],
-                                                                     geography=self.geography)
-
 
 class SimpleTilerDOXYZTableTask(Task):
 
@@ -1,11 +1,14 @@
 from time import time
 from collections import OrderedDict
-from luigi import Parameter, WrapperTask
+from concurrent.futures import ThreadPoolExecutor
+from luigi import Parameter, IntParameter, WrapperTask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 
 from lib.timespan import get_timespan
 from lib.logger import get_logger
 from tasks.base_tasks import TableTask, MetaWrapper, LoadPostgresFromZipFile, RepoFile
-from tasks.util import grouper
 from tasks.us.census.tiger import SumLevel, ShorelineClip, TigerBlocksInterpolation
 from tasks.us.census.tiger import (SUMLEVELS, GeoidColumns, GEOID_SUMLEVEL_COLUMN, GEOID_SHORELINECLIPPED_COLUMN)
 from tasks.meta import (current_session, GEOM_REF)
@@ -36,6 +39,53 @@ GEOGRAPHIES = [STATE, COUNTY, CENSUS_TRACT, BLOCK_GROUP, BLOCK, PUMA, ZCTA5, CON
 YEARS = ['2015', '2016']
 SAMPLES = [SAMPLE_5YR]
 
+# Groups of columns ranked at the same time for the largest geographies
+PARALLEL_QUANTILES_WORKERS = 4
+
+
+class SchemaCatalog(object):
+    '''
+    Lowercased names of the tables of a schema and of their columns.  Each
+    schema is loaded with a single catalog query the first time it is needed
+    and then shared by every task of the run.
+    '''
+
+    def __init__(self):
+        self._schemas = {}
+
+    def tables(self, schema):
+        '''
+        Returns a dict of the tables in ``schema`` to the set of their columns.
+        '''
+        if schema not in self._schemas:
+            tables = {}
+            resp = current_session().execute(
+                '''
+                SELECT LOWER(c.relname), LOWER(a.attname)
+                FROM pg_namespace n
+                     JOIN pg_class c ON c.relnamespace = n.oid
+                     JOIN pg_attribute a ON a.attrelid = c.oid
+                WHERE n.nspname = :schema
+                  AND c.relkind IN ('r', 'v', 'm', 'f', 'p')
+                  AND a.attnum > 0 AND NOT a.attisdropped
+                ''', {'schema': schema})
+            for table, column in resp:
+                tables.setdefault(table, set()).add(column)
+            self._schemas[schema] = tables
+        return self._schemas[schema]
+
+    def has_table(self, schema, table):
+        return table.lower() in self.tables(schema)
+
+    def has_column(self, schema, table, column):
+        return column.lower() in self.tables(schema).get(table.lower(), ())
+
+    def invalidate(self, schema):
+        self._schemas.pop(schema, None)
+
+
+acs_catalog = SchemaCatalog()
+
 
 class DownloadACS(LoadPostgresFromZipFile):
 
@@ -62,6 +112,7 @@ class DownloadACS(LoadPostgresFromZipFile):
         cursor = current_session()
         cursor.execute('DROP SCHEMA IF EXISTS {schema} CASCADE'.format(schema=self.schema))
         cursor.commit()
+        acs_catalog.invalidate(self.schema)
         LOGGER.info("Starting to import ACS {year}_{sample}".format(year=self.year, sample=self.sample))
         self.load_from_zipfile(self.input().path)
         LOGGER.info("Finished to import ACS {year}_{sample}".format(year=self.year, sample=self.sample))
@@ -70,11 +121,16 @@ class DownloadACS(LoadPostgresFromZipFile):
 class Quantiles(TableTask):
     '''
     Calculate the quantiles for each ACS column
+
+    :param workers: Optional.  Number of groups of columns ranked at the same
+                    time.  Defaults to ``PARALLEL_QUANTILES_WORKERS`` for block
+                    groups and blocks, and to a single statement otherwise.
     '''
 
     year = Parameter()
     sample = Parameter()
     geography = Parameter()
+    workers = IntParameter(default=None, significant=False)
 
     def requires(self):
         return {
@@ -111,54 +167,99 @@ class Quantiles(TableTask):
                                                      end=int(self.year)))
 
     def populate(self):
-        connection = current_session()
         input_ = self.input()
         quant_col_names = list(input_['columns'].keys())
         old_col_names = [name.split("_quantile")[0]
                          for name in quant_col_names]
+        cols = list(zip(quant_col_names, old_col_names))
+        workers = self.workers or (PARALLEL_QUANTILES_WORKERS if self.geography in (BLOCK_GROUP, BLOCK) else 1)
 
-        insert = True
-        for cols in grouper(list(zip(quant_col_names, old_col_names)), 20):
-            selects = [" percent_rank() OVER (ORDER BY {old_col} ASC) as {old_col} ".format(old_col=c[1])
-                       for c in cols if c is not None]
-
-            insert_statment = ", ".join([c[0] for c in cols if c is not None])
-            old_cols_statment = ", ".join([c[1] for c in cols if c is not None])
-            select_statment = ", ".join(selects)
-            before = time()
-            if insert:
-                stmt = '''
-                    INSERT INTO {table}
-                    (geoidsl, geoidsc, {insert_statment})
-                    SELECT geoidsl, geoidsc, {select_statment}
-                    FROM {source_table}
-                '''.format(
-                    table=self.output().table,
-                    insert_statment=insert_statment,
-                    select_statment=select_statment,
-                    source_table=input_['table'].table
-                )
-                insert = False
-            else:
-                stmt = '''
-                    WITH data as (
-                        SELECT geoidsl, geoidsc, {select_statment}
-                        FROM {source_table}
-                    )
-                    UPDATE {table} SET ({insert_statment}) = ROW({old_cols_statment})
-                    FROM data
-                    WHERE data.geoidsc = {table}.geoidsc
-                     AND data.geoidsl = {table}.geoidsl
-                '''.format(
-                    table=self.output().table,
-                    insert_statment=insert_statment,
-                    select_statment=select_statment,
-                    old_cols_statment=old_cols_statment,
-                    source_table=input_['table'].table
-                )
-            connection.execute(stmt)
-            after = time()
-            LOGGER.info('quantile calculation time taken : %s', int(after - before))
+        before = time()
+        if workers > 1 and len(cols) > 1:
+            self._populate_parallel(cols, workers)
+        else:
+            # Every rank is computed in the same scan and the output is written once
+            current_session().execute('''
+                INSERT INTO {table}
+                (geoidsl, geoidsc, {insert_statment})
+                {select}
+            '''.format(
+                table=self.output().table,
+                insert_statment=", ".join([c[0] for c in cols]),
+                select=self._quantiles_select(cols)
+            ))
+        after = time()
+        LOGGER.info('quantile calculation time taken : %s', int(after - before))
+
+    def _quantiles_select(self, cols, row_id=False):
+        '''
+        Ranks of ``cols``.  With ``row_id``, the rows also carry the id of
+        their source row, which is the same for every group of columns.
+        '''
+        return '''
+            SELECT {row_id}geoidsl, geoidsc, {select_statment}
+            FROM {source_table}
+        '''.format(
+            row_id='CAST(ctid AS TEXT) row_id, ' if row_id else '',
+            select_statment=", ".join([" percent_rank() OVER (ORDER BY {old_col} ASC) as {old_col} ".format(old_col=c[1])
+                                       for c in cols]),
+            source_table=self.input()['table'].table
+        )
+
+    def _populate_parallel(self, cols, workers):
+        '''
+        Computes the ranks of ``workers`` groups of columns concurrently, each
+        into a staging table, and joins them into the output by source row.
+        '''
+        engine = create_engine(current_session().get_bind().url, poolclass=NullPool)
+        groups = [cols[i::workers] for i in range(workers) if cols[i::workers]]
+        staging = ['{table}_{num}'.format(table=self.output().table, num=num) for num in range(len(groups))]
+
+        def rank(table, group):
+            session = Session(bind=engine)
+            try:
+                session.execute('DROP TABLE IF EXISTS {table}'.format(table=table))
+                session.execute('CREATE UNLOGGED TABLE {table} AS {select}'.format(
+                    table=table, select=self._quantiles_select(group, row_id=True)))
+                session.commit()
+            finally:
+                session.close()
+
+        session = current_session()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(rank, staging, groups))
+
+            session.execute('''
+                INSERT INTO {table}
+                (geoidsl, geoidsc, {insert_statment})
+                SELECT s0.geoidsl, s0.geoidsc, {select_statment}
+                FROM {joins}
+            '''.format(
+                table=self.output().table,
+                insert_statment=", ".join([c[0] for group in groups for c in group]),
+                select_statment=", ".join(['s{num}.{old_col}'.format(num=num, old_col=c[1])
+                                           for num, group in enumerate(groups) for c in group]),
+                joins=' '.join(['{table} s0'.format(table=staging[0])] +
+                                ['JOIN {table} s{num} ON s{num}.row_id = s0.row_id'.format(table=table, num=num)
+                                 for num, table in enumerate(staging) if num > 0])
+            ))
+        except:
+            # The session holds locks on the staging tables it has read
+            session.rollback()
+            cleanup = Session(bind=engine)
+            try:
+                for table in staging:
+                    cleanup.execute('DROP TABLE IF EXISTS {table}'.format(table=table))
+                cleanup.commit()
+            finally:
+                cleanup.close()
+            raise
+        else:
+            for table in staging:
+                session.execute('DROP TABLE {table}'.format(table=table))
+        finally:
+            engine.dispose()
 
 
 class Extract(TableTask):
@@ -256,20 +357,13 @@ class Extract(TableTask):
         tableids = set()
         inputschema = 'acs{year}_{sample}'.format(year=self.year, sample=self.sample)
         for colname, coltarget in self.columns().items():
-            colid = coltarget.get(session).id
+            colid = coltarget._id
             tableid = colid.split('.')[-1][0:-3]
             if 'geoid' in colid:
                 colids.append('SUBSTR(geoid, 8)')
             else:
                 colid = coltarget._id.split('.')[-1]
-                resp = session.execute('SELECT COUNT(*) FROM information_schema.columns '
-                                       "WHERE table_schema = '{inputschema}'  "
-                                       "  AND table_name ILIKE '{inputtable}' "
-                                       "  AND column_name ILIKE '{colid}' ".format(
-                                           inputschema=inputschema,
-                                           inputtable=tableid,
-                                           colid=colid))
-                if int(resp.fetchone()[0]) == 0:
+                if not acs_catalog.has_column(inputschema, tableid, colid):
                     continue
                 colids.append(colid)
                 tableids.add(tableid)
@@ -278,12 +372,7 @@ class Extract(TableTask):
         tableclause = '{inputschema}.{inputtable} '.format(
             inputschema=inputschema, inputtable=tableids.pop())
         for tableid in tableids:
-            resp = session.execute('SELECT COUNT(*) FROM information_schema.tables '
-                                   "WHERE table_schema = '{inputschema}'  "
-                                   "  AND table_name ILIKE '{inputtable}' ".format(
-                                       inputschema=inputschema,
-                                       inputtable=tableid))
-            if int(resp.fetchone()[0]) > 0:
+            if acs_catalog.has_table(inputschema, tableid):
                 tableclause += ' JOIN {inputschema}.{inputtable} ' \
                                ' USING (geoid) '.format(inputschema=inputschema,
                                                         inputtable=tableid)
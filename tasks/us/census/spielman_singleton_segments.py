@@ -108,22 +108,11 @@ class SpielmanSingletonTempTable(CSV2TempTableTask):
     def input_csv(self):
         return self.input().path
 
-    def after_copy(self):
-        for name, segment_id in SpielmanSingletonColumns.x10_mapping.items():
-            query = ('''UPDATE {table} SET "X10"='{name}'
-                        WHERE "X10"='{segment_id}';'''.format(
-                          table=self.output().table,
-                          name=name,
-                          segment_id=segment_id))
-            current_session().execute(query)
-
-        for name, segment_id in SpielmanSingletonColumns.x55_mapping.items():
-            query = ('''UPDATE {table} SET "X55"='{name}'
-                        WHERE "X55"='{segment_id}';'''.format(
-                          table=self.output().table,
-                          name=name,
-                          segment_id=segment_id))
-            current_session().execute(query)
+    def recode(self):
+        return {
+            'X10': {segment_id: name for name, segment_id in SpielmanSingletonColumns.x10_mapping.items()},
+            'X55': {segment_id: name for name, segment_id in SpielmanSingletonColumns.x55_mapping.items()},
+        }
 
 
 class SpielmanSingletonTable(TableTask):
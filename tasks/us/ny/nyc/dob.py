@@ -13,6 +13,7 @@ from tasks.us.ny.nyc.tags import NYCTags
 from tasks.poi import POIColumns
 from datetime import datetime
 
+from lib.copy import copy_from_iterator, copy_text_line
 from lib.logger import get_logger
 
 import os
@@ -45,67 +46,63 @@ class PermitIssuanceXLS2TempTableTask(TempTableTask):
             self.input().path,
             'per{}{}.xls'.format(
                 ('0' + str(self.month))[-2:], ('0' + str(self.year))[-2:])),
-            formatting_info=True)
+            formatting_info=True, on_demand=True)
 
-        sheet = book.sheets()[0]
-
-        session = current_session()
-        allvals = []
-        for rownum, row in enumerate(sheet.get_rows()):
-            if rownum == 2:
-                coldefs = ['"{}" VARCHAR'.format(cell.value.replace('"', '').strip()) for cell in row if cell.value]
-                session.execute('CREATE TABLE {output} ({coldefs})'.format(
-                    coldefs=', '.join(coldefs),
-                    output=self.output().table
-                ))
-            elif rownum > 2:
-                # Have to escape colons as they are interpreted as symbols otherwise
-                vals = []
-                for cell in row:
-                    # type 0 is empty
-                    if cell.ctype == 0:
-                        pass
-                    # type 2 is numeric, which is always a float, even if it
-                    # should be an integer
-                    elif cell.ctype == 2:
-                        if cell.value == int(cell.value):
-                            vals.append(str(int(cell.value)))
-                        else:
-                            vals.append(str(cell.value))
-                    # type 3 is date
-                    elif cell.ctype == 3:
-                        vals.append("'{}-{}-{}'".format(*xldate_as_tuple(cell.value, 0)))
-                    # everything else just pass in as unicode string, unless
-                    # it's blank, in which case send in NULL
-                    else:
-                        if cell.value:
-                            vals.append("'{}'".format(str(cell.value)
-                                                      .replace(":", "::")
-                                                      .replace("'", "''")))
-                        else:
-                            vals.append('NULL')
-
-                # Kill occasional erroneous blank last column
-                if vals[-1] == "NULL":
-                    vals = vals[0:-1]
-
-                if len(vals) < len(coldefs):
-                    vals.extend(["NULL"] * (len(coldefs) - len(vals)))
-
-                if len(vals) != len(coldefs):
-                    LOGGER.error('FIXME: cannot parse year %s month %s row %s',
-                                 self.year, self.month, rownum)
-                    continue
-
-                allvals.append(', '.join(vals))
         try:
-            session.execute('INSERT INTO {output} VALUES ({allvals})'.format(
-                output=self.output().table,
-                allvals='), ('.join(allvals)
+            sheet = book.sheet_by_index(0)
+            rows = sheet.get_rows()
+            for rownum, row in enumerate(rows):
+                if rownum == 2:
+                    colnames = [cell.value.replace('"', '').strip() for cell in row if cell.value]
+                    break
+
+            session = current_session()
+            session.execute('CREATE TABLE {output} ({coldefs})'.format(
+                coldefs=', '.join(['"{}" VARCHAR'.format(colname) for colname in colnames]),
+                output=self.output().table
             ))
-        except Exception as err:
-            print(err)
-            raise
+            # The rows are converted as COPY reads them
+            copy_from_iterator(session, self.output().table,
+                               ['"{}"'.format(colname) for colname in colnames],
+                               self._copy_lines(rows, len(colnames), first_rownum=3))
+        finally:
+            book.release_resources()
+
+    def _copy_lines(self, rows, numcols, first_rownum):
+        for rownum, row in enumerate(rows, first_rownum):
+            vals = []
+            for cell in row:
+                # type 0 is empty
+                if cell.ctype == 0:
+                    pass
+                # type 2 is numeric, which is always a float, even if it
+                # should be an integer
+                elif cell.ctype == 2:
+                    if cell.value == int(cell.value):
+                        vals.append(int(cell.value))
+                    else:
+                        vals.append(cell.value)
+                # type 3 is date
+                elif cell.ctype == 3:
+                    vals.append('{}-{}-{}'.format(*xldate_as_tuple(cell.value, 0)))
+                # everything else just pass in as unicode string, unless
+                # it's blank, in which case send in NULL
+                else:
+                    vals.append(str(cell.value) if cell.value else None)
+
+            # Kill occasional erroneous blank last column
+            if vals and vals[-1] is None:
+                vals = vals[0:-1]
+
+            if len(vals) < numcols:
+                vals.extend([None] * (numcols - len(vals)))
+
+            if len(vals) != numcols:
+                LOGGER.error('FIXME: cannot parse year %s month %s row %s',
+                             self.year, self.month, rownum)
+                continue
+
+            yield copy_text_line(vals)
 
 
 class PermitColumns(ColumnsTask):
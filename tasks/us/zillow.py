@@ -369,27 +369,30 @@ class Zillow(TableTask):
     def populate(self):
         session = current_session()
 
-        insert = True
         input_ = self.input()
         output = self.output()
+        # Every region is looked up once in each of the inputs, so each
+        # output row is written a single time and the primary key is built
+        # over the final table
+        input_tables = [(key, input_[key].table) for key in input_['metadata'].keys()]
+        regions = ' UNION '.join(['SELECT "RegionName" FROM {}'.format(input_table)
+                                  for _, input_table in input_tables])
+        joins = ' '.join(['LEFT JOIN {input_table} t{num} ON t{num}."RegionName" = r."RegionName"'.format(
+                              input_table=input_table, num=num)
+                          for num, (_, input_table) in enumerate(input_tables)])
+        values = ', '.join(['t{num}."{year}-{month}"::NUMERIC'.format(
+                                num=num, year=str(self.year).zfill(2), month=str(self.month).zfill(2))
+                            for num in range(len(input_tables))])
+        session.execute('''INSERT INTO {output} (region_name_sl, region_name_sc, {col_ids})
+                           SELECT r."RegionName", r."RegionName", {values}
+                           FROM ({regions}) r {joins}'''.format(
+                               output=output.table,
+                               col_ids=', '.join([key for key, _ in input_tables]),
+                               values=values,
+                               regions=regions,
+                               joins=joins))
         session.execute('ALTER TABLE {output} ADD PRIMARY KEY (region_name_sl, region_name_sc)'.format(
             output=output.table))
-        session.flush()
-        for key, _ in input_['metadata'].items():
-            input_table = input_[key].table
-            stmt = '''INSERT INTO {output} (region_name_sl, region_name_sc, {col_id})
-                      SELECT "RegionName", "RegionName", "{year}-{month}"::NUMERIC
-                      FROM {input_table}
-                      ON CONFLICT (region_name_sl, region_name_sc)
-                         DO UPDATE SET {col_id} = EXCLUDED.{col_id}'''
-            session.execute(stmt.format(
-                output=output.table,
-                year=str(self.year).zfill(2),
-                month=str(self.month).zfill(2),
-                col_id=key,
-                input_table=input_table))
-            if insert:
-                insert = False
 
 
 class AllZillow(WrapperTask):
@@ -1,7 +1,9 @@
 '''
 Util functions for luigi bigmetadata tasks.
 '''
+import io
 import os
+import gzip
 import time
 import re
 import subprocess
@@ -9,10 +11,15 @@ import shutil
 import zipfile
 
 from lib.logger import get_logger
+from lib.copy import copy_from_iterator
 
 from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from slugify import slugify
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 import requests
 
 OBSERVATORY_PREFIX = 'obs_'
@@ -213,63 +220,74 @@ def sql_to_cartodb_table(outname, localname, json_column_names=None,
     assert resp.status_code == 200
 
 
-def generate_tile_summary(session, table_id, column_id, tablename, colname):
-    '''
-    Add entries to obs_column_table_tile for the given table and column.
-    '''
-    tablename_ns = tablename.split('.')[-1]
+TILE_SUMMARY_WORKERS = int(os.environ.get('TILE_SUMMARY_WORKERS', os.cpu_count() or 1))
+TILE_SUMMARY_CHUNKS_PER_WORKER = 4
 
-    query = '''
-        DELETE FROM observatory.obs_column_table_tile_simple
-        WHERE table_id = '{table_id}'
-          AND column_id = '{column_id}';'''.format(
-              table_id=table_id, column_id=column_id)
-    resp = session.execute(query)
 
-    query = '''
-        DELETE FROM observatory.obs_column_table_tile
-        WHERE table_id = '{table_id}'
-          AND column_id = '{column_id}';'''.format(
-              table_id=table_id, column_id=column_id)
-    resp = session.execute(query)
-
-    query = '''
+def _raster_grid(session, tablename, colname):
+    '''
+    Returns the tile size and the extent of the raster that summarizes the
+    geometries of ``tablename``, as
+    ``(tilesize, xmin, xmax, ymin, ymax)``.
+    '''
+    return tuple(session.execute('''
+        WITH tilesize AS (SELECT
+          CASE WHEN SUM(ST_Area({colname})) > 5000 THEN 2.5
+               ELSE 0.5 END AS tilesize,
+          ST_SetSRID(ST_Extent({colname}), 4326) extent
+          FROM {tablename}
+        ) SELECT tilesize,
+                 ST_XMin(extent) xmin, ST_XMax(extent) xmax,
+                 ST_YMin(extent) ymin, ST_YMax(extent) ymax
+          FROM tilesize
+        '''.format(colname=colname, tablename=tablename)).fetchone())
+
+
+def _create_raster_empty(session, tablename_ns, grid, chunks=1, chunk=0):
+    '''
+    Creates ``raster_empty_<tablename_ns>`` with the empty raster tiles of
+    ``grid``.  The tiles are numbered in the order ``ST_Tile`` generates them,
+    which only depends on the grid, so every connection numbers them the same
+    way, and with ``chunks`` only the tiles whose id modulo ``chunks`` is
+    ``chunk`` are kept.
+    '''
+    tilesize, xmin, xmax, ymin, ymax = grid
+    return session.execute('''
         DROP TABLE IF EXISTS raster_empty_{tablename_ns};
         CREATE TEMPORARY TABLE raster_empty_{tablename_ns} AS
-        SELECT ROW_NUMBER() OVER () AS id, rast FROM (
-          WITH tilesize AS (SELECT
-            CASE WHEN SUM(ST_Area({colname})) > 5000 THEN 2.5
-                 ELSE 0.5 END AS tilesize,
-            ST_SetSRID(ST_Extent({colname}), 4326) extent
-            FROM {tablename}
-          ), summaries AS (
-            SELECT ST_XMin(extent) xmin, ST_XMax(extent) xmax,
-                   ST_YMin(extent) ymin, ST_YMax(extent) ymax
-            FROM tilesize
-          ) SELECT
-              ST_Tile(ST_SetSRID(
-                ST_AddBand(
-                  ST_MakeEmptyRaster(
-                    ((xmax - xmin) / tilesize)::Integer + 1,
-                    ((ymax - ymin) / tilesize)::Integer + 1,
-                    ((xmin / tilesize)::Integer)::Numeric * tilesize,
-                    ((ymax / tilesize)::Integer)::Numeric * tilesize,
-                    tilesize
-                  ), ARRAY[
-                    (1, '32BF', -1, 0)::addbandarg,
-                    (2, '32BF', -1, 0)::addbandarg,
-                    (3, '32BF', -1, 0)::addbandarg
-                  ])
-              , 4326)
-          , ARRAY[1, 2, 3], 25, 25) rast
-          FROM summaries, tilesize
-          ) foo;
-        '''.format(colname=colname,
-                   tablename=tablename,
-                   tablename_ns=tablename_ns)
-    resp = session.execute(query)
-    assert resp.rowcount > 0
-
+        WITH summaries AS (
+          SELECT {xmin}::FLOAT xmin, {xmax}::FLOAT xmax,
+                 {ymin}::FLOAT ymin, {ymax}::FLOAT ymax,
+                 {tilesize}::NUMERIC tilesize
+        ) SELECT tiles.id, tiles.rast
+          FROM summaries,
+               ST_Tile(ST_SetSRID(
+                 ST_AddBand(
+                   ST_MakeEmptyRaster(
+                     ((xmax - xmin) / tilesize)::Integer + 1,
+                     ((ymax - ymin) / tilesize)::Integer + 1,
+                     ((xmin / tilesize)::Integer)::Numeric * tilesize,
+                     ((ymax / tilesize)::Integer)::Numeric * tilesize,
+                     tilesize
+                   ), ARRAY[
+                     (1, '32BF', -1, 0)::addbandarg,
+                     (2, '32BF', -1, 0)::addbandarg,
+                     (3, '32BF', -1, 0)::addbandarg
+                   ])
+               , 4326)
+               , ARRAY[1, 2, 3], 25, 25) WITH ORDINALITY AS tiles (rast, id)
+          WHERE tiles.id % {chunks} = {chunk};
+        '''.format(tablename_ns=tablename_ns, tilesize=str(tilesize),
+                   xmin=repr(xmin), xmax=repr(xmax), ymin=repr(ymin), ymax=repr(ymax),
+                   chunks=chunks, chunk=chunk))
+
+
+def _create_raster_vals(session, tablename_ns, tablename, colname):
+    '''
+    Creates ``raster_vals_<tablename_ns>`` with the geometry count and the
+    fill of every pixel of ``raster_empty_<tablename_ns>`` that intersects
+    the geometries of ``tablename``.
+    '''
     query = '''
       DROP TABLE IF EXISTS raster_pap_{tablename_ns};
       CREATE TEMPORARY TABLE raster_pap_{tablename_ns} As
@@ -279,14 +297,13 @@ def generate_tile_summary(session, table_id, column_id, tablename, colname):
            WHERE rast.rast && vector.{colname}
            GROUP BY id;
     '''.format(tablename_ns=tablename_ns, tablename=tablename, colname=colname)
-    resp = session.execute(query)
-    assert resp.rowcount > 0
+    session.execute(query)
 
     query = '''
       CREATE UNIQUE INDEX ON raster_pap_{tablename_ns} (id, x, y);
       CREATE INDEX ON raster_pap_{tablename_ns} using gist (geom);
     '''.format(tablename_ns=tablename_ns, colname=colname)
-    resp = session.execute(query)
+    session.execute(query)
 
     # Travis doesn't support ST_ClipByBox2D because of old GEOS version, but
     # our Docker container supports this optimization
@@ -337,8 +354,119 @@ def generate_tile_summary(session, table_id, column_id, tablename, colname):
          GROUP BY id, x, y;
     '''.format(tablename_ns=tablename_ns, tablename=tablename, colname=colname,
                st_clip=st_clip)
+    session.execute(query)
+
+
+def _chunk_raster_vals(engine, chunks, chunk, tablename_ns, tablename, colname, grid):
+    '''
+    Computes the pixel stats of one chunk of raster tiles in a connection of
+    its own, returning ``(id, geom, cnt, percent_fill)`` rows.
+    '''
+    session = Session(bind=engine)
+    try:
+        _create_raster_empty(session, tablename_ns, grid, chunks, chunk)
+        _create_raster_vals(session, tablename_ns, tablename, colname)
+        return session.execute('''
+            SELECT id, (cnt).geom, (cnt).val, (percent_fill).val
+            FROM raster_vals_{tablename_ns}
+            '''.format(tablename_ns=tablename_ns)).fetchall()
+    finally:
+        session.close()
+
+
+def _parallel_raster_vals(engine, workers, chunks, tablename_ns, tablename, colname, grid):
+    '''
+    Yields the pixel stats rows of every chunk, computed by ``workers``
+    threads.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_chunk_raster_vals, engine, chunks, chunk,
+                                   tablename_ns, tablename, colname, grid)
+                   for chunk in range(chunks)]
+        for future in as_completed(futures):
+            for row in future.result():
+                yield row
+
+
+def _merge_raster_vals(session, tablename_ns, rows):
+    '''
+    Loads pixel stats rows into ``raster_vals_<tablename_ns>`` in ``session``.
+    '''
+    session.execute('''
+        DROP TABLE IF EXISTS raster_stats_{tablename_ns};
+        CREATE TEMPORARY TABLE raster_stats_{tablename_ns} (
+          id BIGINT, geom GEOMETRY, cnt NUMERIC, percent_fill NUMERIC
+        );
+        '''.format(tablename_ns=tablename_ns))
+
+    def lines():
+        for row in rows:
+            yield '\t'.join(['\\N' if value is None else str(value) for value in row]) + '\n'
+
+    copy_from_iterator(session, 'raster_stats_{}'.format(tablename_ns),
+                       ['id', 'geom', 'cnt', 'percent_fill'], lines())
+    session.execute('''
+        DROP TABLE IF EXISTS raster_vals_{tablename_ns};
+        CREATE TEMPORARY TABLE raster_vals_{tablename_ns} AS
+        SELECT id
+               , (null::geometry, null::numeric)::geomval median
+               , (geom, cnt)::geomval cnt
+               , (geom, percent_fill)::geomval percent_fill
+        FROM raster_stats_{tablename_ns};
+        '''.format(tablename_ns=tablename_ns))
+
+
+def generate_tile_summary(session, table_id, column_id, tablename, colname, workers=1):
+    '''
+    Add entries to obs_column_table_tile for the given table and column.
+
+    With ``workers`` greater than one, the pixel stats are computed by chunks
+    of raster tiles in that many parallel connections and merged in
+    ``session``.  Those connections only see committed data, so this is only
+    for tables that are not modified in the current transaction.
+    '''
+    tablename_ns = tablename.split('.')[-1]
+
+    query = '''
+        DELETE FROM observatory.obs_column_table_tile_simple
+        WHERE table_id = '{table_id}'
+          AND column_id = '{column_id}';'''.format(
+              table_id=table_id, column_id=column_id)
     resp = session.execute(query)
+
+    query = '''
+        DELETE FROM observatory.obs_column_table_tile
+        WHERE table_id = '{table_id}'
+          AND column_id = '{column_id}';'''.format(
+              table_id=table_id, column_id=column_id)
+    resp = session.execute(query)
+
+    real_num_geoms = session.execute('''
+        SELECT COUNT({colname}) FROM {tablename}
+    '''.format(colname=colname,
+               tablename=tablename)).fetchone()[0]
+
+    grid = _raster_grid(session, tablename, colname)
+    resp = _create_raster_empty(session, tablename_ns, grid)
     assert resp.rowcount > 0
+    num_tiles = resp.rowcount
+
+    chunks = min(num_tiles, workers * TILE_SUMMARY_CHUNKS_PER_WORKER)
+    if chunks > 1:
+        LOGGER.info('Computing tile summary of %s in %s chunks with %s workers',
+                    tablename, chunks, workers)
+        engine = create_engine(session.get_bind().url, poolclass=NullPool)
+        try:
+            _merge_raster_vals(session, tablename_ns, _parallel_raster_vals(
+                engine, workers, chunks, tablename_ns, tablename, colname, grid))
+        finally:
+            engine.dispose()
+    else:
+        _create_raster_vals(session, tablename_ns, tablename, colname)
+
+    resp = session.execute('SELECT COUNT(*) FROM raster_vals_{tablename_ns}'.format(
+        tablename_ns=tablename_ns))
+    assert resp.fetchone()[0] > 0
 
     query = '''
         INSERT INTO observatory.obs_column_table_tile
@@ -395,11 +523,6 @@ def generate_tile_summary(session, table_id, column_id, tablename, colname):
        '''.format(table_id=table_id, column_id=column_id,
                   colname=colname, tablename=tablename))
 
-    real_num_geoms = session.execute('''
-        SELECT COUNT({colname}) FROM {tablename}
-    '''.format(colname=colname,
-               tablename=tablename)).fetchone()[0]
-
     est_num_geoms = session.execute('''
         SELECT (ST_SummaryStatsAgg(tile, 1, false)).sum
         FROM observatory.obs_column_table_tile_simple
@@ -438,16 +561,93 @@ def copyfile(src, dst):
 
     shutil.copyfile(src, dst)
 
-def uncompress_file(zip_file):
+UNCOMPRESS_WORKERS = 4
+
+
+def _member_path(path, name):
+    '''
+    Path where :meth:`zipfile.ZipFile.extract` writes the member ``name``
+    into ``path``, leaving out absolute and parent components like it does.
+    '''
+    parts = [p for p in os.path.splitdrive(name.replace('/', os.path.sep))[1].split(os.path.sep)
+             if p not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(path, *parts)
+
+
+def _extract_members(archive, path, names):
+    with zipfile.ZipFile(archive, 'r') as z:
+        for name in names:
+            z.extract(name, path=path)
+
+
+def uncompress_file(zip_file, workers=UNCOMPRESS_WORKERS):
+    '''
+    Extracts ``{zip_file}.zip`` into the folder ``{zip_file}``.  The members
+    are streamed to disk, spread by size over ``workers`` threads that read
+    the archive independently.
+    '''
     LOGGER.debug("Uncompressing {zip_file}".format(zip_file=zip_file))
+    archive = '{zip_file}.zip'.format(zip_file=zip_file)
     try:
-        with zipfile.ZipFile('{zip_file}.zip'.format(zip_file=zip_file), 'r') as z:
-            z.extractall(path='{zip_file}'.format(zip_file=zip_file))
+        with zipfile.ZipFile(archive, 'r') as z:
+            members = sorted(z.infolist(), key=lambda m: m.file_size, reverse=True)
+        # zipfile creates missing directories without a lock, so they are all
+        # created before the workers start
+        for member in members:
+            target = _member_path(zip_file, member.filename)
+            os.makedirs(target if member.filename.endswith('/') else os.path.dirname(target),
+                        exist_ok=True)
+        members = [m for m in members if not m.filename.endswith('/')]
+        # Largest members first, each to the least loaded worker
+        batches = [[] for _ in range(max(1, min(workers, len(members))))]
+        loads = [0] * len(batches)
+        for member in members:
+            idx = loads.index(min(loads))
+            batches[idx].append(member.filename)
+            loads[idx] += member.file_size
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            futures = [executor.submit(_extract_members, archive, zip_file, names) for names in batches]
+            for future in as_completed(futures):
+                future.result()
     except NotImplementedError as err:
         s_err = str(err)
         LOGGER.warn("%s.zip error: %s. Fallback to command line...", zip_file, s_err)
         if s_err == 'compression type 9 (deflate64)':
             # Support for unsupported file types, such as PKWare deflate64 format
-            subprocess.check_call(['unzip', '{zip_file}.zip'.format(zip_file=zip_file), '-d', zip_file])
+            subprocess.check_call(['unzip', '-o', '{zip_file}.zip'.format(zip_file=zip_file), '-d', zip_file])
         else:
             raise
+
+
+def open_stream(path):
+    '''
+    Opens ``path`` for binary reading, decompressing it on the fly if it is a
+    ``.gz`` file, or a member of a zip archive given as
+    ``archive.zip/member``, so it can be read without unpacking it to disk.
+    '''
+    if '.zip/' in path and not os.path.exists(path):
+        archive, member = path.split('.zip/', 1)
+        zfile = zipfile.ZipFile(archive + '.zip', 'r')
+        try:
+            return _ZipMemberStream(zfile, zfile.open(member))
+        except:
+            zfile.close()
+            raise
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class _ZipMemberStream(io.BufferedReader):
+    '''
+    Stream over a zip member that closes its archive when it is closed.
+    '''
+    def __init__(self, zfile, member):
+        super(_ZipMemberStream, self).__init__(member)
+        self._zfile = zfile
+
+    def close(self):
+        try:
+            super(_ZipMemberStream, self).close()
+        finally:
+            self._zfile.close()
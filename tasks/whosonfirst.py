@@ -4,50 +4,120 @@
 Bigmetadata tasks
 '''
 
-import subprocess
+import json
+import time
+import random
 from csv import DictReader
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from luigi import Parameter, WrapperTask
+from requests.adapters import HTTPAdapter
+from luigi import Parameter, IntParameter, WrapperTask
 
+from lib.copy import copy_from_iterator, copy_text_line
+from lib.logger import get_logger
 from lib.timespan import get_timespan
 from tasks.meta import current_session, OBSColumn
 from tasks.base_tasks import ColumnsTask, TempTableTask, TableTask
-from tasks.util import shell
+from tasks.util import grouper
 from tasks.us.census.tiger import ShorelineClip, DownloadTiger
 from tasks.tags import SectionTags, SubsectionTags
 
+LOGGER = get_logger(__name__)
+
+
+def fetch_url(url, session=None, timeout=60):
+    '''
+    Returns the contents of ``url`` as bytes.  ``file://`` URLs are read from
+    disk, so a local copy of the data can stand in for the servers.
+    '''
+    if url.startswith('file://'):
+        with open(url[len('file://'):], 'rb') as f:
+            return f.read()
+    resp = (session or requests).get(url, timeout=timeout)
+    resp.raise_for_status()
+    return resp.content
+
 
 class DownloadWOF(TempTableTask):
+    '''
+    Loads the features of a Who's On First resolution.
+
+    The features listed in the index are fetched by ``workers`` concurrent
+    requests, retried ``retries`` times and then from the LFS mirror, and
+    loaded ``batch_size`` at a time with ``COPY``.
+    '''
 
     resolution = Parameter()
+    workers = IntParameter(default=16, significant=False)
+    batch_size = IntParameter(default=5000, significant=False)
+    retries = IntParameter(default=3, significant=False)
+
     URL = 'https://media.githubusercontent.com/media/whosonfirst-data/whosonfirst-data/master/meta/wof-{resolution}-latest.csv'
+    DATA_URL = 'https://whosonfirst.mapzen.com/data/{path}'
+    LFS_URL = 'https://github.com/whosonfirst/whosonfirst-data/raw/master/data/{path}'
 
     def run(self):
-        resp = requests.get(self.URL.format(resolution=self.resolution))
-        #encoded = resp.text.encode(resp.headers['Content-Type'].split('charset=')[1])
-        reader = DictReader(resp.text.encode('utf8').split('\r\n'))
-
-        for i, line in enumerate(reader):
-            # TODO would be much, much faster in parallel...
-            url = 'https://whosonfirst.mapzen.com/data/{path}'.format(path=line['path'])
-            lfs_url = 'https://github.com/whosonfirst/whosonfirst-data/raw/master/data/{path}'.format(
-                path=line['path'])
-            cmd = 'wget \'{url}\' -O - | ogr2ogr -{operation} ' \
-                    '-nlt Geometry -nln \'{table}\' ' \
-                    '-f PostgreSQL PG:"dbname=$PGDATABASE ' \
-                    'active_schema={schema}" /vsistdin/'.format(
-                        url=url,
-                        schema=self.output().schema,
-                        table=self.output().tablename,
-                        operation='append' if i > 0 else 'overwrite -lco OVERWRITE=yes'
-                    )
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.workers)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+
+        index = fetch_url(self.URL.format(resolution=self.resolution), http).decode('utf8')
+        paths = [line['path'] for line in DictReader(index.splitlines())]
+
+        session = current_session()
+        session.execute('CREATE TABLE {features} (id NUMERIC, name TEXT, geojson TEXT)'.format(
+            features=self._features_table()))
+        loaded = 0
+        for batch in grouper(self._fetch_features(http, paths), self.batch_size):
+            batch = [feature for feature in batch if feature is not None]
+            copy_from_iterator(session, self._features_table(), ('id', 'name', 'geojson'),
+                               [copy_text_line(feature) for feature in batch])
+            loaded += len(batch)
+            LOGGER.info('%s: loaded %s of %s features', self.task_id, loaded, len(paths))
+            self.set_status_message('Loaded {} of {} features'.format(loaded, len(paths)))
+
+        session.execute('CREATE TABLE {output} AS '
+                        'SELECT id "wof:id", name "wof:name", '
+                        '       ST_SetSRID(ST_GeomFromGeoJSON(geojson), 4326) wkb_geometry '
+                        'FROM {features}'.format(output=self.output().table,
+                                                 features=self._features_table()))
+        session.execute('DROP TABLE {features}'.format(features=self._features_table()))
+
+    def _features_table(self):
+        return '"{schema}".{table}_features'.format(schema=self.output().schema,
+                                                     table=self.output().tablename[:50])
+
+    def _fetch_features(self, http, paths):
+        '''
+        Yields ``(wof:id, wof:name, geometry)`` for every path, in order, with
+        up to ``workers`` requests in flight.
+        '''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(self._fetch_feature, http, path))
+                if len(pending) >= self.workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _fetch_feature(self, http, path):
+        urls = [self.DATA_URL.format(path=path)] * self.retries + [self.LFS_URL.format(path=path)]
+        for attempt, url in enumerate(urls):
             try:
-                shell(cmd)
-            except subprocess.CalledProcessError:
-                cmd = cmd.replace(url, lfs_url)
-                shell(cmd)
+                feature = json.loads(fetch_url(url, http).decode('utf8'))
+                break
+            except (requests.RequestException, IOError, ValueError) as err:
+                if attempt == len(urls) - 1:
+                    raise
+                LOGGER.warning('Error fetching %s (%s), retrying', url, err)
+                time.sleep(min(2 ** attempt, 10) * random.random())
+        properties = feature['properties']
+        return (properties['wof:id'], properties.get('wof:name'),
+                json.dumps(feature['geometry']))
 
 
 class WOFColumns(ColumnsTask):
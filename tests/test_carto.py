@@ -4,7 +4,9 @@ from nose.tools import (assert_equals, with_setup, assert_raises, assert_in,
                         assert_is_none, assert_true, assert_false)
 from tests.util import runtask, setup, teardown, FakeTask
 
-from tasks.meta import current_session
+from lib.timespan import get_timespan
+from tasks.base_tasks import TagsTask, ColumnsTask, TableTask
+from tasks.meta import current_session, OBSColumn, OBSTag, GEOM_REF
 
 import tasks.carto
 import imp
@@ -96,3 +98,150 @@ def test_obs_meta_to_local_works_twice():
     assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta_geom').fetchone()[0], 0)
     assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta_timespan').fetchone()[0], 0)
     assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta_geom_numer_timespan').fetchone()[0], 0)
+
+
+@with_setup(setup, teardown)
+def test_obs_meta_to_local_full_rebuild():
+    '''
+    OBSMetaToLocal without incremental should rebuild everything from scratch.
+    '''
+    imp.reload(tasks.carto)
+    runtask(tasks.carto.OBSMetaToLocal())
+    session = current_session()
+    session.execute("INSERT INTO observatory.obs_meta_numer (numer_id) VALUES ('foo')")
+    session.commit()
+    runtask(tasks.carto.OBSMetaToLocal(incremental=False))
+    assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta').fetchone()[0], 0)
+    assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta_numer').fetchone()[0], 0)
+
+
+class MetaTestTags(TagsTask):
+
+    def tags(self):
+        return [OBSTag(id='population', name='Population', type='subsection'),
+                OBSTag(id='boundary', name='Boundaries', type='subsection')]
+
+
+class MetaTestGeomColumns(ColumnsTask):
+
+    def requires(self):
+        return MetaTestTags()
+
+    def columns(self):
+        return OrderedDict([
+            ('the_geom', OBSColumn(type='Geometry', name='Areas', weight=1,
+                                   tags=[self.input()['boundary']])),
+        ])
+
+
+class MetaTestGeoidColumns(ColumnsTask):
+
+    def requires(self):
+        return MetaTestGeomColumns()
+
+    def columns(self):
+        return OrderedDict([
+            ('geoid', OBSColumn(type='Text', name='Area id', weight=0,
+                                targets={self.input()['the_geom']: GEOM_REF})),
+        ])
+
+
+class MetaTestDataColumns(ColumnsTask):
+
+    def requires(self):
+        return MetaTestTags()
+
+    def columns(self):
+        total = OBSColumn(type='Numeric', name='Total population', weight=1, aggregate='sum',
+                          tags=[self.input()['population']])
+        return OrderedDict([
+            ('total_pop', total),
+            ('male_pop', OBSColumn(type='Numeric', name='Male population', weight=1, aggregate='sum',
+                                   targets={total: 'denominator'}, tags=[self.input()['population']])),
+            ('female_pop', OBSColumn(type='Numeric', name='Female population', weight=1, aggregate='sum',
+                                     targets={total: 'denominator'}, tags=[self.input()['population']])),
+        ])
+
+
+class MetaTestGeomTable(TableTask):
+
+    def requires(self):
+        return {
+            'geom': MetaTestGeomColumns(),
+            'geoid': MetaTestGeoidColumns(),
+        }
+
+    def table_timespan(self):
+        return get_timespan('2000')
+
+    def columns(self):
+        return OrderedDict([
+            ('geoid', self.input()['geoid']['geoid']),
+            ('the_geom', self.input()['geom']['the_geom']),
+        ])
+
+    def populate(self):
+        current_session().execute(
+            "INSERT INTO {output} VALUES "
+            "('a', ST_SetSRID(ST_MakeEnvelope(0, 0, 1, 1), 4326)), "
+            "('b', ST_SetSRID(ST_MakeEnvelope(1, 0, 2, 1), 4326))".format(output=self.output().table))
+
+
+class MetaTestDataTable(TableTask):
+
+    def requires(self):
+        return {
+            'geoid': MetaTestGeoidColumns(),
+            'data': MetaTestDataColumns(),
+            'geom': MetaTestGeomTable(),
+        }
+
+    def targets(self):
+        return {self.input()['geom'].obs_table: GEOM_REF}
+
+    def table_timespan(self):
+        return get_timespan('2000')
+
+    def columns(self):
+        columns = OrderedDict([('geoid', self.input()['geoid']['geoid'])])
+        columns.update(self.input()['data'])
+        return columns
+
+    def populate(self):
+        current_session().execute(
+            "INSERT INTO {output} VALUES ('a', 10, 4, 6), ('b', 20, 9, 11)".format(output=self.output().table))
+
+
+def _obs_meta_tables():
+    session = current_session()
+    return dict([(table, sorted([repr(tuple(row)) for row in session.execute(
+        'SELECT * FROM observatory.{}'.format(table))]))
+        for table in ('obs_meta', 'obs_meta_numer', 'obs_meta_denom', 'obs_meta_geom',
+                      'obs_meta_timespan', 'obs_meta_geom_numer_timespan')])
+
+
+@with_setup(setup, teardown)
+def test_obs_meta_to_local_incremental_matches_full_rebuild():
+    '''
+    An incremental OBSMetaToLocal after a change of metadata should give the
+    same obs_meta tables as a full rebuild.
+    '''
+    runtask(MetaTestDataTable())
+    imp.reload(tasks.carto)
+    runtask(tasks.carto.OBSMetaToLocal())
+    session = current_session()
+    assert_equals(session.execute('SELECT COUNT(*) FROM observatory.obs_meta').fetchone()[0], 3)
+
+    session.execute("UPDATE observatory.obs_tag SET name = 'People' WHERE id LIKE '%population'")
+    session.execute("UPDATE observatory.obs_column SET name = 'Men', version = version + 1 "
+                    "WHERE id LIKE '%male_pop' AND id NOT LIKE '%female_pop'")
+    session.commit()
+
+    imp.reload(tasks.carto)
+    runtask(tasks.carto.OBSMetaToLocal())
+    incremental = _obs_meta_tables()
+    assert_in("'Men'", ''.join(incremental['obs_meta']))
+
+    imp.reload(tasks.carto)
+    runtask(tasks.carto.OBSMetaToLocal(incremental=False))
+    assert_equals(incremental, _obs_meta_tables())
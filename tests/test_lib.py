@@ -1,5 +1,17 @@
 from nose.tools import assert_equals, assert_raises
 from lib.timespan import parse_timespan
+from lib.tileutils import tile2bounds, tiles_in_bboxes, count_tiles_in_bboxes
+from lib.geo import bboxes_intersect
+from lib.concurrency import AdaptiveLimit
+from lib.csv_stream import CSVNormalizerStream
+from lib.repository import ContentStore
+
+import io
+import os
+import re
+import shutil
+import hashlib
+import tempfile
 
 
 def test_parse_invalid_timespan():
@@ -67,3 +79,193 @@ def test_parse_day_month_year_timespan():
     assert_equals(ts_name, '20180201')
     assert_equals(ts_description, '02/01/2018')
     assert_equals(ts_timespan, '[2018-02-01, 2018-02-01]')
+
+
+def test_tiles_in_bboxes_matches_full_grid_scan():
+    bboxes = [{'xmin': -124.848974, 'ymin': 24.396308, 'xmax': -66.885444, 'ymax': 49.384358},
+              {'xmin': -179.45, 'ymin': 51.1, 'xmax': -129.94, 'ymax': 71.63},
+              {'xmin': -130.0, 'ymin': 45.0, 'xmax': -100.0, 'ymax': 60.0},
+              {'xmin': 172.3, 'ymin': 51.283, 'xmax': 180.0, 'ymax': 53.074}]
+
+    for zoom in range(0, 7):
+        expected = []
+        for x in range(0, (pow(2, zoom) + 1)):
+            for y in range(0, (pow(2, zoom) + 1)):
+                rect1 = tile2bounds(zoom, x, y)
+                if any([bboxes_intersect(rect1, [b['xmin'], b['ymin'], b['xmax'], b['ymax']]) for b in bboxes]):
+                    expected.append([x, y, zoom])
+
+        assert_equals(list(tiles_in_bboxes(zoom, bboxes)), expected)
+        assert_equals(count_tiles_in_bboxes(zoom, bboxes), len(expected))
+
+
+def test_tiles_in_bboxes_without_intersection():
+    bboxes = [{'xmin': 10, 'ymin': 89.5, 'xmax': 20, 'ymax': 89.9}]
+
+    assert_equals(list(tiles_in_bboxes(3, bboxes)), [])
+    assert_equals(count_tiles_in_bboxes(3, bboxes), 0)
+
+
+def test_adaptive_limit_grows_while_latency_is_stable():
+    limit = AdaptiveLimit(initial=4, maximum=50)
+    for _ in range(200):
+        limit.sample(0.1)
+    assert_equals(limit.limit > 4, True)
+    assert_equals(limit.limit <= 50, True)
+
+
+def test_adaptive_limit_shrinks_when_latency_degrades():
+    limit = AdaptiveLimit(initial=40, maximum=50)
+    for _ in range(40):
+        limit.sample(0.1)
+    grown = limit.limit
+    for _ in range(400):
+        limit.sample(5)
+    assert_equals(limit.limit < grown, True)
+    limit.overloaded()
+    assert_equals(limit.limit >= limit.minimum, True)
+
+
+def test_adaptive_limit_rate():
+    now = [0]
+    limit = AdaptiveLimit(clock=lambda: now[0], rate_interval=10)
+    for _ in range(21):
+        limit.sample(0.1)
+        now[0] += 0.5
+    now[0] -= 0.5
+    assert_equals(limit.rate, 2.0)
+    now[0] += 100
+    assert_equals(limit.rate, 0.0)
+
+
+def _dash_to_zero(row):
+    return ['0' if f == '-' else f for f in row]
+
+
+def test_csv_normalizer_stream_quotes_fields():
+    infile = io.StringIO('id,name\n1,-\n2,"Smith, John"\n')
+    stream = CSVNormalizerStream(infile, _dash_to_zero, block_size=1)
+    assert_equals(stream.read(), b'id,name\n1,0\n2,"Smith, John"\n')
+
+
+def test_csv_normalizer_stream_processes_keep_order():
+    lines = ''.join(['{},-\n'.format(i) for i in range(1000)])
+    stream = CSVNormalizerStream(io.StringIO(lines), _dash_to_zero, processes=2, block_size=10)
+    try:
+        assert_equals(stream.read().decode('utf-8'), lines.replace('-', '0'))
+    finally:
+        stream.close()
+
+
+class _RangeResponse(io.BytesIO):
+    def __init__(self, data, code, headers=None, fail_after=None):
+        super(_RangeResponse, self).__init__(data)
+        self.code = code
+        self.headers = headers or {}
+        self.fail_after = fail_after
+
+    def getcode(self):
+        return self.code
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise ConnectionResetError('Connection reset by peer')
+        return super(_RangeResponse, self).read(size)
+
+
+def _range_urlopen(data, etag='"v1"', fail_after=None):
+    '''
+    Stand-in for urlopen serving ``data`` as version ``etag``, with support
+    for ranges.  GETs without a range fail after ``fail_after`` bytes, as a
+    broken download.
+    '''
+    def urlopen(request):
+        headers = {'Content-Length': str(len(data)), 'Accept-Ranges': 'bytes', 'ETag': etag}
+        if request.get_method() == 'HEAD':
+            return _RangeResponse(b'', 200, headers)
+        match = re.match(r'bytes=(\d+)-(\d*)', request.get_header('Range') or '')
+        if_range = request.get_header('If-range')
+        if match is None or (if_range is not None and if_range != etag):
+            return _RangeResponse(data, 200, headers, fail_after=fail_after)
+        last = int(match.group(2)) if match.group(2) else len(data) - 1
+        return _RangeResponse(data[int(match.group(1)):last + 1], 206, headers)
+    return urlopen
+
+
+def test_content_store_fetch_deduplicates():
+    root = tempfile.mkdtemp()
+    try:
+        source = os.path.join(root, 'source.csv')
+        with open(source, 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+        store = ContentStore(os.path.join(root, 'repository'))
+        first = os.path.join(root, 'repository', 'res', '1', 'file')
+        second = os.path.join(root, 'repository', 'res', '2', 'file')
+
+        digest = store.fetch('file://' + source, first)
+        assert_equals(digest, hashlib.md5(b'a,b\n1,2\n').hexdigest())
+        assert_equals(store.fetch('file://' + source, second), digest)
+        assert_equals(os.stat(first).st_ino, os.stat(second).st_ino)
+        assert_equals(os.stat(store.blob_path(digest)).st_nlink, 3)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_content_store_resumes_download():
+    root = tempfile.mkdtemp()
+    data = os.urandom(10000)
+    try:
+        path = os.path.join(root, 'file')
+        broken = ContentStore(root, chunk_size=1000, parallel_min_size=len(data) + 1,
+                              urlopen=_range_urlopen(data, fail_after=4000))
+        with assert_raises(ConnectionResetError):
+            broken.fetch('http://example.com/file', path)
+        assert_equals(os.path.getsize(broken._partial_path('http://example.com/file')), 4000)
+
+        requests = []
+
+        def urlopen(request):
+            requests.append(request)
+            return _range_urlopen(data)(request)
+
+        store = ContentStore(root, chunk_size=1000, urlopen=urlopen,
+                             parallel_min_size=len(data) + 1)
+        assert_equals(store.fetch('http://example.com/file', path), hashlib.md5(data).hexdigest())
+        assert_equals(requests[-1].get_header('Range'), 'bytes=4000-')
+        with open(path, 'rb') as f:
+            assert_equals(f.read(), data)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_content_store_does_not_resume_changed_file():
+    root = tempfile.mkdtemp()
+    old_data, new_data = os.urandom(10000), os.urandom(10000)
+    try:
+        path = os.path.join(root, 'file')
+        broken = ContentStore(root, chunk_size=1000, parallel_min_size=len(old_data) + 1,
+                              urlopen=_range_urlopen(old_data, fail_after=4000))
+        with assert_raises(ConnectionResetError):
+            broken.fetch('http://example.com/file', path)
+
+        store = ContentStore(root, chunk_size=1000, parallel_min_size=len(new_data) + 1,
+                             urlopen=_range_urlopen(new_data, etag='"v2"'))
+        assert_equals(store.fetch('http://example.com/file', path), hashlib.md5(new_data).hexdigest())
+        with open(path, 'rb') as f:
+            assert_equals(f.read(), new_data)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_content_store_fetches_parts():
+    root = tempfile.mkdtemp()
+    data = os.urandom(10000)
+    try:
+        path = os.path.join(root, 'file')
+        store = ContentStore(root, chunk_size=1000, parts=3, parallel_min_size=1000,
+                             urlopen=_range_urlopen(data))
+        assert_equals(store.fetch('http://example.com/file', path), hashlib.md5(data).hexdigest())
+        with open(path, 'rb') as f:
+            assert_equals(f.read(), data)
+    finally:
+        shutil.rmtree(root)
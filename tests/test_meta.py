@@ -2,13 +2,14 @@
 Test metadata functions
 '''
 
+import multiprocessing
 
 from nose.tools import assert_equals, with_setup
 
 from tests.util import setup, teardown, session_scope, EMPTY_RASTER, FakeTask
 
 from tasks.meta import (OBSColumnTable, OBSColumn, OBSTable, OBSColumnTableTile,
-                        OBSTag, OBSColumnTag)
+                        OBSTag, OBSColumnTag, current_session, completeness_cache)
 from tasks.targets import TagTarget
 
 
@@ -181,3 +182,42 @@ def test_delete_columntable_removes_tiles():
         session.delete(session.query(OBSColumnTableTile).get(
             ('"us.census.acs".tract_geoms', '"us.census.tiger".tract', 1, )))
         assert_equals(session.query(OBSColumnTableTile).count(), 0)
+
+
+@with_setup(setup, teardown)
+def test_completeness_cache_invalidated_on_commit():
+    populate()
+    session = current_session()
+    assert_equals(completeness_cache.column_version('"us.census.acs".median_rent'), 0.0)
+    assert_equals(completeness_cache.column_version('"us.census.acs".nonexistent'), None)
+    assert_equals(completeness_cache.relation_exists('observatory', 'OBS_COLUMN'), True)
+
+    session.execute('UPDATE observatory.obs_column SET version = 2 '
+                    "WHERE id = '\"us.census.acs\".median_rent'")
+    assert_equals(completeness_cache.column_version('"us.census.acs".median_rent'), 2.0)
+    session.execute('CREATE TABLE observatory.foo (bar TEXT)')
+    assert_equals(completeness_cache.relation_exists('observatory', 'foo'), True)
+    session.commit()
+    assert_equals(completeness_cache.column_version('"us.census.acs".median_rent'), 2.0)
+
+
+def _set_median_rent_version(version):
+    session = current_session()
+    session.execute('UPDATE observatory.obs_column SET version = {} '
+                    "WHERE id = '\"us.census.acs\".median_rent'".format(version))
+    session.commit()
+
+
+@with_setup(setup, teardown)
+def test_completeness_cache_invalidated_by_forked_process():
+    '''
+    Commits of luigi workers running in forked processes should be seen by
+    the scheduling process.
+    '''
+    populate()
+    assert_equals(completeness_cache.column_version('"us.census.acs".median_rent'), 0.0)
+    process = multiprocessing.Process(target=_set_median_rent_version, args=(3, ))
+    process.start()
+    process.join()
+    assert_equals(process.exitcode, 0)
+    assert_equals(completeness_cache.column_version('"us.census.acs".median_rent'), 3.0)
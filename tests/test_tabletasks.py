@@ -3,6 +3,9 @@ Test TableTask classes
 '''
 
 import os
+import csv
+import json
+import shutil
 from collections import OrderedDict
 from nose import with_setup
 from nose.tools import (assert_equal, assert_is_not_none, assert_is_none,
@@ -11,10 +14,13 @@ from nose.tools import (assert_equal, assert_is_not_none, assert_is_none,
 from lib.timespan import get_timespan
 from tests.util import runtask, setup, teardown
 
+from luigi import IntParameter
+
 from tasks.base_tasks import (ColumnsTask, TableTask, GeoFile2TempTableTask, RepoFileUnzipTask, CSV2TempTableTask,
-                              Carto2TempTableTask)
+                              Carto2TempTableTask, InterpolationTask)
 from tasks.meta import OBSColumn, OBSColumnTableTile, current_session
 from tasks.util import shell
+from tasks.whosonfirst import DownloadWOF
 
 
 class TestColumnsTask(ColumnsTask):
@@ -66,12 +72,138 @@ class TestGeomTableTask(BaseTestTableTask):
             ))
 
 
+class TestInterpolationColumnsTask(ColumnsTask):
+
+    def columns(self):
+        return OrderedDict([
+            ('geoid', OBSColumn(name='', type='Text')),
+            ('the_geom', OBSColumn(name='', type='Geometry')),
+            ('measure', OBSColumn(name='', type='Numeric')),
+        ])
+
+
+class BaseTestInterpolationTableTask(TableTask):
+
+    _test = False
+
+    def table_timespan(self):
+        return get_timespan('2000')
+
+    def requires(self):
+        return TestInterpolationColumnsTask()
+
+
+class TestSourceGeomTableTask(BaseTestInterpolationTableTask):
+
+    def columns(self):
+        cols = self.input()
+        cols.pop('measure')
+        return cols
+
+    def populate(self):
+        # A grid of 10x10 unit squares
+        current_session().execute(
+            "INSERT INTO {output} (geoid, the_geom) "
+            "SELECT 's' || x || '_' || y, ST_SetSRID(ST_MakeEnvelope(x, y, x + 1, y + 1), 4326) "
+            "FROM generate_series(0, 9) x, generate_series(0, 9) y".format(output=self.output().table))
+
+
+class TestSourceDataTableTask(BaseTestInterpolationTableTask):
+
+    def columns(self):
+        cols = self.input()
+        cols.pop('the_geom')
+        return cols
+
+    def populate(self):
+        current_session().execute(
+            "INSERT INTO {output} (geoid, measure) "
+            "SELECT 's' || x || '_' || y, 100 + 10 * x + y "
+            "FROM generate_series(0, 9) x, generate_series(0, 9) y".format(output=self.output().table))
+
+
+class TestTargetGeomTableTask(BaseTestInterpolationTableTask):
+
+    def columns(self):
+        cols = self.input()
+        cols.pop('measure')
+        return cols
+
+    def populate(self):
+        # A grid of 4x4 squares not aligned with the source one, and a second
+        # geometry for one of the geoids
+        current_session().execute(
+            "INSERT INTO {output} (geoid, the_geom) "
+            "SELECT 't' || x || '_' || y, "
+            "       ST_SetSRID(ST_MakeEnvelope(2.4 * x + 0.3, 2.4 * y + 0.3, 2.4 * x + 2.7, 2.4 * y + 2.7), 4326) "
+            "FROM generate_series(0, 3) x, generate_series(0, 3) y "
+            "UNION ALL "
+            "SELECT 't0_0', ST_SetSRID(ST_MakeEnvelope(9.8, 0.2, 9.9, 0.5), 4326)".format(
+                output=self.output().table))
+
+
+class TestInterpolationTask(InterpolationTask):
+
+    _test = False
+
+    def table_timespan(self):
+        return get_timespan('2000')
+
+    def requires(self):
+        return {
+            'source_geom_columns': TestInterpolationColumnsTask(),
+            'source_geom': TestSourceGeomTableTask(),
+            'source_data_columns': TestInterpolationColumnsTask(),
+            'source_data': TestSourceDataTableTask(),
+            'target_geom_columns': TestInterpolationColumnsTask(),
+            'target_geom': TestTargetGeomTableTask(),
+            'target_data_columns': TestInterpolationColumnsTask(),
+        }
+
+    def columns(self):
+        cols = self.input()['target_data_columns']
+        return OrderedDict([
+            ('geoid', cols['geoid']),
+            ('measure', cols['measure']),
+        ])
+
+    def get_interpolation_parameters(self):
+        return {
+            'source_data_geoid': 'geoid',
+            'source_geom_geoid': 'geoid',
+            'target_data_geoid': 'geoid',
+            'target_geom_geoid': 'geoid',
+            'source_geom_geomfield': 'the_geom',
+            'target_geom_geomfield': 'the_geom',
+        }
+
+
+class TestParallelInterpolationTask(TestInterpolationTask):
+
+    workers = IntParameter(default=3, significant=False)
+
+
 class TestGeoFile2TempTableTask(GeoFile2TempTableTask):
 
     def input_files(self):
         return os.path.join('tests', 'fixtures', 'cartodb-query.shp')
 
 
+class TestMultiGeoFile2TempTableTask(GeoFile2TempTableTask):
+
+    def input_files(self):
+        return [os.path.join('tests', 'fixtures', 'cartodb-query.shp')] * 3
+
+
+WOF_DIR = os.path.abspath(os.path.join('tmp', 'test_wof'))
+
+
+class TestDownloadWOF(DownloadWOF):
+    URL = 'file://' + os.path.join(WOF_DIR, 'wof-{resolution}-latest.csv')
+    DATA_URL = 'file://' + os.path.join(WOF_DIR, 'data', '{path}')
+    LFS_URL = 'file://' + os.path.join(WOF_DIR, 'lfs', '{path}')
+
+
 class TestRepoFileUnzipTask(RepoFileUnzipTask):
     def get_url(self):
         return 'http://andrew.carto.com/api/v2/sql?q=select%20*%20from%20dma_master_polygons%20limit%201&format=shp'
@@ -89,6 +221,29 @@ class TestCSV2TempTableTask(CSV2TempTableTask):
         return os.path.join('tests', 'fixtures', 'cartodb-query.csv')
 
 
+class TestRecodeCSV2TempTableTask(CSV2TempTableTask):
+
+    def input_csv(self):
+        return os.path.join('tests', 'fixtures', 'cartodb-query.csv')
+
+    def recode(self):
+        return {
+            'cartodb_id': {1: 'one', 2: 'two'},
+            'dma_code': {'767': 'Casper', '839': 'Las Vegas'},
+        }
+
+
+class TestMultiCSV2TempTableTask(CSV2TempTableTask):
+
+    def input_csv(self):
+        return [os.path.join('tests', 'fixtures', 'cartodb-query.csv')] * 3
+
+    def coldef(self):
+        with open(self.input_csv()[0], 'r') as f:
+            header_row = next(csv.reader(f))
+        return [(h, 'Text') for h in header_row]
+
+
 @with_setup(setup, teardown)
 def test_table_task():
     '''
@@ -160,6 +315,56 @@ def test_shp_2_temp_table_task():
     assert_equal(before_table_count, after_table_count)
 
 
+@with_setup(setup, teardown)
+def test_geofile_2_temp_table_task_several_files():
+    '''
+    Geofile to temp table task should merge all the files into one table.
+    '''
+    task = TestMultiGeoFile2TempTableTask(workers=2)
+    runtask(task)
+    session = current_session()
+    assert_equal(session.execute(
+        'SELECT COUNT(*) FROM {}'.format(
+            task.output().table)).fetchone()[0], 30)
+    assert_equal(session.execute(
+        "SELECT COUNT(*) FROM information_schema.tables "
+        "WHERE table_schema = '{}' AND table_name LIKE '%\\_part%'".format(
+            task.output().schema)).fetchone()[0], 0)
+
+
+@with_setup(setup, teardown)
+def test_download_wof():
+    '''
+    DownloadWOF should load every feature of the index, falling back to the
+    LFS URL when the data URL fails.
+    '''
+    shutil.rmtree(WOF_DIR, ignore_errors=True)
+    paths = []
+    for wof_id in range(1, 8):
+        path = '{}/{}.geojson'.format(wof_id, wof_id)
+        paths.append(path)
+        # Odd features are only on the LFS mirror
+        mirror = 'lfs' if wof_id % 2 else 'data'
+        os.makedirs(os.path.join(WOF_DIR, mirror, str(wof_id)))
+        with open(os.path.join(WOF_DIR, mirror, path), 'w') as f:
+            json.dump({'type': 'Feature',
+                       'properties': {'wof:id': wof_id, 'wof:name': 'Place\t{}'.format(wof_id)},
+                       'geometry': {'type': 'Point', 'coordinates': [wof_id, wof_id]}}, f)
+    with open(os.path.join(WOF_DIR, 'wof-region-latest.csv'), 'w') as f:
+        f.write('id,path\n' + ''.join(['{},{}\n'.format(num, path) for num, path in enumerate(paths)]))
+
+    try:
+        task = TestDownloadWOF(resolution='region', workers=2, batch_size=3, retries=1)
+        runtask(task)
+        rows = current_session().execute(
+            'SELECT "wof:id", "wof:name", ST_X(wkb_geometry) FROM {} ORDER BY 1'.format(
+                task.output().table)).fetchall()
+        assert_equal([(int(r[0]), r[1], r[2]) for r in rows],
+                     [(num, 'Place\t{}'.format(num), num) for num in range(1, 8)])
+    finally:
+        shutil.rmtree(WOF_DIR, ignore_errors=True)
+
+
 @with_setup(setup, teardown)
 def test_csv_2_temp_table_task():
     '''
@@ -179,6 +384,55 @@ def test_csv_2_temp_table_task():
     assert_equal(before_table_count, after_table_count)
 
 
+@with_setup(setup, teardown)
+def test_csv_2_temp_table_task_several_csvs():
+    '''
+    CSV to temp table task should load all the CSVs into the same table.
+    '''
+    task = TestMultiCSV2TempTableTask(copy_workers=2)
+    runtask(task)
+    assert_equal(current_session().execute(
+        'SELECT COUNT(*) FROM {}'.format(
+            task.output().table)).fetchone()[0], 30)
+
+
+@with_setup(setup, teardown)
+def test_csv_2_temp_table_task_recode():
+    '''
+    CSV to temp table task should replace the values of the recoded columns,
+    and leave the others untouched.
+    '''
+    task = TestRecodeCSV2TempTableTask()
+    runtask(task)
+    session = current_session()
+    assert_equal(session.execute(
+        'SELECT cartodb_id, dma_code FROM {} WHERE cartodb_id IN (\'one\', \'two\', \'3\') '
+        'ORDER BY cartodb_id'.format(task.output().table)).fetchall(),
+        [('3', '543'), ('one', 'Casper'), ('two', 'Las Vegas')])
+    assert_equal(session.execute(
+        'SELECT COUNT(*) FROM {}'.format(task.output().table)).fetchone()[0], 10)
+
+
+@with_setup(setup, teardown)
+def test_interpolation_task_parallel():
+    '''
+    Interpolating in parallel chunks should give the same results as the
+    single statement, counting every geometry of a geoid once.
+    '''
+    task = TestInterpolationTask()
+    runtask(task)
+    parallel_task = TestParallelInterpolationTask()
+    runtask(parallel_task)
+    session = current_session()
+    assert_equal(session.execute(
+        'SELECT COUNT(*) FROM {}'.format(parallel_task.output().table)).fetchone()[0], 16)
+    assert_equal(session.execute(
+        'SELECT COUNT(*) FROM {single} single FULL JOIN {parallel} parallel USING (geoid) '
+        'WHERE single.geoid IS NULL OR parallel.geoid IS NULL '
+        '   OR ABS(single.measure - parallel.measure) > 1'.format(
+            single=task.output().table, parallel=parallel_task.output().table)).fetchone()[0], 0)
+
+
 @with_setup(setup, teardown)
 def test_download_unzip_task():
     '''
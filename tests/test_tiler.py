@@ -0,0 +1,59 @@
+'''
+Test tiler tasks
+'''
+
+from nose import with_setup
+from nose.tools import assert_equal, assert_true, assert_false
+
+from tests.util import setup, teardown
+
+from tasks.meta import current_session
+from tasks.tiler.xyz import TilerXYZTableTask
+
+
+class TestTilerXYZTableTask(TilerXYZTableTask):
+
+    def _get_config_data(self):
+        return [{
+            "table": "test_xyz",
+            "schema": "tiler",
+            "sharded": False,
+            "bboxes": [{"xmin": -10, "ymin": -10, "xmax": 10, "ymax": 10}],
+        }]
+
+    def get_table_columns(self, config, shard_value=None):
+        return ['total NUMERIC']
+
+
+def _drop_tiler_schema():
+    session = current_session()
+    session.rollback()
+    session.execute('DROP SCHEMA IF EXISTS tiler CASCADE')
+    session.commit()
+
+
+@with_setup(setup, teardown)
+def test_tiler_progress_reset_when_table_recreated():
+    task = TestTilerXYZTableTask(zoom_level=0, geography='test')
+    config = task.config_data[0]
+    table_data = task._get_table_names(config)[0]
+    session = current_session()
+    try:
+        task._create_schema_and_table(table_data, config)
+        session.execute("INSERT INTO tiler.test_xyz (x, y, z, geoid, total) VALUES (0, 0, 0, '1', 1)")
+        session.execute("INSERT INTO tiler.tile_progress VALUES ('test_xyz', 0, 0, 0)")
+        session.commit()
+        assert_equal(task.progress(), {'test_xyz': (1, 1)})
+        assert_true(task.complete())
+
+        # A rerun against the existing table keeps the recorded tiles
+        task._create_schema_and_table(table_data, config)
+        assert_equal(task.progress(), {'test_xyz': (1, 1)})
+
+        session.execute('DROP TABLE tiler.test_xyz')
+        session.commit()
+        task._create_schema_and_table(table_data, config)
+        assert_equal(task.progress(), {'test_xyz': (0, 1)})
+        assert_false(task.complete())
+    finally:
+        _drop_tiler_schema()
@@ -1,3 +1,8 @@
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
 from collections import OrderedDict
 from luigi import Parameter
 from nose.tools import (assert_equals, with_setup, assert_raises, assert_in,
@@ -5,8 +10,9 @@ from nose.tools import (assert_equals, with_setup, assert_raises, assert_in,
 from tests.util import runtask, session_scope, setup, teardown, FakeTask
 
 from tasks.base_tasks import ColumnsTask, TableTask, TagsTask
-from tasks.util import underscore_slugify, generate_tile_summary
-from tasks.targets import PostgresTarget, ColumnTarget, TagTarget, TableTarget
+from tasks.util import underscore_slugify, generate_tile_summary, uncompress_file, open_stream
+from tasks.targets import (PostgresTarget, ColumnTarget, TagTarget, TableTarget, update_or_create_columns,
+                           targets_exist)
 from tasks.meta import (UNIVERSE, OBSColumn, OBSColumnTable, OBSTag, current_session,
                         OBSTable, OBSColumnTag, OBSColumnToColumn, metadata)
 from lib.timespan import get_timespan
@@ -274,6 +280,31 @@ def test_columns_task_with_tags_def_one_tag():
                   'Section tag not added from tags method')
 
 
+@with_setup(setup, teardown)
+def test_update_or_create_columns():
+    task = TestColumnsTask()
+    runtask(task)
+
+    # Only the attributes that are set are updated, and links are replaced
+    col = OBSColumn(id='test_util.population', type='Numeric', name='Population',
+                    version=1, targets={})
+    update_or_create_columns([ColumnTarget(col, FakeTask())])
+    session = current_session()
+    session.commit()
+    pop = session.query(OBSColumn).get('test_util.population')
+    assert_equals(pop.name, 'Population')
+    assert_equals(pop.aggregate, 'sum')
+    assert_equals(float(pop.version), 1)
+    assert_equals(len(pop.tags), 2)
+    assert_equals(session.query(OBSColumnToColumn).count(), 1)
+
+    foobar = OBSColumn(id='test_util.foobar', type='Numeric', name='Foo Bar', tags=[], targets={})
+    update_or_create_columns([ColumnTarget(foobar, FakeTask())])
+    session.commit()
+    assert_equals(session.query(OBSColumnToColumn).count(), 0)
+    assert_equals(session.query(OBSColumnTag).filter_by(column_id='test_util.foobar').count(), 0)
+
+
 @with_setup(setup, teardown)
 def test_columns_task_with_tags_def_two_tags():
 
@@ -544,7 +575,28 @@ def test_postgres_target_existencess():
     assert_equals(target.exists(), True)
 
 
-def fake_table_for_rasters(geometries):
+@with_setup(setup, teardown)
+def test_targets_exist():
+    '''
+    targets_exist should resolve several targets at once.
+    '''
+    session = current_session()
+    session.execute('CREATE TABLE observatory.empty_table (id INT)')
+    session.execute('CREATE TABLE observatory.full_table (id INT)')
+    session.execute('INSERT INTO observatory.full_table VALUES (1), (2)')
+    session.commit()
+
+    assert_equals(targets_exist([
+        PostgresTarget('observatory', 'full_table'),
+        PostgresTarget('observatory', 'empty_table'),
+        PostgresTarget('observatory', 'empty_table', non_empty=False),
+        PostgresTarget('observatory', 'missing_table'),
+        PostgresTarget('observatory', 'full_table', where='id > 1'),
+        PostgresTarget('observatory', 'full_table', where='id > 2'),
+    ]), [True, False, True, False, True, False])
+
+
+def fake_table_for_rasters(geometries, workers=None):
     session = current_session()
     table_id = 'foo_table'
     column_id = 'foo_column'
@@ -563,7 +615,10 @@ def fake_table_for_rasters(geometries):
         SELECT '{table_id}', '{tablename}', 1,
                 (SELECT ST_SetSRID(ST_Extent({colname}), 4326) FROM {tablename})
     '''.format(table_id=table_id, tablename=tablename, colname=colname))
-    generate_tile_summary(session, table_id, column_id, tablename, colname)
+    if workers:
+        # Worker connections only see the committed table
+        session.commit()
+    generate_tile_summary(session, table_id, column_id, tablename, colname, workers=workers)
     session.commit()
 
 
@@ -605,6 +660,27 @@ def test_generate_tile_summary_thousandgeom():
     ''').fetchone()[0], 100, 1)
 
 
+@with_setup(setup, teardown)
+def test_generate_tile_summary_parallel():
+    '''
+    generate_tile_summary should give the same summary computed in parallel.
+    '''
+    fake_table_for_rasters(50 * [
+        'POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))'
+    ] + 50 * [
+        'POLYGON((-60 -20, -50 -20, -50 -10, -60 -10, -60 -20))'
+    ], workers=3)
+    session = current_session()
+    assert_almost_equals(session.execute('''
+        SELECT (ST_SummaryStatsAgg(tile, 2, false)).sum
+        FROM observatory.obs_column_table_tile
+    ''').fetchone()[0], 100, 1)
+    assert_almost_equals(session.execute('''
+        SELECT (ST_SummaryStatsAgg(tile, 1, false)).sum
+        FROM observatory.obs_column_table_tile_simple
+    ''').fetchone()[0], 100, 1)
+
+
 @with_setup(setup, teardown)
 def test_tabletask_without_timespan():
     class TestTableTaskWithoutTimespan(TableTask):
@@ -652,3 +728,26 @@ def test_tabletask_with_invalid_timespan():
     task = TestTableTaskWithoutTimespan()
     with assert_raises(ValueError):
         runtask(task)
+
+
+def test_uncompress_file_and_open_stream():
+    tmp = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(tmp, 'archive')
+        with zipfile.ZipFile(archive + '.zip', 'w', zipfile.ZIP_DEFLATED) as z:
+            for num in range(5):
+                z.writestr('dir/file{}.csv'.format(num), 'a,b\n{},{}\n'.format(num, num) * (num + 1))
+        with gzip.open(os.path.join(tmp, 'file.csv.gz'), 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+
+        uncompress_file(archive, workers=2)
+        for num in range(5):
+            with open(os.path.join(archive, 'dir', 'file{}.csv'.format(num))) as f:
+                assert_equals(f.read(), 'a,b\n{},{}\n'.format(num, num) * (num + 1))
+
+        with open_stream(os.path.join(tmp, 'archive.zip', 'dir', 'file3.csv')) as f:
+            assert_equals(f.read(), b'a,b\n3,3\n' * 4)
+        with open_stream(os.path.join(tmp, 'file.csv.gz')) as f:
+            assert_equals(f.read(), b'a,b\n1,2\n')
+    finally:
+        shutil.rmtree(tmp)
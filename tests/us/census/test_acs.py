@@ -11,11 +11,15 @@ try:
 except:
     pass
 
+from collections import OrderedDict
+
+from luigi import Parameter
 from nose.tools import assert_equals, with_setup, assert_false, assert_true
 
 from tasks.meta import (OBSColumnTable, OBSColumn, OBSColumnToColumn, OBSTable,
                         OBSTag, OBSColumnTag, Base, current_session)
-from tasks.us.census.acs import Columns, Extract
+from tasks.targets import PostgresTarget
+from tasks.us.census.acs import Columns, Extract, Quantiles
 
 from tests.util import runtask, setup, teardown
 
@@ -29,3 +33,54 @@ def test_acs_columns_run():
     assert_equals(True, task.complete())
     assert_equals(True, worker.run_succeeded)
     assert_equals(0, len(current_session().dirty))
+
+
+class FakeQuantiles(Quantiles):
+    '''
+    Quantiles of ``observatory.quantiles_source`` into ``output_table``.
+    '''
+
+    output_table = Parameter()
+
+    def input(self):
+        return {
+            'columns': OrderedDict([('a_quantile', None), ('b_quantile', None), ('c_quantile', None)]),
+            'table': PostgresTarget('observatory', 'quantiles_source'),
+        }
+
+    def output(self):
+        return PostgresTarget('observatory', self.output_table)
+
+
+@with_setup(setup, teardown)
+def test_quantiles_parallel_matches_single_pass():
+    session = current_session()
+    session.execute('''
+        CREATE TABLE observatory.quantiles_source AS
+        SELECT 'sl' || i geoidsl, 'sc' || i geoidsc, (i * 7) % 11 a, (i * 3) % 5 b, i c
+        FROM generate_series(1, 50) i
+        UNION ALL
+        SELECT NULL, NULL, 1, 2, 3
+    ''')
+    for table in ('quantiles_single', 'quantiles_parallel'):
+        session.execute('''
+            CREATE TABLE observatory.{} (geoidsl TEXT, geoidsc TEXT,
+                                         a_quantile NUMERIC, b_quantile NUMERIC, c_quantile NUMERIC)
+        '''.format(table))
+    # Workers only see committed tables
+    session.commit()
+
+    FakeQuantiles(year='2015', sample='5yr', geography='state', workers=1,
+                  output_table='quantiles_single').populate()
+    FakeQuantiles(year='2015', sample='5yr', geography='state', workers=3,
+                  output_table='quantiles_parallel').populate()
+    session = current_session()
+    assert_equals(session.execute(
+        'SELECT COUNT(*) FROM observatory.quantiles_parallel').fetchone()[0], 51)
+    for first, second in (('quantiles_single', 'quantiles_parallel'),
+                          ('quantiles_parallel', 'quantiles_single')):
+        assert_equals(session.execute('''
+            SELECT COUNT(*) FROM (SELECT * FROM observatory.{} EXCEPT ALL SELECT * FROM observatory.{}) diff
+        '''.format(first, second)).fetchone()[0], 0)
+    assert_equals(session.execute(
+        "SELECT to_regclass('observatory.quantiles_parallel_0')").fetchone()[0], None)